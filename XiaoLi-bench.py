@@ -0,0 +1,1015 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import subprocess
+import socket
+import threading
+import contextlib
+import importlib.util
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Dict, List, Optional
+
+# 本脚本提供离线的星火接口模拟服务器和小狸智能体循环的基准测试，不需要网络
+
+
+def load_xiaoli():
+    """加载同目录下的 XiaoLi-v3.py（文件名含连字符，不能直接import）"""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "XiaoLi-v3.py")
+    spec = importlib.util.spec_from_file_location("xiaoli_v3", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _reply(content, **options) -> Dict:
+    """构造一条脚本化回复；content为dict时自动转为JSON文本"""
+    if not isinstance(content, str):
+        content = json.dumps(content, ensure_ascii=False)
+    return {"content": content, **options}
+
+
+def _final(text: str, **options) -> Dict:
+    return _reply({"thinking": "回复用户", "action": "final_response", "response": text,
+                   "actions": ["blink_eyes"]}, **options)
+
+
+def _tools(*calls, **options) -> Dict:
+    return _reply({"thinking": "调用工具", "action": "tool_call",
+                   "tool_calls": [{"function": {"name": name, "arguments": args}} for name, args in calls]},
+                  **options)
+
+
+# 内置场景：input为用户输入，replies为每次迭代的回复
+SCENARIOS = {
+    "chat": {
+        "input": "你好呀",
+        "replies": [_final("你好喵~ 今天想让小狸帮你做什么呢？")],
+    },
+    "tools": {
+        "input": "现在几点了，顺便算一下12*34",
+        "replies": [
+            _tools(("get_current_time", {}), ("calculate", {"expression": "12*34"})),
+            _final("现在的时间已经告诉你啦，12*34=408喵~"),
+        ],
+    },
+    "chain": {
+        "input": "看看当前目录有什么，再检查一下README",
+        "replies": [
+            _tools(("get_current_directory", {})),
+            _tools(("list_directory", {"directory_path": "."}), ("file_exists", {"file_path": "README.md"})),
+            _tools(("get_file_size", {"file_path": "README.md"})),
+            _final("目录和README都检查好啦喵~"),
+        ],
+    },
+    "malformed": {
+        "input": "讲个笑话",
+        "replies": [
+            _reply("好的，下面是一个笑话：……"),
+            _reply('{"thinking": "修正格式", "action": "final_response", "response": "未闭合'),
+            _final("小猫为什么不爱玩扑克？因为怕遇到猎豹（cheetah）喵~"),
+        ],
+    },
+    "slow_stream": {
+        "input": "写一段长一点的问候",
+        "replies": [_final("你好呀，" + "今天也要元气满满喵~" * 20, chunk_size=4, chunk_delay=0.005)],
+    },
+    "flaky": {
+        "input": "测试一下重试",
+        "replies": [_final("重试成功喵~", status=503, retry_after=0)],
+    },
+}
+
+
+class MockSparkServer:
+    """模拟星火 /v2/chat/completions 接口的本地HTTP服务器
+
+    按最后一轮用户输入选择场景，按本轮已有的迭代次数选择回复，
+    支持流式SSE、首字节延迟、分块延迟和错误状态码注入。
+    """
+
+    def __init__(self, scenarios: Dict = None, host: str = "127.0.0.1", port: int = 0,
+                 default_scenario: str = "chat"):
+        self.scenarios = scenarios or SCENARIOS
+        self.default_scenario = default_scenario
+        self._inputs = {spec["input"]: name for name, spec in self.scenarios.items()}
+        self._lock = threading.Lock()
+        self._failures_sent = set()
+        self.stats = {"requests": 0, "bytes_received": 0, "service_seconds": 0.0}
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def setup(self):
+                super().setup()
+                # 关闭Nagle算法，避免小块SSE写入与延迟确认叠加出的约40ms停顿
+                self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            def do_POST(self):
+                started = time.perf_counter()
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length)
+                try:
+                    payload = json.loads(body)
+                except json.JSONDecodeError:
+                    self._send_json(400, {"code": 10003, "message": "invalid json"})
+                    return
+                try:
+                    server._serve(self, payload)
+                except (BrokenPipeError, ConnectionResetError):
+                    # 客户端取消了请求
+                    self.close_connection = True
+                finally:
+                    with server._lock:
+                        server.stats["requests"] += 1
+                        server.stats["bytes_received"] += length
+                        server.stats["service_seconds"] += time.perf_counter() - started
+
+            def _send_json(self, status, data, headers=None):
+                out = json.dumps(data, ensure_ascii=False).encode('utf-8')
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(out)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(out)
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v2/chat/completions"
+
+    def start(self) -> "MockSparkServer":
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return dict(self.stats)
+
+    def _select(self, messages: List[Dict]):
+        """根据消息列表确定场景和迭代序号"""
+        last_assistant = -1
+        for index, message in enumerate(messages):
+            if message.get("role") == "assistant":
+                last_assistant = index
+        turn = [m for m in messages[last_assistant + 1:] if m.get("role") == "user"]
+        user_input = turn[0].get("content", "") if turn else ""
+        name = self._inputs.get(user_input, self.default_scenario)
+        return name, max(0, len(turn) - 1), len(messages)
+
+    def _serve(self, handler, payload: Dict):
+        name, iteration, depth = self._select(payload.get("messages", []))
+        replies = self.scenarios[name]["replies"]
+        reply = replies[min(iteration, len(replies) - 1)]
+
+        # 错误注入：同一位置只失败一次，重试后返回正常结果
+        status = reply.get("status", 200)
+        if status != 200:
+            marker = (name, iteration, depth)
+            with self._lock:
+                first = marker not in self._failures_sent
+                self._failures_sent.add(marker)
+            if first:
+                headers = {}
+                if "retry_after" in reply:
+                    headers["Retry-After"] = str(reply["retry_after"])
+                handler._send_json(status, {"code": status, "message": "mock failure"}, headers)
+                return
+
+        if reply.get("delay"):
+            time.sleep(reply["delay"])
+
+        content = reply["content"]
+        if not payload.get("stream"):
+            handler._send_json(200, {
+                "code": 0, "message": "Success", "sid": "mock",
+                "choices": [{"message": {"role": "assistant", "content": content}, "index": 0}],
+            })
+            return
+
+        handler.send_response(200)
+        handler.send_header("Content-Type", "text/event-stream")
+        handler.send_header("Transfer-Encoding", "chunked")
+        handler.end_headers()
+
+        def write_event(data: str):
+            event = f"data: {data}\n\n".encode('utf-8')
+            handler.wfile.write(b"%x\r\n%s\r\n" % (len(event), event))
+            handler.wfile.flush()
+
+        chunk_size = reply.get("chunk_size", 16)
+        for start in range(0, len(content), chunk_size):
+            if start and reply.get("chunk_delay"):
+                time.sleep(reply["chunk_delay"])
+            write_event(json.dumps({
+                "code": 0, "message": "Success", "sid": "mock",
+                "choices": [{"delta": {"role": "assistant", "content": content[start:start + chunk_size]},
+                             "index": 0}],
+            }, ensure_ascii=False))
+        write_event("[DONE]")
+        handler.wfile.write(b"0\r\n\r\n")
+        handler.wfile.flush()
+
+
+def percentile(values: List[float], p: float) -> float:
+    """线性插值百分位数"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * p / 100
+    low = int(k)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (k - low)
+
+
+class NullLive2DChannel:
+    """替代模块级的Live2D通道，基准测试中不连接桌面宠物"""
+
+    def speak(self, text: str, actions: Optional[List[str]] = None):
+        pass
+
+    def stop(self):
+        pass
+
+    def close(self, timeout: float = 0.5):
+        pass
+
+
+@contextlib.contextmanager
+def without_live2d(xiaoli):
+    """在with块内把xiaoli.live2d_channel换成空实现，计时不包含连接宠物的尝试"""
+    original = xiaoli.live2d_channel
+    xiaoli.live2d_channel = NullLive2DChannel()
+    try:
+        yield
+    finally:
+        xiaoli.live2d_channel = original
+
+
+def run_agent_benchmark(xiaoli, server: MockSparkServer, scenario_names: List[str], turns: int,
+                        stream: bool = True, quiet: bool = True) -> Dict:
+    """通过模拟服务器驱动 XiaoLiAgent.process_user_input，统计每轮耗时与智能体自身开销
+
+    关闭本地意图路由（每轮都经过模拟大模型），Live2D通道换成空实现，只测量智能体循环本身。
+    """
+    results = {}
+    devnull = open(os.devnull, "w")
+    for name in scenario_names:
+        records = []
+        client = xiaoli.SparkX1Client("mock", base_url=server.url, backoff_base=0.01)
+        agent = xiaoli.XiaoLiAgent("mock", stream=stream, client=client, use_router=False)
+        user_input = server.scenarios[name]["input"]
+        try:
+            for _ in range(turns):
+                before = server.snapshot()
+                started = time.perf_counter()
+                with contextlib.redirect_stdout(devnull) if quiet else contextlib.nullcontext(), \
+                        without_live2d(xiaoli):
+                    agent.process_user_input(user_input)
+                wall = time.perf_counter() - started
+                after = server.snapshot()
+                upstream = after["service_seconds"] - before["service_seconds"]
+                records.append({
+                    "wall": wall,
+                    "upstream": upstream,
+                    "overhead": max(0.0, wall - upstream),
+                    "iterations": after["requests"] - before["requests"],
+                    "bytes_sent": after["bytes_received"] - before["bytes_received"],
+                })
+                # 每个场景每轮都从干净的历史开始，保证可比
+                agent.messages = agent.messages[:1]
+        finally:
+            agent.close()
+
+        walls = [r["wall"] * 1000 for r in records]
+        overheads = [r["overhead"] * 1000 for r in records]
+        results[name] = {
+            "turns": len(records),
+            "wall_ms": {"mean": sum(walls) / len(walls), "p50": percentile(walls, 50),
+                        "p95": percentile(walls, 95), "p99": percentile(walls, 99)},
+            "overhead_ms": {"p50": percentile(overheads, 50), "p95": percentile(overheads, 95),
+                            "p99": percentile(overheads, 99)},
+            "iterations": sum(r["iterations"] for r in records) / len(records),
+            "bytes_sent": sum(r["bytes_sent"] for r in records) / len(records),
+        }
+    devnull.close()
+    return results
+
+
+def print_agent_report(results: Dict):
+    """打印基准测试结果表"""
+    header = f"{'场景':<12}{'轮数':>6}{'迭代':>6}{'发送字节':>10}{'平均ms':>10}{'p50':>9}{'p95':>9}{'p99':>9}{'开销p50':>10}{'开销p95':>10}{'开销p99':>10}"
+    print(header)
+    print("-" * len(header))
+    for name, r in results.items():
+        w, o = r["wall_ms"], r["overhead_ms"]
+        print(f"{name:<12}{r['turns']:>6}{r['iterations']:>6.1f}{r['bytes_sent']:>10.0f}"
+              f"{w['mean']:>10.1f}{w['p50']:>9.1f}{w['p95']:>9.1f}{w['p99']:>9.1f}"
+              f"{o['p50']:>10.1f}{o['p95']:>10.1f}{o['p99']:>10.1f}")
+
+
+def run_ai_server(port: int, mock_url: Optional[str] = None, max_inflight: Optional[int] = None,
+                  rate: Optional[float] = None, max_queue: Optional[int] = None):
+    """以模拟星火服务器为后端运行AI服务，直到进程被终止"""
+    xiaoli = load_xiaoli()
+    mock = None
+    if mock_url is None:
+        mock = MockSparkServer().start()
+        mock_url = mock.url
+    upstream = xiaoli.UpstreamScheduler()
+    if max_inflight is not None:
+        upstream.max_inflight = max_inflight
+    if rate is not None:
+        upstream.rate = rate
+    if max_queue is not None:
+        upstream.max_queue = max_queue
+    sessions = xiaoli.SessionManager(xiaoli.SparkX1Client("mock", base_url=mock_url, backoff_base=0.01),
+                                     upstream=upstream)
+    ai_server = xiaoli.AIServer(sessions, port=port)
+    if not ai_server.start_in_thread():
+        sys.exit(1)
+    # 供负载测试进程识别监听端口
+    print(f"LISTEN {ai_server.port}", flush=True)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        ai_server.shutdown()
+        if mock is not None:
+            mock.stop()
+
+
+def spawn_ai_server(mock_url: str, server_args: List[str]) -> "tuple[subprocess.Popen, int]":
+    """在子进程中启动AI服务（便于单独统计其内存），返回(进程, 端口)"""
+    command = [sys.executable, os.path.abspath(__file__), "serve", "--port", "0", "--mock-url", mock_url,
+               *server_args]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    port = None
+    for raw in process.stdout:
+        line = raw.decode("utf-8", "replace")
+        if line.startswith("LISTEN "):
+            port = int(line.split()[1])
+            break
+    if port is None:
+        process.kill()
+        raise RuntimeError("AI服务启动失败")
+    # 持续读掉服务端输出（思考动画等），防止管道写满阻塞服务
+    threading.Thread(target=lambda: [None for _ in process.stdout], daemon=True).start()
+    return process, port
+
+
+async def _load_client(host: str, port: int, index: int, inputs: List[str], messages: int, interval: float,
+                       start_delay: float, stream: bool, timeout: float, records: List[Dict], errors: Dict):
+    """一个模拟UI客户端：连接、建立会话，按间隔依次发送消息"""
+    await asyncio.sleep(start_delay)
+    try:
+        reader, writer = await asyncio.open_connection(host, port, limit=4 * 1024 * 1024)
+    except OSError:
+        errors["connect"] += 1
+        return
+    try:
+        writer.write((json.dumps({"type": "hello", "session_id": f"load-{index}", "stream": stream}) + "\n").encode())
+        await asyncio.wait_for(reader.readline(), timeout)
+        for n in range(messages):
+            text = inputs[(index + n) % len(inputs)]
+            started = time.perf_counter()
+            first = None
+            writer.write((json.dumps({"type": "user_input", "text": text}, ensure_ascii=False) + "\n").encode("utf-8"))
+            await writer.drain()
+            while True:
+                line = await asyncio.wait_for(reader.readline(), timeout)
+                if not line:
+                    errors["disconnect"] += 1
+                    return
+                message = json.loads(line)
+                kind = message.get("type")
+                if kind in ("ai_response_delta", "tool_progress"):
+                    first = first or time.perf_counter()
+                    continue
+                if kind in ("ai_response", "ai_response_done"):
+                    finished = time.perf_counter()
+                    records.append({"at": finished, "latency": finished - started,
+                                    "ttfb": (first or finished) - started, "error": bool(message.get("error"))})
+                    break
+                if kind == "error":
+                    errors["protocol"] += 1
+                    break
+            if interval > 0 and n + 1 < messages:
+                await asyncio.sleep(interval)
+    except asyncio.TimeoutError:
+        errors["timeout"] += 1
+    except (OSError, ValueError):
+        errors["disconnect"] += 1
+    finally:
+        writer.close()
+
+
+async def _sample_rss(pid: Optional[int], samples: List[Dict], records: List[Dict], started: float,
+                      period: float):
+    """定期记录AI服务进程的RSS和已完成的请求数"""
+    process = None
+    if pid is not None:
+        import psutil
+        process = psutil.Process(pid)
+    while True:
+        rss = None
+        if process is not None:
+            try:
+                rss = process.memory_info().rss
+            except Exception:
+                rss = None
+        samples.append({"t": time.perf_counter() - started, "rss_mb": rss / 1048576 if rss else None,
+                        "completed": len(records)})
+        await asyncio.sleep(period)
+
+
+def run_load_test(host: str, port: int, clients: int, messages: int, inputs: List[str], interval: float = 0.0,
+                  ramp: float = 0.0, stream: bool = False, timeout: float = 60.0, pid: Optional[int] = None,
+                  sample_period: float = 0.5) -> Dict:
+    """N个并发UI客户端压测端口8888的AI服务，统计延迟分位数、吞吐、错误率和服务端RSS"""
+    records: List[Dict] = []
+    samples: List[Dict] = []
+    errors = {"connect": 0, "disconnect": 0, "timeout": 0, "protocol": 0}
+
+    async def run():
+        started = time.perf_counter()
+        sampler = asyncio.create_task(_sample_rss(pid, samples, records, started, sample_period))
+        await asyncio.gather(*[
+            _load_client(host, port, index, inputs, messages, interval, ramp * index / max(1, clients),
+                         stream, timeout, records, errors)
+            for index in range(clients)
+        ])
+        sampler.cancel()
+        await asyncio.sleep(0)
+        samples.append({"t": time.perf_counter() - started, "rss_mb": samples[-1]["rss_mb"] if samples else None,
+                        "completed": len(records)})
+        return time.perf_counter() - started
+
+    duration = asyncio.run(run())
+    latencies = [r["latency"] * 1000 for r in records]
+    ttfbs = [r["ttfb"] * 1000 for r in records]
+    failed = sum(1 for r in records if r["error"]) + sum(errors.values())
+    attempted = clients * messages
+    rss = [sample["rss_mb"] for sample in samples if sample["rss_mb"] is not None]
+    return {
+        "clients": clients,
+        "attempted": attempted,
+        "completed": len(records),
+        "duration_s": duration,
+        "throughput_rps": len(records) / duration if duration else 0.0,
+        "error_rate": failed / attempted if attempted else 0.0,
+        "errors": dict(errors, reply=sum(1 for r in records if r["error"])),
+        "latency_ms": {"mean": sum(latencies) / len(latencies) if latencies else 0.0,
+                       "p50": percentile(latencies, 50), "p95": percentile(latencies, 95),
+                       "p99": percentile(latencies, 99), "max": max(latencies, default=0.0)},
+        "ttfb_ms": {"p50": percentile(ttfbs, 50), "p95": percentile(ttfbs, 95), "p99": percentile(ttfbs, 99)},
+        "rss_mb": {"start": rss[0] if rss else None, "peak": max(rss) if rss else None,
+                   "end": rss[-1] if rss else None},
+        "timeline": samples,
+    }
+
+
+def print_load_report(result: Dict):
+    """打印负载测试结果"""
+    latency, ttfb, rss = result["latency_ms"], result["ttfb_ms"], result["rss_mb"]
+    print(f"客户端 {result['clients']}  请求 {result['completed']}/{result['attempted']}  "
+          f"耗时 {result['duration_s']:.2f}s  吞吐 {result['throughput_rps']:.1f} 请求/秒  "
+          f"错误率 {result['error_rate'] * 100:.2f}%")
+    print(f"延迟ms  平均 {latency['mean']:.1f}  p50 {latency['p50']:.1f}  p95 {latency['p95']:.1f}  "
+          f"p99 {latency['p99']:.1f}  最大 {latency['max']:.1f}")
+    print(f"首条消息ms  p50 {ttfb['p50']:.1f}  p95 {ttfb['p95']:.1f}  p99 {ttfb['p99']:.1f}")
+    print("错误: " + "  ".join(f"{key} {value}" for key, value in result["errors"].items()))
+    if rss["peak"] is not None:
+        print(f"服务端RSS MB  开始 {rss['start']:.1f}  峰值 {rss['peak']:.1f}  结束 {rss['end']:.1f}")
+        print(f"{'时间s':>8}{'RSS MB':>10}{'已完成':>8}")
+        timeline = result["timeline"]
+        step = max(1, len(timeline) // 20)
+        for sample in timeline[::step]:
+            if sample["rss_mb"] is not None:
+                print(f"{sample['t']:>8.1f}{sample['rss_mb']:>10.1f}{sample['completed']:>8}")
+
+
+# 本地意图路由语料：(输入, 期望意图, 大模型会调用的工具, 参数)；期望意图为None表示应交给大模型
+ROUTER_CORPUS = [
+    ("现在几点了", "time", "get_current_time", {}),
+    ("几点了？", "time", "get_current_time", {}),
+    ("what time is it?", "time", "get_current_time", {}),
+    ("帮我看一下内存使用情况", "memory", "get_memory_info", {}),
+    ("CPU使用率多少", "cpu", "get_cpu_info", {}),
+    ("磁盘空间还剩多少", "disk", "get_disk_usage", {}),
+    ("系统信息", "system", "get_system_info", {}),
+    ("当前目录是哪里", "cwd", "get_current_directory", {}),
+    ("当前目录有什么", "list_directory", "list_directory", {"directory_path": "."}),
+    ("看看桌面上有什么", "desktop", "list_directory", {"directory_path": "~/Desktop"}),
+    ("我的IP地址是多少", "ip", "get_ip_address", {}),
+    ("算一下12*34", "calculate", "calculate", {"expression": "12*34"}),
+    ("(3+4)×5等于多少", "calculate", "calculate", {"expression": "(3+4)*5"}),
+    ("12*34是多少", "calculate", "calculate", {"expression": "12*34"}),
+    ("ls", "list_directory", "list_directory", {"directory_path": "."}),
+    ("你好呀", None, None, None),
+    ("讲个笑话", None, None, None),
+    ("现在几点了，顺便算一下12*34", None, None, None),
+    ("看看当前目录有什么，再检查一下README", None, None, None),
+    ("帮我写一首关于时间的诗", None, None, None),
+    ("内存泄漏怎么排查", None, None, None),
+    ("时间管理有什么技巧", None, None, None),
+    ("打开桌面上的记事本", None, None, None),
+    ("查一下北京的时间", None, None, None),
+    ("今天天气怎么样", None, None, None),
+    ("2024-10-18是星期几", None, None, None),
+    ("今天是2024-10-18", None, None, None),
+    ("138-1234-5678", None, None, None),
+    ("1+1", None, None, None),
+    ("What time is it in NY", None, None, None),
+    ("纽约现在几点了", None, None, None),
+    ("删桌面文件", None, None, None),
+    ("打开当前目录", None, None, None),
+    ("移动桌面上的文件", None, None, None),
+    ("dirt", None, None, None),
+    ("program", None, None, None),
+]
+
+
+def run_router_benchmark(xiaoli, turns: int, upstream_delay: float, stream: bool = True,
+                         quiet: bool = True) -> Dict:
+    """统计意图路由的命中率、准确率和匹配耗时，并与走大模型的同一请求比较端到端耗时"""
+    router = xiaoli.IntentRouter()
+    rows = []
+    for text, expected, _, _ in ROUTER_CORPUS:
+        started = time.perf_counter()
+        for _ in range(turns):
+            route = router.match(text)
+        match_us = (time.perf_counter() - started) / turns * 1e6
+        rows.append({"input": text, "expected": expected, "intent": route and route["intent"],
+                     "match_us": match_us})
+    trivial = [r for r in rows if r["expected"]]
+    other = [r for r in rows if not r["expected"]]
+
+    # 同一请求分别走大模型（调用工具再回复）和本地路由
+    scenarios = {}
+    for index, (text, expected, tool, arguments) in enumerate(ROUTER_CORPUS):
+        if expected:
+            scenarios[f"route{index}"] = {"input": text, "replies": [
+                _tools((tool, arguments), delay=upstream_delay), _final("好啦喵~", delay=upstream_delay)]}
+    server = MockSparkServer(scenarios=scenarios, default_scenario=next(iter(scenarios))).start()
+    devnull = open(os.devnull, "w")
+    walls = {}
+    try:
+        for use_router in (False, True):
+            client = xiaoli.SparkX1Client("mock", base_url=server.url, backoff_base=0.01)
+            agent = xiaoli.XiaoLiAgent("mock", stream=stream, client=client, use_router=use_router)
+            samples = []
+            try:
+                for spec in scenarios.values():
+                    started = time.perf_counter()
+                    with contextlib.redirect_stdout(devnull) if quiet else contextlib.nullcontext(), \
+                            without_live2d(xiaoli):
+                        agent.process_user_input(spec["input"])
+                    samples.append((time.perf_counter() - started) * 1000)
+                    agent.messages = agent.messages[:1]
+            finally:
+                agent.close()
+            walls["router" if use_router else "llm"] = samples
+    finally:
+        server.stop()
+        devnull.close()
+
+    saved = [llm - routed for llm, routed in zip(walls["llm"], walls["router"])]
+    return {
+        "corpus": len(rows),
+        "hit_rate": sum(1 for r in trivial if r["intent"]) / len(trivial),
+        "accuracy": sum(1 for r in trivial if r["intent"] == r["expected"]) / len(trivial),
+        "false_positives": [r["input"] for r in other if r["intent"]],
+        "misses": [r["input"] for r in trivial if r["intent"] != r["expected"]],
+        "match_us": {"p50": percentile([r["match_us"] for r in rows], 50),
+                     "max": max(r["match_us"] for r in rows)},
+        "llm_ms": {"p50": percentile(walls["llm"], 50), "mean": sum(walls["llm"]) / len(walls["llm"])},
+        "router_ms": {"p50": percentile(walls["router"], 50), "mean": sum(walls["router"]) / len(walls["router"])},
+        "saved_ms": {"mean": sum(saved) / len(saved), "total": sum(saved)},
+        "upstream_requests_saved": 2 * len(scenarios),
+    }
+
+
+def print_router_report(result: Dict):
+    print(f"语料: {result['corpus']} 条  命中率: {result['hit_rate'] * 100:.1f}%  "
+          f"准确率: {result['accuracy'] * 100:.1f}%  误路由: {len(result['false_positives'])}")
+    for text in result["false_positives"]:
+        print(f"  误路由: {text}")
+    for text in result["misses"]:
+        print(f"  未命中: {text}")
+    print(f"匹配耗时 p50 {result['match_us']['p50']:.1f}µs  最大 {result['match_us']['max']:.1f}µs")
+    print(f"大模型路径 p50 {result['llm_ms']['p50']:.1f}ms  本地路由 p50 {result['router_ms']['p50']:.1f}ms")
+    print(f"每次命中节省 {result['saved_ms']['mean']:.1f}ms，合计 {result['saved_ms']['total']:.1f}ms，"
+          f"少发 {result['upstream_requests_saved']} 次上游请求")
+
+
+INDEX_WORDS = ("def class return import self value result path file index search thread lock data "
+               "小狸 搜索 文件 目录 缓存 会话 工具 结果 时间 内存").split()
+
+
+def make_corpus_tree(root: str, files: int, seed: int = 0) -> List[str]:
+    """生成合成的文本目录树（每个目录100个文件，约2KB一个），返回埋入的稀有词"""
+    import random
+    rng = random.Random(seed)
+    rare = [f"needle{i:04d}" for i in range(20)]
+    for i in range(files):
+        directory = os.path.join(root, f"d{i // 100:04d}")
+        os.makedirs(directory, exist_ok=True)
+        words = [rng.choice(INDEX_WORDS) for _ in range(300)]
+        if i % 997 == 0:
+            words.append(rare[(i // 997) % len(rare)])
+        with open(os.path.join(directory, f"f{i:06d}.txt"), "w", encoding="utf-8") as f:
+            for start in range(0, len(words), 12):
+                f.write(" ".join(words[start:start + 12]) + "\n")
+    return rare
+
+
+def run_index_benchmark(xiaoli, root: str, index_dir: str, queries: List[str], touch: int = 100) -> Dict:
+    """建索引、无变化更新、部分文件变化后更新，以及有无索引时的查询耗时"""
+    index = xiaoli.TrigramIndex(os.path.join(index_dir, "bench.sqlite"), root)
+    result = {"build": index.update(), "noop_update": index.update()}
+
+    files = sorted(index.searcher.iter_files(root))[:touch]
+    for path in files:
+        with open(path, "a", encoding="utf-8") as f:
+            f.write("touched\n")
+    result["touch_update"] = index.update()
+    result["index"] = index.stats()
+
+    searcher = xiaoli.ContentSearcher()
+    result["queries"] = []
+    for term in queries:
+        started = time.perf_counter()
+        candidates = index.candidates(term)
+        lookup = time.perf_counter() - started
+        indexed = searcher.search(root, term, limit=10, paths=candidates)
+        indexed_ms = (time.perf_counter() - started) * 1000
+        started = time.perf_counter()
+        full = searcher.search(root, term, limit=10)
+        full_ms = (time.perf_counter() - started) * 1000
+        result["queries"].append({
+            "term": term, "candidates": None if candidates is None else len(candidates),
+            "found": len(indexed["results"]), "found_full": len(full["results"]),
+            "lookup_ms": lookup * 1000, "indexed_ms": indexed_ms, "full_ms": full_ms,
+        })
+    index.close()
+    return result
+
+
+def print_index_report(result: Dict):
+    for name in ("build", "noop_update", "touch_update"):
+        r = result[name]
+        print(f"{name:<14}文件 {r['files']:>7}  索引 {r['indexed']:>7}  删除 {r['removed']:>5}  {r['seconds']:>8.3f}s")
+    stats = result["index"]
+    print(f"索引: {stats['files']} 个文件, {stats['grams']} 个三元组, {stats['segments']} 段, "
+          f"{stats['bytes'] / 1024 / 1024:.1f}MB")
+    header = f"{'搜索词':<16}{'候选':>8}{'结果':>6}{'全扫描结果':>10}{'查索引ms':>10}{'索引搜索ms':>12}{'全扫描ms':>10}"
+    print(header)
+    print("-" * len(header))
+    for q in result["queries"]:
+        candidates = "-" if q["candidates"] is None else q["candidates"]
+        print(f"{q['term']:<16}{candidates:>8}{q['found']:>6}{q['found_full']:>10}"
+              f"{q['lookup_ms']:>10.1f}{q['indexed_ms']:>12.1f}{q['full_ms']:>10.1f}")
+
+
+# 回归检查：每个函数复现一个修复过的问题，失败时抛出AssertionError
+CHECKS = {}
+
+
+def check(func):
+    CHECKS[func.__name__[len("check_"):]] = func
+    return func
+
+
+@check
+def check_cache_survives_non_fs_tools(xiaoli, workdir: str):
+    """不涉及文件系统的工具不清空共享缓存，命令执行仍然清空"""
+    path = os.path.join(workdir, "a.txt")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("hello")
+    executor = xiaoli.ToolExecutor(cwd=workdir)
+    executor.execute_tool("get_file_info", {"file_path": path})
+    for name, arguments in (("python_code_interpreter", {"code": "print(1)"}),
+                            ("change_directory", {"directory_path": workdir})):
+        executor.execute_tool(name, arguments)
+        assert executor.result_cache.stats()["entries"] == 1, f"{name} 清空了结果缓存"
+    hits = executor.result_cache.stats()["hits"]
+    executor.execute_tool("get_file_info", {"file_path": path})
+    assert executor.result_cache.stats()["hits"] == hits + 1, "缓存未命中"
+    executor.execute_tool("execute_shell_command", {"command": "echo hi"})
+    assert executor.result_cache.stats()["entries"] == 0, "命令执行后缓存应被清空"
+
+
+@check
+def check_fallback_request_cancels(xiaoli, workdir: str):
+    """未安装aiohttp时，取消非流式请求会关闭响应，不再等整个响应返回"""
+    scenarios = {"slow": {"input": "慢慢说", "replies": [_final("喵" * 400, chunk_size=1, chunk_delay=0.05)]}}
+    server = MockSparkServer(scenarios=scenarios, default_scenario="slow").start()
+    client = xiaoli.SparkX1Client("mock", base_url=server.url, backoff_base=0.01)
+    client._aiohttp_session = lambda: None
+    token = xiaoli.CancelToken()
+
+    async def request():
+        xiaoli.CancelToken._current.set(token)
+        asyncio.get_running_loop().call_later(0.3, token.cancel)
+        return await client.asend_request([{"role": "user", "content": "慢慢说"}])
+
+    started = time.perf_counter()
+    try:
+        result = asyncio.run(request())
+    finally:
+        client.close()
+        server.stop()
+    elapsed = time.perf_counter() - started
+    assert "error" in result, f"取消后应返回错误: {str(result)[:80]}"
+    assert elapsed < 2, f"取消后 {elapsed:.1f}s 才返回"
+
+
+@check
+def check_journal_append_after_torn_record(xiaoli, workdir: str):
+    """日志末尾有写了一半的记录时，重新打开后的追加仍能读回"""
+    def turn(journal, number):
+        journal.append({"role": "user", "content": f"问题{number}"})
+        journal.append({"role": "assistant", "content": f"回答{number}"})
+
+    journal = xiaoli.SessionJournal(workdir, "torn")
+    turn(journal, 1)
+    journal.close()
+    with open(journal.journal_path, "ab") as f:
+        f.write(b"\x40\x00\x00\x00partial")
+    journal = xiaoli.SessionJournal(workdir, "torn")
+    turn(journal, 2)
+    journal.close()
+    journal = xiaoli.SessionJournal(workdir, "torn")
+    assert journal.turns == 2, f"轮次为 {journal.turns}"
+    assert [m["content"] for m in journal.load()] == ["问题1", "回答1", "问题2", "回答2"], journal.load()
+
+    # reset记录本身写了一半：它的索引项也要删掉，之后的追加接在完整的历史后面
+    journal.reset([{"role": "user", "content": "新的开始"}])
+    journal.close()
+    with open(journal.journal_path, "r+b") as f:
+        f.truncate(os.path.getsize(journal.journal_path) - 3)
+    journal = xiaoli.SessionJournal(workdir, "torn")
+    turn(journal, 3)
+    journal.close()
+    journal = xiaoli.SessionJournal(workdir, "torn")
+    assert journal.turns == 3, f"轮次为 {journal.turns}"
+    assert [m["content"] for m in journal.load()][-2:] == ["问题3", "回答3"]
+    assert len(journal.load()) == 6, journal.load()
+    journal.close()
+
+
+@check
+def check_router_error_falls_back(xiaoli, workdir: str):
+    """本地路由的工具出错（读取不存在的桌面目录）时交给大模型，不把错误套进回复模板"""
+    scenarios = {"desktop": {"input": "看看桌面上有什么", "replies": [_final("桌面目录不存在喵~")]}}
+    server = MockSparkServer(scenarios=scenarios, default_scenario="desktop").start()
+    client = xiaoli.SparkX1Client("mock", base_url=server.url, backoff_base=0.01)
+    agent = xiaoli.XiaoLiAgent("mock", stream=False, client=client)
+    saved = {key: os.environ.get(key) for key in ("HOME", "USERPROFILE")}
+    os.environ["HOME"] = os.environ["USERPROFILE"] = workdir
+    devnull = open(os.devnull, "w")
+    try:
+        with contextlib.redirect_stdout(devnull), without_live2d(xiaoli):
+            reply = json.loads(agent.process_user_input("看看桌面上有什么"))
+    finally:
+        devnull.close()
+        for key, value in saved.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+        agent.close()
+        server.stop()
+    assert server.snapshot()["requests"] == 1, "没有请求大模型"
+    assert reply.get("response") == "桌面目录不存在喵~", reply
+    assert "错误" not in agent.messages[-1]["content"], agent.messages[-1]["content"]
+
+
+@check
+def check_index_sees_new_files(xiaoli, workdir: str):
+    """索引更新后在外部新建的文件和子目录，下次查询不等定期更新就能作为候选"""
+    root = os.path.join(workdir, "tree")
+    make_corpus_tree(root, 300)
+    index = xiaoli.TrigramIndex(os.path.join(workdir, "index.sqlite"), root)
+    try:
+        index.update()
+        assert index.candidates("zebra-unique") == [], "更新前不应有候选"
+        created = [os.path.join(root, "d0001", "new.txt"), os.path.join(root, "fresh", "deep", "x.txt")]
+        for path in created:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w", encoding="utf-8") as f:
+                f.write("zebra-unique\n")
+        found = index.candidates("zebra-unique")
+        assert found == sorted(created), found
+        assert index.candidates("zebra-unique", os.path.join(root, "d0002")) == []
+    finally:
+        index.close()
+
+
+def run_checks(xiaoli, names: Optional[List[str]] = None) -> List[Dict]:
+    """逐个运行回归检查，每个检查使用独立的临时目录"""
+    import tempfile
+    import shutil
+    results = []
+    for name, func in CHECKS.items():
+        if names and name not in names:
+            continue
+        workdir = tempfile.mkdtemp(prefix="xiaoli-check-")
+        started = time.perf_counter()
+        try:
+            func(xiaoli, workdir)
+            error = None
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        results.append({"name": name, "error": error, "ms": (time.perf_counter() - started) * 1000})
+    return results
+
+
+def main(argv: Optional[List[str]] = None):
+    """命令行入口"""
+    import argparse
+    parser = argparse.ArgumentParser(description="小狸离线模拟服务器与基准测试")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    mock = subparsers.add_parser("mock", help="单独运行模拟星火服务器")
+    mock.add_argument("--host", default="127.0.0.1")
+    mock.add_argument("--port", type=int, default=9999)
+    mock.add_argument("--scenario", default="chat", choices=sorted(SCENARIOS), help="未匹配输入时使用的场景")
+
+    agent = subparsers.add_parser("agent", help="智能体循环基准测试")
+    agent.add_argument("--turns", type=int, default=20, help="每个场景的轮数")
+    agent.add_argument("--scenario", action="append", choices=sorted(SCENARIOS), help="可重复指定，默认全部")
+    agent.add_argument("--no-stream", action="store_true", help="使用非流式请求")
+    agent.add_argument("--json", help="把结果写入JSON文件")
+    agent.add_argument("--verbose", action="store_true", help="显示智能体的输出")
+    agent.add_argument("--trace", help="开启分阶段计时，span写入该JSONL文件")
+    agent.add_argument("--metrics", action="store_true", help="结束后打印聚合的分阶段计时")
+
+    serve = subparsers.add_parser("serve", help="以模拟星火服务器为后端运行端口8888的AI服务")
+    serve.add_argument("--port", type=int, default=8888)
+    serve.add_argument("--mock-url", help="已运行的模拟服务器地址，默认在本进程内启动一个")
+    serve.add_argument("--max-inflight", type=int, help="上游同时请求数上限")
+    serve.add_argument("--rate", type=float, help="上游每秒请求数上限，0表示不限（默认不限）")
+    serve.add_argument("--max-queue", type=int, help="上游排队请求数上限")
+
+    load = subparsers.add_parser("load", help="并发UI客户端压测AI服务")
+    load.add_argument("--clients", type=int, default=50, help="并发客户端数")
+    load.add_argument("--messages", type=int, default=5, help="每个客户端发送的消息数")
+    load.add_argument("--interval", type=float, default=0.0, help="同一客户端两条消息之间的间隔秒数")
+    load.add_argument("--ramp", type=float, default=0.0, help="在该秒数内逐个启动客户端")
+    load.add_argument("--scenario", action="append", choices=sorted(SCENARIOS), help="可重复指定，默认全部")
+    load.add_argument("--stream", action="store_true", help="使用流式UI协议")
+    load.add_argument("--timeout", type=float, default=60.0, help="单条消息的超时秒数")
+    load.add_argument("--target", help="压测已运行的AI服务 host:port（默认启动子进程）")
+    load.add_argument("--pid", type=int, help="配合--target统计该进程的RSS")
+    load.add_argument("--max-inflight", type=int, help="子进程AI服务的上游同时请求数上限")
+    load.add_argument("--rate", type=float, help="子进程AI服务的上游每秒请求数上限，0表示不限（默认不限）")
+    load.add_argument("--max-queue", type=int, help="子进程AI服务的上游排队请求数上限")
+    load.add_argument("--json", help="把结果写入JSON文件")
+
+    router = subparsers.add_parser("router", help="本地意图路由的准确率和节省的延迟")
+    router.add_argument("--turns", type=int, default=1000, help="每条语料的匹配次数（用于计时）")
+    router.add_argument("--upstream-delay", type=float, default=0.3, help="模拟大模型每次回复的延迟秒数")
+    router.add_argument("--no-stream", action="store_true", help="使用非流式请求")
+    router.add_argument("--verbose", action="store_true", help="显示智能体的输出")
+    router.add_argument("--json", help="把结果写入JSON文件")
+
+    index = subparsers.add_parser("index", help="内容搜索索引的建立、增量更新和查询基准测试")
+    index.add_argument("--root", help="要索引的目录，默认生成合成目录树")
+    index.add_argument("--files", type=int, default=20000, help="合成目录树的文件数")
+    index.add_argument("--query", action="append", help="搜索词，可重复指定")
+    index.add_argument("--touch", type=int, default=100, help="修改多少个文件后测量增量更新")
+    index.add_argument("--json", help="把结果写入JSON文件")
+
+    checks = subparsers.add_parser("check", help="运行回归检查")
+    checks.add_argument("--name", action="append", choices=sorted(CHECKS), help="可重复指定，默认全部")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "check":
+        results = run_checks(load_xiaoli(), args.name)
+        for result in results:
+            status = "通过" if result["error"] is None else f"失败 {result['error']}"
+            print(f"{result['name']:<40}{result['ms']:>8.1f}ms  {status}")
+        failed = sum(1 for result in results if result["error"])
+        print(f"共 {len(results)} 项，失败 {failed} 项")
+        sys.exit(1 if failed else 0)
+
+    if args.command == "serve":
+        run_ai_server(args.port, args.mock_url, args.max_inflight, args.rate, args.max_queue)
+        return
+
+    if args.command == "load":
+        inputs = [SCENARIOS[name]["input"] for name in (args.scenario or list(SCENARIOS))]
+        mock = MockSparkServer().start()
+        process = None
+        try:
+            if args.target:
+                host, _, port = args.target.rpartition(":")
+                port, pid = int(port), args.pid
+            else:
+                server_args = []
+                for flag, value in (("--max-inflight", args.max_inflight), ("--rate", args.rate),
+                                    ("--max-queue", args.max_queue)):
+                    if value is not None:
+                        server_args += [flag, str(value)]
+                process, port = spawn_ai_server(mock.url, server_args)
+                host, pid = "127.0.0.1", process.pid
+            result = run_load_test(host, port, args.clients, args.messages, inputs, interval=args.interval,
+                                   ramp=args.ramp, stream=args.stream, timeout=args.timeout, pid=pid)
+            result["upstream_requests"] = mock.snapshot()["requests"]
+        finally:
+            if process is not None:
+                process.terminate()
+                process.wait()
+            mock.stop()
+        print_load_report(result)
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump(result, f, ensure_ascii=False, indent=2)
+        return
+
+    if args.command == "router":
+        result = run_router_benchmark(load_xiaoli(), args.turns, args.upstream_delay, stream=not args.no_stream,
+                                      quiet=not args.verbose)
+        print_router_report(result)
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump(result, f, ensure_ascii=False, indent=2)
+        return
+
+    if args.command == "index":
+        import tempfile
+        import shutil
+        workdir = tempfile.mkdtemp(prefix="xiaoli-index-bench-")
+        try:
+            root = args.root
+            queries = args.query
+            if root is None:
+                root = os.path.join(workdir, "tree")
+                rare = make_corpus_tree(root, args.files)
+                queries = queries or [rare[0], "小狸 搜索", "return value", "definitely-missing"]
+            # --root指定真实目录时不修改其中的文件
+            result = run_index_benchmark(load_xiaoli(), root, workdir, queries or ["import"],
+                                         touch=args.touch if args.root is None else 0)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        print_index_report(result)
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump(result, f, ensure_ascii=False, indent=2)
+        return
+
+    if args.command == "mock":
+        server = MockSparkServer(host=args.host, port=args.port, default_scenario=args.scenario)
+        print(f"模拟星火服务器已启动: {server.url}")
+        try:
+            server.httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.httpd.server_close()
+        return
+
+    if args.command == "agent":
+        xiaoli = load_xiaoli()
+        if args.trace or args.metrics:
+            xiaoli.tracer.configure(args.trace)
+        server = MockSparkServer().start()
+        try:
+            results = run_agent_benchmark(xiaoli, server, args.scenario or list(SCENARIOS), args.turns,
+                                          stream=not args.no_stream, quiet=not args.verbose)
+        finally:
+            server.stop()
+        print_agent_report(results)
+        if args.metrics:
+            print("")
+            print(xiaoli.tracer.prometheus_text(), end="")
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,49 +1,2359 @@
 import os
 import json
+import asyncio
+import weakref
+import contextlib
 import requests
 import subprocess
 import time
 import threading
-from typing import Dict, List, Optional, Union
+from typing import AsyncIterator, Callable, Dict, Iterator, List, Optional, Tuple, Union
 import sys
 import webbrowser
 import urllib.parse
 import socket
+import signal
 import platform
 import psutil
 import datetime
 import shutil
+import stat
 import base64
+import random
+import re
+import fnmatch
+import tempfile
+import inspect
+import hashlib
+import zlib
+import struct
+import mmap
+import codecs
+import bisect
+import atexit
+import contextvars
+import uuid
+import sqlite3
+from array import array
+from collections import OrderedDict, deque
+import email.utils
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from requests.adapters import HTTPAdapter
 from cryptography.fernet import Fernet
 
 # 移除所有Unicode字符以避免编码问题
 
+class _NoopSpan:
+    """追踪关闭时使用的空span，几乎没有开销"""
+    __slots__ = ()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        return False
+    
+    def set(self, **attrs):
+        pass
+    
+    def finish(self, **attrs):
+        pass
+
+
+class _Span:
+    """一次计时区间"""
+    __slots__ = ("tracer", "name", "attrs", "span_id", "parent_id", "started", "wall_started", "_token")
+    
+    def __init__(self, tracer: "Tracer", name: str, attrs: Dict):
+        self.tracer = tracer
+        self.name = name
+        self.attrs = attrs
+        self.span_id = tracer._next_id()
+        parent = Tracer._current.get()
+        self.parent_id = parent.span_id if parent is not None else None
+        self.wall_started = time.time()
+        self.started = time.perf_counter()
+        self._token = None
+    
+    def __enter__(self):
+        self._token = Tracer._current.set(self)
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.attrs["error"] = exc_type.__name__
+        self.finish()
+        return False
+    
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+    
+    def finish(self, **attrs):
+        if self.started is None:
+            return
+        duration = time.perf_counter() - self.started
+        self.started = None
+        self.attrs.update(attrs)
+        if self._token is not None:
+            try:
+                Tracer._current.reset(self._token)
+            except ValueError:
+                # 在其他上下文中结束（例如跨任务），无需恢复
+                pass
+        self.tracer._record(self, duration)
+
+
+class Tracer:
+    """智能体循环的分阶段计时：span写入JSONL，并聚合为Prometheus文本格式
+    
+    默认关闭，关闭时span()返回共享的空对象。
+    """
+    
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+    _current = contextvars.ContextVar("xiaoli_span", default=None)
+    _NOOP = _NoopSpan()
+    
+    def __init__(self):
+        self.enabled = False
+        self._file = None
+        self._lock = threading.Lock()
+        self._ids = 0
+        self._aggregates = {}  # (name, label) -> [count, sum, max, bucket_counts]
+    
+    def configure(self, jsonl_path: Optional[str] = None, enabled: bool = True):
+        """开启追踪；jsonl_path为None时只做内存聚合"""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            if jsonl_path:
+                self._file = open(jsonl_path, 'a', encoding='utf-8')
+            self.enabled = enabled
+    
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+    
+    def span(self, name: str, **attrs):
+        """创建span，可作为上下文管理器使用，或手动调用finish()"""
+        if not self.enabled:
+            return self._NOOP
+        return _Span(self, name, attrs)
+    
+    def observe(self, name: str, seconds: float, **attrs):
+        """记录一个已知耗时的测量值（例如首字节时间）"""
+        if not self.enabled:
+            return
+        span = _Span(self, name, attrs)
+        span.started = None
+        self._record(span, seconds)
+    
+    def _next_id(self) -> int:
+        with self._lock:
+            self._ids += 1
+            return self._ids
+    
+    def _record(self, span: _Span, duration: float):
+        label = span.attrs.get("tool", "")
+        with self._lock:
+            aggregate = self._aggregates.get((span.name, label))
+            if aggregate is None:
+                aggregate = self._aggregates[(span.name, label)] = [0, 0.0, 0.0, [0] * len(self.BUCKETS)]
+            aggregate[0] += 1
+            aggregate[1] += duration
+            aggregate[2] = max(aggregate[2], duration)
+            for index, bound in enumerate(self.BUCKETS):
+                if duration <= bound:
+                    aggregate[3][index] += 1
+            
+            if self._file is not None:
+                self._file.write(json.dumps({
+                    "ts": round(span.wall_started, 6),
+                    "span": span.name,
+                    "id": span.span_id,
+                    "parent": span.parent_id,
+                    "ms": round(duration * 1000, 3),
+                    **span.attrs,
+                }, ensure_ascii=False, default=str) + "\n")
+    
+    def prometheus_text(self) -> str:
+        """导出聚合结果（Prometheus文本格式）"""
+        lines = [
+            "# HELP xiaoli_span_seconds 智能体循环各阶段耗时",
+            "# TYPE xiaoli_span_seconds histogram",
+        ]
+        with self._lock:
+            items = sorted(self._aggregates.items())
+        for (name, label), (count, total, _, buckets) in items:
+            labels = f'span="{name}"' + (f',tool="{label}"' if label else "")
+            for bound, bucket in zip(self.BUCKETS, buckets):
+                lines.append(f'xiaoli_span_seconds_bucket{{{labels},le="{bound}"}} {bucket}')
+            lines.append(f'xiaoli_span_seconds_bucket{{{labels},le="+Inf"}} {count}')
+            lines.append(f"xiaoli_span_seconds_sum{{{labels}}} {total:.6f}")
+            lines.append(f"xiaoli_span_seconds_count{{{labels}}} {count}")
+        lines.append("# HELP xiaoli_span_seconds_max 各阶段最长耗时")
+        lines.append("# TYPE xiaoli_span_seconds_max gauge")
+        for (name, label), (_, _, longest, _) in items:
+            labels = f'span="{name}"' + (f',tool="{label}"' if label else "")
+            lines.append(f"xiaoli_span_seconds_max{{{labels}}} {longest:.6f}")
+        return "\n".join(lines) + "\n"
+
+
+# 全局追踪器：设置环境变量 XIAOLI_TRACE=文件路径 或使用 --trace 参数开启
+tracer = Tracer()
+if os.environ.get("XIAOLI_TRACE"):
+    tracer.configure(os.environ["XIAOLI_TRACE"])
+atexit.register(tracer.close)
+
+
+class TurnCancelledError(Exception):
+    """当前对话已被取消"""
+
+
+class CancelToken:
+    """一轮对话的取消令牌，可在任意线程触发
+    
+    取消时依次调用注册的回调（中断HTTP请求、结束子进程等）。当前令牌通过contextvar传递，
+    线程池中的工具和同步HTTP请求用current_cancel_token()获取。
+    """
+    
+    _current = contextvars.ContextVar("xiaoli_cancel_token", default=None)
+    
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = {}
+        self._next_handle = 0
+        self.reason = None
+    
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+    
+    def cancel(self, reason: str = "已取消"):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.reason = reason
+            self._event.set()
+            callbacks = list(self._callbacks.values())
+            self._callbacks.clear()
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                pass
+    
+    def register(self, callback: Callable[[], None]) -> Optional[int]:
+        """注册取消回调；已取消时立即调用。返回用于unregister的句柄"""
+        with self._lock:
+            if not self._event.is_set():
+                self._next_handle += 1
+                self._callbacks[self._next_handle] = callback
+                return self._next_handle
+        callback()
+        return None
+    
+    def unregister(self, handle: Optional[int]):
+        if handle is not None:
+            with self._lock:
+                self._callbacks.pop(handle, None)
+    
+    @contextlib.contextmanager
+    def on_cancel(self, callback: Callable[[], None]):
+        """在with块内注册取消回调"""
+        handle = self.register(callback)
+        try:
+            yield
+        finally:
+            self.unregister(handle)
+    
+    def raise_if_cancelled(self):
+        if self._event.is_set():
+            raise TurnCancelledError(self.reason)
+    
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """等待至多timeout秒，期间被取消则返回True"""
+        return self._event.wait(timeout)
+
+
+def current_cancel_token() -> CancelToken:
+    """当前对话的取消令牌；不在对话中时返回一个永不取消的令牌"""
+    return CancelToken._current.get() or _NEVER_CANCELLED
+
+
+_NEVER_CANCELLED = CancelToken()
+
+
+class ResponseCache:
+    """磁盘上的大模型响应缓存（按总大小做LRU淘汰）
+    
+    mode:
+    - readwrite：命中则直接返回，未命中时请求网络并记录
+    - record：总是请求网络，并记录结果
+    - replay：只从缓存回放，未命中时报错，完全不访问网络
+    """
+    
+    MODES = ("readwrite", "record", "replay")
+    
+    def __init__(self, directory: str, mode: str = "readwrite", max_bytes: int = 64 * 1024 * 1024):
+        if mode not in self.MODES:
+            raise ValueError(f"未知的缓存模式: {mode}")
+        self.directory = os.path.abspath(os.path.expanduser(directory))
+        self.mode = mode
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._total_bytes = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    @staticmethod
+    def key(payload: Dict) -> str:
+        """由消息列表和请求参数计算稳定的哈希（与是否流式无关）"""
+        material = {k: v for k, v in payload.items() if k != "stream"}
+        encoded = json.dumps(material, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+        return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+    
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".json")
+    
+    def get(self, payload: Dict) -> Optional[Dict]:
+        """查找缓存；replay模式下未命中返回错误结构，其余模式返回None"""
+        if self.mode == "record":
+            return None
+        path = self._path(self.key(payload))
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            # 更新访问时间，作为LRU依据
+            os.utime(path, None)
+        except (OSError, json.JSONDecodeError):
+            with self._lock:
+                self.misses += 1
+            if self.mode == "replay":
+                return {"error": "回放模式下缓存未命中"}
+            return None
+        with self._lock:
+            self.hits += 1
+        return data
+    
+    def put(self, payload: Dict, response: Dict):
+        """记录一次成功的响应"""
+        if self.mode == "replay" or not response.get("choices"):
+            return
+        path = self._path(self.key(payload))
+        data = json.dumps(response, ensure_ascii=False).encode('utf-8')
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            # 覆盖已有条目时只计入大小的差值
+            replaced = os.path.getsize(path)
+        except OSError:
+            replaced = 0
+        try:
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        except OSError:
+            return
+        with self._lock:
+            if self._total_bytes is not None:
+                self._total_bytes += len(data) - replaced
+        self._evict()
+    
+    def _evict(self):
+        """总大小超出上限时按访问时间淘汰最旧的条目"""
+        with self._lock:
+            if self._total_bytes is not None and self._total_bytes <= self.max_bytes:
+                return
+            entries = []
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith(".json"):
+                    try:
+                        st = entry.stat()
+                    except OSError:
+                        continue
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+                self.evictions += 1
+            self._total_bytes = total
+    
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"mode": self.mode, "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
 class SparkX1Client:
-    def __init__(self, api_password: str):
+    # 需要重试的HTTP状态码
+    RETRY_STATUS = frozenset({429, 500, 502, 503, 504})
+    
+    def __init__(self, api_password: str, pool_size: int = 10, max_retries: int = 3,
+                 backoff_base: float = 0.5, backoff_max: float = 8.0, timeout: float = 30,
+                 response_cache: Optional[ResponseCache] = None, base_url: Optional[str] = None):
         self.api_password = api_password
-        self.base_url = "https://spark-api-open.xf-yun.com/v2/chat/completions"
+        self.response_cache = response_cache
+        self.base_url = base_url or "https://spark-api-open.xf-yun.com/v2/chat/completions"
         self.headers = {
             "Authorization": f"Bearer {api_password}",
             "Content-Type": "application/json"
         }
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.pool_size = pool_size
+        
+        # 连接池会话：多次迭代复用同一个TLS连接
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        self._adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("https://", self._adapter)
+        self.session.mount("http://", self._adapter)
+        
+        self._stats_lock = threading.Lock()
+        self._stats = {"requests": 0, "retries": 0, "failures": 0, "aio_new": 0, "aio_reused": 0}
+        # 每个事件循环各自的aiohttp会话
+        self._aio_sessions = weakref.WeakKeyDictionary()
+    
+    def _post(self, payload: Dict, stream: bool = False) -> requests.Response:
+        """带重试的POST请求：连接错误、429和5xx按抖动退避重试，并遵守Retry-After"""
+        body = self.encode_payload(payload)
+        attempt = 0
+        while True:
+            with self._stats_lock:
+                self._stats["requests"] += 1
+            try:
+                response = self.session.post(self.base_url, data=body, stream=stream, timeout=self.timeout)
+            except requests.exceptions.ConnectionError:
+                if attempt >= self.max_retries:
+                    self._count("failures")
+                    raise
+                delay = self._backoff_delay(attempt)
+            else:
+                if response.status_code not in self.RETRY_STATUS or attempt >= self.max_retries:
+                    if response.status_code >= 400:
+                        self._count("failures")
+                    response.raise_for_status()
+                    return response
+                delay = self._retry_after(response.headers)
+                if delay is None:
+                    delay = self._backoff_delay(attempt)
+                response.close()
+            
+            self._count("retries")
+            attempt += 1
+            if current_cancel_token().wait(delay):
+                raise requests.exceptions.ConnectionError("请求已取消")
+    
+    @staticmethod
+    def encode_payload(payload) -> bytes:
+        """编码请求体：中文直接使用UTF-8，比\\uXXXX转义小一半左右"""
+        return json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    
+    def _count(self, key: str):
+        with self._stats_lock:
+            self._stats[key] += 1
+    
+    def _backoff_delay(self, attempt: int) -> float:
+        """指数退避加全抖动"""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+    
+    def _retry_after(self, headers) -> Optional[float]:
+        """解析Retry-After头（秒数或HTTP日期）"""
+        value = headers.get("Retry-After")
+        if not value:
+            return None
+        try:
+            delay = float(value)
+        except ValueError:
+            try:
+                retry_at = email.utils.parsedate_to_datetime(value)
+                delay = (retry_at - datetime.datetime.now(retry_at.tzinfo)).total_seconds()
+            except (TypeError, ValueError):
+                return None
+        # 加少量抖动，避免所有会话同时重试
+        return max(0.0, min(delay, 60.0)) + random.uniform(0, self.backoff_base)
+    
+    def connection_stats(self) -> Dict:
+        """连接复用统计"""
+        new_connections = 0
+        pooled_requests = 0
+        pools = self._adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            try:
+                pool = pools[key]
+            except KeyError:
+                continue
+            new_connections += pool.num_connections
+            pooled_requests += pool.num_requests
+        
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["new_connections"] = new_connections + stats.pop("aio_new")
+        stats["reused_connections"] = max(0, pooled_requests - new_connections) + stats.pop("aio_reused")
+        return stats
+    
+    def close(self):
+        """关闭连接池"""
+        self.session.close()
+    
+    async def aclose(self):
+        """关闭当前事件循环的aiohttp会话"""
+        session = self._aio_sessions.pop(asyncio.get_running_loop(), None)
+        if session is not None:
+            await session.close()
+    
+    # === 异步接口 ===
+    def _aiohttp_session(self):
+        """获取当前事件循环的aiohttp会话；未安装aiohttp时返回None"""
+        try:
+            import aiohttp
+        except ImportError:
+            return None
+        
+        loop = asyncio.get_running_loop()
+        session = self._aio_sessions.get(loop)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60)
+            trace_config = aiohttp.TraceConfig()
+            
+            async def on_new(session, context, params):
+                self._count("aio_new")
+            
+            async def on_reuse(session, context, params):
+                self._count("aio_reused")
+            
+            trace_config.on_connection_create_end.append(on_new)
+            trace_config.on_connection_reuseconn.append(on_reuse)
+            session = aiohttp.ClientSession(
+                headers=self.headers,
+                connector=connector,
+                trace_configs=[trace_config],
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=self.timeout, sock_read=self.timeout),
+            )
+            self._aio_sessions[loop] = session
+        return session
+    
+    async def _apost(self, session, payload: Dict):
+        """异步版本的带重试POST请求"""
+        import aiohttp
+        
+        body = self.encode_payload(payload)
+        attempt = 0
+        while True:
+            with self._stats_lock:
+                self._stats["requests"] += 1
+            try:
+                response = await session.post(self.base_url, data=body)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if attempt >= self.max_retries:
+                    self._count("failures")
+                    raise
+                delay = self._backoff_delay(attempt)
+            else:
+                if response.status not in self.RETRY_STATUS or attempt >= self.max_retries:
+                    if response.status >= 400:
+                        self._count("failures")
+                        response.release()
+                    response.raise_for_status()
+                    return response
+                delay = self._retry_after(response.headers)
+                if delay is None:
+                    delay = self._backoff_delay(attempt)
+                response.release()
+            
+            self._count("retries")
+            attempt += 1
+            await asyncio.sleep(delay)
+    
+    async def asend_request(self, messages: List[Dict], stream: bool = False, **kwargs) -> Dict:
+        """异步发送请求，返回结构与send_request一致"""
+        session = self._aiohttp_session()
+        # 未安装aiohttp时非流式请求也按流式发送：同步的非流式请求在线程里阻塞到整个响应返回，
+        # 取消后仍占用线程和连接直到超时；流式响应在取消时会被关闭，线程立即结束
+        if stream or session is None:
+            content = []
+            async for delta in self.astream_request(messages, **kwargs):
+                if "error" in delta:
+                    return {"error": delta["error"]}
+                content.append(delta.get("content", ""))
+            return {"choices": [{"message": {"role": "assistant", "content": "".join(content)}}]}
+        
+        import aiohttp
+        payload = {
+            "model": "x1",
+            "messages": messages,
+            "stream": False,
+            **kwargs
+        }
+        cached = self._cache_get(payload)
+        if cached is not None:
+            return cached
+        try:
+            response = await self._apost(session, payload)
+            async with response:
+                data = await response.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            return {"error": str(e) or type(e).__name__}
+        self._cache_put(payload, data)
+        return data
+    
+    async def astream_request(self, messages: List[Dict], **kwargs) -> AsyncIterator[Dict]:
+        """异步SSE流式请求，产出的增量与stream_request一致"""
+        session = self._aiohttp_session()
+        if session is None:
+            async for delta in self._astream_in_thread(messages, **kwargs):
+                yield delta
+            return
+        
+        import aiohttp
+        payload = {
+            "model": "x1",
+            "messages": messages,
+            "stream": True,
+            **kwargs
+        }
+        cached = self._cache_get(payload)
+        if cached is not None:
+            for delta in self._cached_deltas(cached):
+                yield delta
+            return
+        try:
+            response = await self._apost(session, payload)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            yield {"error": str(e) or type(e).__name__}
+            return
+        
+        async with response:
+            try:
+                content = []
+                async for line in response.content:
+                    delta = self._parse_sse_line(line)
+                    if delta is None:
+                        continue
+                    if delta is self._SSE_DONE:
+                        break
+                    yield delta
+                    if "error" in delta:
+                        return
+                    content.append(delta["content"])
+                # 读完剩余数据，连接才能放回连接池复用
+                await response.read()
+                self._cache_put(payload, {"choices": [{"message": {"role": "assistant", "content": "".join(content)}}]})
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                yield {"error": str(e) or type(e).__name__}
+    
+    async def _astream_in_thread(self, messages: List[Dict], **kwargs) -> AsyncIterator[Dict]:
+        """未安装aiohttp时，在线程中运行同步流式请求并转发到事件循环"""
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        finished = object()
+        
+        def pump():
+            try:
+                for delta in self.stream_request(messages, **kwargs):
+                    loop.call_soon_threadsafe(queue.put_nowait, delta)
+            except Exception as e:
+                loop.call_soon_threadsafe(queue.put_nowait, {"error": str(e)})
+            finally:
+                loop.call_soon_threadsafe(queue.put_nowait, finished)
+        
+        # 复制上下文，线程中的请求才能拿到当前对话的取消令牌
+        loop.run_in_executor(None, contextvars.copy_context().run, pump)
+        while True:
+            delta = await queue.get()
+            if delta is finished:
+                return
+            yield delta
+    
+    def send_request(self, messages: List[Dict], stream: bool = False, **kwargs) -> Dict:
+        if stream:
+            # 流式模式下聚合所有增量，返回与非流式一致的结构
+            content = []
+            for delta in self.stream_request(messages, **kwargs):
+                if "error" in delta:
+                    return {"error": delta["error"]}
+                content.append(delta.get("content", ""))
+            return {"choices": [{"message": {"role": "assistant", "content": "".join(content)}}]}
+        
+        payload = {
+            "model": "x1",
+            "messages": messages,
+            "stream": False,
+            **kwargs
+        }
+        cached = self._cache_get(payload)
+        if cached is not None:
+            return cached
+        
+        try:
+            response = self._post(payload)
+            data = response.json()
+        except requests.exceptions.RequestException as e:
+            return {"error": str(e)}
+        self._cache_put(payload, data)
+        return data
+    
+    def _cache_get(self, payload: Dict) -> Optional[Dict]:
+        if self.response_cache is None:
+            return None
+        return self.response_cache.get(payload)
+    
+    def _cache_put(self, payload: Dict, data: Dict):
+        if self.response_cache is not None and isinstance(data, dict):
+            self.response_cache.put(payload, data)
+    
+    @staticmethod
+    def _cached_deltas(cached: Dict) -> List[Dict]:
+        """把缓存的完整响应转换为流式增量"""
+        if "error" in cached:
+            return [{"error": cached["error"]}]
+        message = (cached.get("choices") or [{}])[0].get("message", {})
+        return [{"content": message.get("content") or "", "reasoning": ""}]
+    
+    def stream_request(self, messages: List[Dict], **kwargs) -> Iterator[Dict]:
+        """以SSE方式发送请求，逐个产出增量 {"content": ..., "reasoning": ...}，出错时产出 {"error": ...}"""
+        payload = {
+            "model": "x1",
+            "messages": messages,
+            "stream": True,
+            **kwargs
+        }
+        cached = self._cache_get(payload)
+        if cached is not None:
+            yield from self._cached_deltas(cached)
+            return
+        
+        try:
+            response = self._post(payload, stream=True)
+        except requests.exceptions.RequestException as e:
+            yield {"error": str(e)}
+            return
+        
+        # 取消时关闭响应，正在阻塞的读取会立即返回
+        cancel_token = current_cancel_token()
+        cancel_handle = cancel_token.register(response.close)
+        try:
+            content = []
+            lines = response.iter_lines()
+            for delta in self._iter_sse_deltas(lines):
+                yield delta
+                if "error" in delta:
+                    return
+                content.append(delta["content"])
+            if cancel_token.cancelled:
+                yield {"error": "请求已取消"}
+                return
+            # 读完剩余数据，连接才能放回连接池复用
+            for _ in lines:
+                pass
+            self._cache_put(payload, {"choices": [{"message": {"role": "assistant", "content": "".join(content)}}]})
+        except (requests.exceptions.RequestException, AttributeError, ValueError) as e:
+            # 响应被关闭后继续读取可能抛出AttributeError/ValueError
+            yield {"error": "请求已取消" if cancel_token.cancelled else str(e)}
+        finally:
+            cancel_token.unregister(cancel_handle)
+            response.close()
+    
+    _SSE_DONE = {}
+    
+    @classmethod
+    def _iter_sse_deltas(cls, lines) -> Iterator[Dict]:
+        """解析SSE数据行，产出内容增量"""
+        for line in lines:
+            delta = cls._parse_sse_line(line)
+            if delta is None:
+                continue
+            if delta is cls._SSE_DONE:
+                return
+            yield delta
+            if "error" in delta:
+                return
+    
+    @classmethod
+    def _parse_sse_line(cls, line) -> Optional[Dict]:
+        """解析单行SSE数据；非数据行返回None，结束标记返回_SSE_DONE"""
+        if not line:
+            return None
+        if isinstance(line, bytes):
+            line = line.decode('utf-8', errors='replace')
+        line = line.strip()
+        if not line.startswith('data:'):
+            return None
+        data = line[5:].strip()
+        if data == '[DONE]':
+            return cls._SSE_DONE
+        try:
+            chunk = json.loads(data)
+        except json.JSONDecodeError:
+            return None
+        
+        # 星火接口出错时返回非零code
+        if chunk.get("code", 0) != 0:
+            return {"error": f"{chunk.get('code')}: {chunk.get('message', '未知错误')}"}
+        
+        choices = chunk.get("choices") or []
+        if not choices:
+            return None
+        delta = choices[0].get("delta", {})
+        return {
+            "content": delta.get("content") or "",
+            "reasoning": delta.get("reasoning_content") or "",
+        }
+
+
+class UpstreamBusyError(Exception):
+    """上游请求队列已满时抛出"""
+
+
+class UpstreamScheduler:
+    """多个会话共享的上游请求调度器（同一事件循环内使用）
+    
+    同时进行的请求数不超过max_inflight，其余请求排队；排队请求按会话轮转放行。
+    rate大于0时另外用令牌桶限速（每秒rate个，最多积累burst个）；默认不限速，
+    按账号配额设置（例如每秒5个时，每轮两次请求的对话约为每秒2.5轮）。队列过深时立即拒绝，不再等待超时。
+    """
+    
+    def __init__(self, max_inflight: int = 8, rate: float = 0.0, burst: int = 10,
+                 max_queue: int = 64, max_queue_per_session: int = 4):
+        self.max_inflight = max_inflight
+        self.rate = rate
+        self.burst = burst
+        self.max_queue = max_queue
+        self.max_queue_per_session = max_queue_per_session
+        self._queues: "OrderedDict[str, deque]" = OrderedDict()
+        self._inflight = 0
+        self._tokens = float(burst)
+        self._refilled = time.monotonic()
+        self._timer = None
+        self._loop = None
+        self._stats = {"admitted": 0, "queued": 0, "rejected": 0, "completed": 0,
+                       "throttled": 0, "wait_seconds": 0.0, "max_wait_seconds": 0.0}
+    
+    @contextlib.asynccontextmanager
+    async def slot(self, session: str = "default"):
+        """获取一个上游请求名额，退出时归还"""
+        await self._acquire(session)
+        try:
+            yield
+        finally:
+            self._release()
+    
+    @property
+    def queued(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+    
+    async def _acquire(self, session: str):
+        self._loop = asyncio.get_running_loop()
+        if self._inflight < self.max_inflight and not self._queues and self._take_token():
+            self._inflight += 1
+            self._stats["admitted"] += 1
+            return
+        
+        queued = self.queued
+        session_queued = len(self._queues.get(session, ()))
+        if queued >= self.max_queue or session_queued >= self.max_queue_per_session:
+            self._stats["rejected"] += 1
+            raise UpstreamBusyError(f"服务器繁忙：当前有 {queued} 个请求在排队，请稍后再试")
+        
+        future = self._loop.create_future()
+        started = time.monotonic()
+        self._queues.setdefault(session, deque()).append(future)
+        self._stats["queued"] += 1
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # 已经放行但等待方被取消，归还名额
+                self._release()
+            else:
+                self._discard(session, future)
+            raise
+        
+        waited = time.monotonic() - started
+        self._stats["admitted"] += 1
+        self._stats["wait_seconds"] += waited
+        self._stats["max_wait_seconds"] = max(self._stats["max_wait_seconds"], waited)
+        tracer.observe("upstream_wait", waited, session=session)
+    
+    def _discard(self, session: str, future):
+        queue = self._queues.get(session)
+        if queue is None:
+            return
+        try:
+            queue.remove(future)
+        except ValueError:
+            pass
+        if not queue:
+            del self._queues[session]
+    
+    def _release(self):
+        self._inflight -= 1
+        self._stats["completed"] += 1
+        self._dispatch()
+    
+    def _take_token(self) -> bool:
+        if self.rate <= 0:
+            return True
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+    
+    def _dispatch(self):
+        """按会话轮转放行排队的请求"""
+        while self._queues and self._inflight < self.max_inflight:
+            if not self._take_token():
+                self._stats["throttled"] += 1
+                self._schedule_refill()
+                return
+            
+            session, queue = next(iter(self._queues.items()))
+            future = queue.popleft()
+            if queue:
+                self._queues.move_to_end(session)
+            else:
+                del self._queues[session]
+            
+            if future.done():
+                # 等待方已取消，退还令牌
+                self._tokens = min(self.burst, self._tokens + 1)
+                continue
+            self._inflight += 1
+            future.set_result(None)
+    
+    def _schedule_refill(self):
+        if self._timer is not None or self._loop is None:
+            return
+        delay = max(0.001, (1 - self._tokens) / self.rate)
+        self._timer = self._loop.call_later(delay, self._on_refill)
+    
+    def _on_refill(self):
+        self._timer = None
+        self._dispatch()
+    
+    def stats(self) -> Dict:
+        """队列指标"""
+        stats = dict(self._stats)
+        stats["inflight"] = self._inflight
+        stats["waiting"] = self.queued
+        stats["waiting_sessions"] = len(self._queues)
+        stats["tokens"] = round(min(self.burst, self._tokens), 3) if self.rate > 0 else None
+        admitted = max(1, stats["admitted"])
+        stats["avg_wait_seconds"] = stats["wait_seconds"] / admitted
+        return stats
+
+
+class IncrementalJSONReader:
+    """增量JSON读取器：在响应尚未完整到达时提前解析顶层字段
+    
+    feed() 返回事件列表：
+    - ("field", (key, value))：顶层字段的值已完整
+    - ("tool_call", (index, tool_call))：tool_calls 数组中的一个元素已完整
+    - ("response_delta", text)：response 字段新到达的文本
+    - ("end", None)：顶层对象结束
+    """
+    
+    def __init__(self):
+        self.text = ""
+        self.valid = None  # None: 尚未判断; False: 不是JSON对象
+        self.fields = {}
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._string_start = 0
+        self._expect_key = False
+        self._key = None
+        self._value_start = None
+        self._element_start = None
+        self._element_index = 0
+        self._response_emitted = 0
+    
+    def feed(self, chunk: str) -> List[Tuple[str, object]]:
+        """喂入新的文本片段"""
+        events = []
+        self.text += chunk
+        text = self.text
+        
+        while self._pos < len(text):
+            i = self._pos
+            ch = text[i]
+            self._pos += 1
+            
+            if self.valid is None:
+                if ch.isspace():
+                    continue
+                self.valid = ch == '{'
+            if not self.valid:
+                return events
+            
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == '\\':
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    self._on_string_end(i, events)
+                continue
+            
+            if ch == '"':
+                self._in_string = True
+                self._string_start = i
+                if self._depth == 1 and not self._expect_key:
+                    self._value_start = i
+            elif ch in '{[':
+                self._depth += 1
+                if self._depth == 1:
+                    self._expect_key = True
+                elif self._depth == 2 and self._value_start is None:
+                    self._value_start = i
+                elif self._depth == 3 and self._key == "tool_calls" and ch == '{':
+                    self._element_start = i
+            elif ch in '}]':
+                self._depth -= 1
+                if self._depth == 2 and self._element_start is not None:
+                    self._emit_tool_call(text[self._element_start:i + 1], events)
+                    self._element_start = None
+                elif self._depth == 1:
+                    self._emit_field(text[self._value_start:i + 1], events)
+                elif self._depth == 0:
+                    self._finish_scalar(text, i, events)
+                    events.append(("end", None))
+            elif self._depth == 1:
+                if ch == ':':
+                    self._expect_key = False
+                elif ch == ',':
+                    self._finish_scalar(text, i, events)
+                    self._expect_key = True
+                elif not ch.isspace() and self._value_start is None:
+                    # 数字、true/false/null 等标量值
+                    self._value_start = i
+        
+        if self._in_string and self._depth == 1 and self._key == "response" and self._value_start is not None:
+            self._emit_response_delta(events)
+        return events
+    
+    def _on_string_end(self, end: int, events: List):
+        """字符串结束时的处理"""
+        if self._depth != 1:
+            return
+        raw = self.text[self._string_start:end + 1]
+        if self._expect_key:
+            self._key = json.loads(raw)
+            self._value_start = None
+            return
+        if self._key == "response":
+            self._emit_response_delta(events, complete=True)
+        self._emit_field(raw, events)
+    
+    def _emit_field(self, raw: str, events: List):
+        """发出顶层字段完成事件"""
+        try:
+            value = json.loads(raw)
+        except (json.JSONDecodeError, TypeError):
+            value = None
+        self.fields[self._key] = value
+        events.append(("field", (self._key, value)))
+        self._value_start = None
+    
+    def _finish_scalar(self, text: str, end: int, events: List):
+        """结束一个未加引号的标量值"""
+        if self._value_start is not None and text[self._value_start] not in '"{[':
+            self._emit_field(text[self._value_start:end].strip(), events)
+    
+    def _emit_tool_call(self, raw: str, events: List):
+        """发出单个工具调用完成事件"""
+        try:
+            events.append(("tool_call", (self._element_index, json.loads(raw))))
+        except json.JSONDecodeError:
+            pass
+        self._element_index += 1
+    
+    def _emit_response_delta(self, events: List, complete: bool = False):
+        """解码response字段已到达的部分，发出新增文本"""
+        end = self._pos - 1 if complete else self._pos
+        raw = self.text[self._value_start + 1:end]
+        decoded = None
+        # 未完整的转义序列（如 \u4f）需要等待更多数据
+        for cut in range(0, 12):
+            if cut > len(raw):
+                break
+            try:
+                decoded = json.loads('"' + raw[:len(raw) - cut] + '"')
+                break
+            except json.JSONDecodeError:
+                continue
+        # 代理对的前半部分需要等待后半部分
+        if decoded and not complete and '\ud800' <= decoded[-1] <= '\udbff':
+            decoded = decoded[:-1]
+        if decoded is None or len(decoded) <= self._response_emitted:
+            return
+        events.append(("response_delta", decoded[self._response_emitted:]))
+        self._response_emitted = len(decoded)
+
+class ToolResultSpillStore:
+    """会话级的工具结果溢出存储：超长结果写入临时文件，提示词中只保留首尾预览和句柄"""
+    
+    HANDLE_PATTERN = re.compile(r'^[a-z_]+-\d+$')
+    
+    def __init__(self, max_inline_chars: int = 4000, preview_chars: int = 800, page_bytes: int = 4000):
+        self.max_inline_chars = max_inline_chars
+        self.preview_chars = preview_chars
+        self.page_bytes = page_bytes
+        self.directory = None
+        self._counter = 0
+        self._lock = threading.Lock()
+        self._finalizer = None
+    
+    def spill(self, tool_name: str, result: str) -> str:
+        """结果过长时写入溢出文件，返回预览；否则原样返回"""
+        if not isinstance(result, str) or len(result) <= self.max_inline_chars:
+            return result
+        
+        with self._lock:
+            if self.directory is None:
+                self.directory = tempfile.mkdtemp(prefix="xiaoli-spill-")
+                self._finalizer = weakref.finalize(self, shutil.rmtree, self.directory, True)
+            self._counter += 1
+            handle = f"{re.sub(r'[^a-z_]', '_', tool_name.lower()) or 'tool'}-{self._counter}"
+        
+        data = result.encode('utf-8')
+        with open(os.path.join(self.directory, handle + ".txt"), 'wb') as f:
+            f.write(data)
+        
+        head = result[:self.preview_chars]
+        tail = result[-self.preview_chars:]
+        omitted = len(result) - len(head) - len(tail)
+        return (f"{head}\n...（结果过长：共{len(result)}个字符/{len(data)}字节，已省略中间{omitted}个字符。"
+                f"完整结果已保存为句柄 {handle}，可调用 read_tool_result 分页读取）...\n{tail}")
+    
+    def read(self, handle: str, offset: int = 0, length: int = None) -> str:
+        """按字节偏移分页读取溢出结果"""
+        if not self.HANDLE_PATTERN.match(handle or "") or self.directory is None:
+            return f"错误：无效的结果句柄 {handle}"
+        path = os.path.join(self.directory, handle + ".txt")
+        if not os.path.exists(path):
+            return f"错误：结果句柄不存在 {handle}"
+        
+        # 留出页脚的空间，避免分页结果本身再次被溢出
+        length = max(1, min(int(length or self.page_bytes), self.max_inline_chars - 200))
+        offset = max(0, int(offset))
+        total = os.path.getsize(path)
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            chunk = f.read(length + 4)
+        
+        # 对齐到UTF-8字符边界
+        start = 0
+        while start < len(chunk) and start < 4 and (chunk[start] & 0xC0) == 0x80:
+            start += 1
+        end = min(len(chunk), start + length)
+        while end < len(chunk) and (chunk[end] & 0xC0) == 0x80:
+            end -= 1
+        text = chunk[start:end].decode('utf-8', errors='replace')
+        next_offset = offset + end
+        
+        footer = f"\n[句柄 {handle}：字节 {offset + start}-{next_offset} / 共 {total}"
+        footer += f"，下一页 offset={next_offset}]" if next_offset < total else "，已读完]"
+        return text + footer
+    
+    def close(self):
+        """删除溢出文件"""
+        if self._finalizer is not None:
+            self._finalizer()
+
+
+class ToolResultCache:
+    """幂等工具的结果缓存：按工具名和标准化参数作键，支持TTL、mtime校验和按路径前缀失效"""
+    
+    def __init__(self, policies: Dict[str, Dict], max_entries: int = 256):
+        self.policies = policies
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (expires_at, paths, fingerprint, result)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+    
+    def _key(self, name: str, function: Callable, args: Dict,
+             resolve: Optional[Callable[[str], str]] = None) -> Optional[Tuple[str, List[str]]]:
+        """生成缓存键和涉及的路径；参数无法绑定时返回None
+        
+        resolve把相对路径转为绝对路径（默认相对进程工作目录），默认参数中的相对路径也会被解析，
+        不同工作目录下的同一调用不会共用缓存。
+        """
+        try:
+            bound = inspect.signature(function).bind(**args)
+        except TypeError:
+            return None
+        bound.apply_defaults()
+        resolve = resolve or (lambda path: os.path.abspath(os.path.expanduser(path)))
+        paths = []
+        for key, value in bound.arguments.items():
+            if isinstance(value, str) and ('path' in key or 'dir' in key or 'file' in key):
+                bound.arguments[key] = resolve(value)
+                paths.append(bound.arguments[key])
+        return name + ":" + json.dumps(bound.arguments, sort_keys=True, default=str), paths
+    
+    @staticmethod
+    def _fingerprint(paths: List[str]) -> Tuple:
+        """路径及其父目录的修改时间指纹"""
+        result = []
+        for path in paths:
+            for target in (path, os.path.dirname(path)):
+                try:
+                    st = os.stat(target)
+                    result.append((st.st_mtime_ns, st.st_size, st.st_ino))
+                except OSError:
+                    result.append(None)
+        return tuple(result)
+    
+    def get(self, name: str, function: Callable, args: Dict,
+            resolve: Optional[Callable[[str], str]] = None) -> Optional[str]:
+        """查找有效的缓存结果"""
+        policy = self.policies.get(name)
+        if policy is None:
+            return None
+        keyed = self._key(name, function, args, resolve)
+        if keyed is None:
+            return None
+        key, paths = keyed
+        
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, _, fingerprint, result = entry
+            if time.monotonic() < expires_at and (not policy.get("mtime") or self._fingerprint(paths) == fingerprint):
+                with self._lock:
+                    if key in self._entries:
+                        self._entries.move_to_end(key)
+                    self.hits += 1
+                return result
+            with self._lock:
+                self._entries.pop(key, None)
+        with self._lock:
+            self.misses += 1
+        return None
+    
+    def put(self, name: str, function: Callable, args: Dict, result: str,
+            resolve: Optional[Callable[[str], str]] = None):
+        """写入缓存"""
+        policy = self.policies.get(name)
+        keyed = self._key(name, function, args, resolve) if policy else None
+        if keyed is None:
+            return
+        key, paths = keyed
+        fingerprint = self._fingerprint(paths) if policy.get("mtime") else None
+        with self._lock:
+            self._entries[key] = (time.monotonic() + policy["ttl"], paths, fingerprint, result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+    
+    def invalidate(self, paths: Optional[List[str]]):
+        """使涉及给定路径（祖先或后代）的缓存失效；paths为None时清除所有与路径相关的缓存"""
+        targets = [p.rstrip(os.sep) for p in paths] if paths is not None else None
+        with self._lock:
+            for key in list(self._entries):
+                entry_paths = self._entries[key][1]
+                if not entry_paths:
+                    continue
+                if targets is None or any(
+                    a == b or a.startswith(b + os.sep) or b.startswith(a + os.sep)
+                    for a in (p.rstrip(os.sep) for p in entry_paths) for b in targets
+                ):
+                    del self._entries[key]
+                    self.invalidations += 1
+    
+    def stats(self) -> Dict:
+        """命中统计"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            }
+
+
+class FileWalker:
+    """基于os.scandir的惰性目录遍历，供文件搜索、内容搜索和压缩等工具共用
+    
+    支持 ** 递归通配、排除规则、深度限制、符号链接环检测和达到上限即停止；
+    workers大于0时用线程池并行列出子目录（结果顺序不固定）。
+    """
+    
+    # 默认不进入的目录：版本库、依赖、缓存；包含pyvenv.cfg的目录视为虚拟环境，同样跳过
+    DEFAULT_EXCLUDES = (".git", ".svn", ".hg", "node_modules", "__pycache__", ".venv", "venv", ".tox",
+                        ".mypy_cache", ".pytest_cache", "*.egg-info")
+    VENV_MARKER = "pyvenv.cfg"
+    
+    def __init__(self, excludes: Optional[Tuple[str, ...]] = DEFAULT_EXCLUDES, max_depth: Optional[int] = None,
+                 follow_symlinks: bool = False, workers: int = 0):
+        excludes = tuple(excludes or ())
+        self.excludes = excludes
+        self._exclude_names = frozenset(name for name in excludes if not any(c in name for c in "*?["))
+        self._exclude_patterns = tuple(name for name in excludes if name not in self._exclude_names)
+        self.skip_venvs = bool(excludes)
+        self.max_depth = max_depth
+        self.follow_symlinks = follow_symlinks
+        self.workers = workers
+    
+    @staticmethod
+    def compile_pattern(pattern: str) -> Tuple[bool, "re.Pattern"]:
+        """把通配模式编译为正则，返回(是否匹配相对路径, 正则)
+        
+        不含路径分隔符的模式（如*.py）匹配任意深度的文件名；否则匹配相对路径，**/可跨越零到多级目录。
+        """
+        pattern = pattern.replace("\\", "/")
+        flags = re.IGNORECASE if os.name == "nt" else 0
+        if "/" not in pattern:
+            return False, re.compile(fnmatch.translate(pattern), flags)
+        segments = pattern.strip("/").split("/")
+        parts = []
+        for index, segment in enumerate(segments):
+            last = index == len(segments) - 1
+            if segment == "**":
+                parts.append(".*" if last else "(?:[^/]+/)*")
+            else:
+                parts.append(FileWalker._translate_segment(segment) + ("" if last else "/"))
+        return True, re.compile("(?s:" + "".join(parts) + r")\Z", flags)
+    
+    @staticmethod
+    def _translate_segment(segment: str) -> str:
+        """单级目录的通配转正则：*和?不跨越目录"""
+        out = []
+        i = 0
+        while i < len(segment):
+            c = segment[i]
+            i += 1
+            if c == "*":
+                out.append("[^/]*")
+            elif c == "?":
+                out.append("[^/]")
+            elif c == "[":
+                # 紧跟在[或[!后的]是普通字符
+                start = i + 1 if segment[i:i + 1] == "!" else i
+                end = segment.find("]", start + 1)
+                if end < 0:
+                    out.append(re.escape(c))
+                    continue
+                body = segment[i:end].replace("\\", "\\\\")
+                i = end + 1
+                if body.startswith("!"):
+                    body = "^" + body[1:]
+                elif body.startswith("^"):
+                    body = "\\" + body
+                out.append("[" + body + "]")
+            else:
+                out.append(re.escape(c))
+        return "".join(out)
+    
+    def _excluded(self, name: str) -> bool:
+        return name in self._exclude_names or any(fnmatch.fnmatch(name, p) for p in self._exclude_patterns)
+    
+    def _list(self, path: str) -> List[os.DirEntry]:
+        try:
+            with os.scandir(path) as entries:
+                return list(entries)
+        except OSError:
+            return []
+    
+    def walk(self, root: str, pattern: Optional[str] = None, limit: Optional[int] = None,
+             include_dirs: bool = False, max_depth: Optional[int] = None,
+             stop: Optional[threading.Event] = None, skipped: Optional[List[str]] = None) -> Iterator[os.DirEntry]:
+        """惰性产出root下匹配pattern的DirEntry（默认只产出文件）；调用方停止迭代即停止遍历
+        
+        传入skipped列表时，因排除规则或虚拟环境而未进入的目录路径会追加到其中。
+        """
+        max_depth = self.max_depth if max_depth is None else max_depth
+        by_path, regex = self.compile_pattern(pattern) if pattern else (False, None)
+        if by_path and "**" not in pattern:
+            # 不含**的路径模式，深度由模式的层数决定
+            depth_limit = pattern.replace("\\", "/").strip("/").count("/")
+            max_depth = depth_limit if max_depth is None else min(max_depth, depth_limit)
+        root = os.path.abspath(root)
+        prefix_len = len(root.rstrip(os.sep)) + 1
+        visited = set()
+        if self.follow_symlinks:
+            try:
+                st = os.stat(root)
+                visited.add((st.st_dev, st.st_ino))
+            except OSError:
+                return
+        
+        pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="xiaoli-walk") if self.workers else None
+        pending = deque([(root, 0)])
+        running = {}
+        yielded = 0
+        try:
+            while pending or running:
+                if stop is not None and stop.is_set():
+                    return
+                if pool is None:
+                    directory, depth = pending.pop()
+                    batches = [(directory, depth, self._list(directory))]
+                else:
+                    while pending and len(running) < self.workers * 2:
+                        directory, depth = pending.popleft()
+                        running[pool.submit(self._list, directory)] = (directory, depth)
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    batches = [running.pop(future) + (future.result(),) for future in done]
+                
+                for directory, depth, entries in batches:
+                    if self.skip_venvs and depth > 0 and any(entry.name == self.VENV_MARKER for entry in entries):
+                        if skipped is not None:
+                            skipped.append(directory)
+                        continue
+                    for entry in entries:
+                        try:
+                            is_dir = entry.is_dir(follow_symlinks=self.follow_symlinks)
+                            if is_dir:
+                                if self._excluded(entry.name):
+                                    if skipped is not None:
+                                        skipped.append(entry.path)
+                                    continue
+                                if self.follow_symlinks:
+                                    st = entry.stat()
+                                    if (st.st_dev, st.st_ino) in visited:
+                                        continue
+                                    visited.add((st.st_dev, st.st_ino))
+                                if max_depth is None or depth < max_depth:
+                                    pending.append((entry.path, depth + 1))
+                                if not include_dirs:
+                                    continue
+                            elif not entry.is_file():
+                                continue
+                        except OSError:
+                            continue
+                        if regex is not None:
+                            name = entry.path[prefix_len:].replace(os.sep, "/") if by_path else entry.name
+                            if not regex.match(name):
+                                continue
+                        yield entry
+                        yielded += 1
+                        if limit is not None and yielded >= limit:
+                            return
+        finally:
+            if pool is not None:
+                for future in running:
+                    future.cancel()
+                pool.shutdown(wait=False)
+
+
+class ContentSearcher:
+    """文件内容搜索：工作线程池并行扫描，按块流式读取，跳过二进制文件，结果够数即停止
+    
+    每个文件只占用 chunk_size 加一行的内存；块中不含搜索词时不切分行，直接累加行号。
+    """
+    
+    # 可见文本中允许出现的控制字符
+    _TEXT_CONTROLS = frozenset(b"\t\n\r\f\b\x1b")
+    
+    _pool = None
+    _pool_lock = threading.Lock()
+    
+    def __init__(self, workers: int = 8, chunk_size: int = 1024 * 1024, sniff_bytes: int = 8192,
+                 max_line_bytes: int = 4 * 1024 * 1024, line_preview: int = 200,
+                 walker: Optional[FileWalker] = None):
+        self.walker = walker or FileWalker()
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.sniff_bytes = sniff_bytes
+        self.max_line_bytes = max_line_bytes
+        self.line_preview = line_preview
+    
+    @classmethod
+    def _get_pool(cls, workers: int) -> ThreadPoolExecutor:
+        # 与工具线程池分开，避免在工具线程中等待同一个池而死锁
+        with cls._pool_lock:
+            if cls._pool is None:
+                cls._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="xiaoli-search")
+            return cls._pool
     
-    def send_request(self, messages: List[Dict], stream: bool = False, **kwargs) -> Dict:
-        payload = {
-            "model": "x1",
-            "messages": messages,
-            "stream": stream,
-            **kwargs
-        }
+    def is_binary(self, head: bytes) -> bool:
+        """根据文件开头判断是否为二进制：含NUL字节，或控制字符超过三成"""
+        if not head:
+            return False
+        if b"\0" in head:
+            return True
+        controls = sum(1 for byte in head if byte < 32 and byte not in self._TEXT_CONTROLS)
+        return controls / len(head) > 0.3
+    
+    def iter_files(self, root: str, extensions: Optional[List[str]] = None,
+                   stop: Optional[threading.Event] = None) -> Iterator[str]:
+        """惰性遍历目录下的普通文件（root为文件时只产出它本身）"""
+        if os.path.isfile(root):
+            yield root
+            return
+        for entry in self.walker.walk(root, stop=stop):
+            if not extensions or entry.name.endswith(tuple(extensions)):
+                yield entry.path
+    
+    def scan_file(self, path: str, needle: str, max_lines: int = 3, stop: Optional[threading.Event] = None,
+                  sniff: bool = True) -> Optional[Dict]:
+        """扫描单个文件，返回 {"path", "matches", "lines": [(行号, 行内容)]}；二进制文件返回None
+        
+        needle需为小写，匹配不区分大小写。
+        """
+        result = {"path": path, "matches": 0, "lines": []}
+        with open(path, "rb") as f:
+            data = f.read(self.sniff_bytes)
+            if sniff and self.is_binary(data):
+                return None
+            line_no = 1
+            carry = b""
+            while data:
+                if stop is not None and stop.is_set():
+                    break
+                block = carry + data
+                cut = block.rfind(b"\n")
+                if cut < 0 and len(block) < self.max_line_bytes:
+                    carry = block
+                    data = f.read(self.chunk_size)
+                    continue
+                # 超长的单行按块强制切开
+                cut = cut if cut >= 0 else len(block) - 1
+                carry = block[cut + 1:]
+                line_no = self._scan_block(block[:cut + 1], needle, line_no, result, max_lines)
+                data = f.read(self.chunk_size)
+            if carry:
+                self._scan_block(carry, needle, line_no, result, max_lines)
+        return result
+    
+    def _scan_block(self, block: bytes, needle: str, line_no: int, result: Dict, max_lines: int) -> int:
+        """扫描若干完整的行，返回下一块的起始行号"""
+        if needle not in block.decode("utf-8", errors="ignore").lower():
+            return line_no + block.count(b"\n")
+        for offset, raw in enumerate(block.split(b"\n")):
+            line = raw.decode("utf-8", errors="ignore")
+            count = line.lower().count(needle)
+            if count:
+                result["matches"] += count
+                if len(result["lines"]) < max_lines:
+                    result["lines"].append((line_no + offset, line.strip()[:self.line_preview]))
+        return line_no + block.count(b"\n")
+    
+    def search(self, root: str, term: str, extensions: Optional[List[str]] = None, limit: int = 10,
+               max_lines: int = 3, cancel_token: Optional["CancelToken"] = None,
+               paths: Optional[List[str]] = None) -> Dict:
+        """并行搜索root下包含term的文件，找到limit个后停止；paths为索引给出的候选文件时只扫描这些文件
+        
+        返回 {"results": [...], "files": 扫描文件数, "binary": 跳过的二进制文件数, "errors": 读取失败数,
+        "truncated": 是否因达到上限提前结束}。
+        """
+        needle = term.lower()
+        stop = threading.Event()
+        handle = cancel_token.register(stop.set) if cancel_token is not None else None
+        pool = self._get_pool(self.workers)
+        summary = {"results": [], "files": 0, "binary": 0, "errors": 0, "truncated": False}
+        pending = set()
+        
+        def collect(done):
+            for future in done:
+                try:
+                    found = future.result()
+                except OSError:
+                    summary["errors"] += 1
+                    continue
+                summary["files"] += 1
+                if found is None:
+                    summary["binary"] += 1
+                elif found["matches"] and len(summary["results"]) < limit:
+                    summary["results"].append(found)
+            if len(summary["results"]) >= limit:
+                summary["truncated"] = True
+                stop.set()
         
         try:
-            response = requests.post(self.base_url, headers=self.headers, json=payload, stream=stream, timeout=30)
-            response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
-            return {"error": str(e)}
+            for path in (paths if paths is not None else self.iter_files(root, extensions, stop)):
+                # 限制在途文件数，遍历不会跑到扫描前面太远
+                if len(pending) >= self.workers * 4:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+                    if stop.is_set():
+                        break
+                pending.add(pool.submit(self.scan_file, path, needle, max_lines, stop))
+            if not stop.is_set():
+                collect(wait(pending)[0])
+                pending = set()
+        finally:
+            stop.set()
+            for future in pending:
+                future.cancel()
+            if handle is not None:
+                cancel_token.unregister(handle)
+        summary["results"].sort(key=lambda item: item["path"])
+        return summary
+
+
+class TrigramIndex:
+    """单个目录的文件内容三元组索引（SQLite），用于在搜索前缩小候选文件范围
+    
+    按文件的mtime和大小增量更新；每次更新写入一个新段（gram -> 文件id数组），段数过多时合并。
+    文件变化后换新id，旧id的倒排记录在合并前由files表过滤掉。
+    索引只缩小范围，候选文件仍要逐个扫描确认。更新时记下每个目录的mtime，查询时只stat这些目录，
+    mtime变化的目录（其中有文件新增、删除或被替换）重新列出并与索引比较，变化的文件也作为候选；
+    原地修改不改变目录mtime，由SearchIndexStore的定期更新和工具修改后的失效处理。
+    搜索词的候选超过max_candidate_ratio比例的文件时不使用索引，直接扫描（找够结果即停止）更快。
+    """
+    
+    # 文件状态：已索引 / 二进制（搜索时跳过） / 过大未索引（总是作为候选）
+    INDEXED, BINARY, UNINDEXED = 0, 1, 2
+    
+    def __init__(self, db_path: str, root: str, searcher: Optional[ContentSearcher] = None,
+                 max_file_bytes: int = 1024 * 1024, segment_files: int = 5000, max_segments: int = 8,
+                 max_candidate_ratio: float = 0.2):
+        self.root = os.path.abspath(root)
+        self.db_path = db_path
+        self.searcher = searcher or ContentSearcher()
+        self.max_file_bytes = max_file_bytes
+        self.segment_files = segment_files
+        self.max_segments = max_segments
+        self.max_candidate_ratio = max_candidate_ratio
+        self.last_update = 0.0
+        # 上次更新时各目录的mtime（只在内存中，进程启动后的首次更新时建立）
+        self._dirs: Dict[str, int] = {}
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.executescript("""
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=NORMAL;
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS files (id INTEGER PRIMARY KEY AUTOINCREMENT, path TEXT UNIQUE NOT NULL,
+                                              mtime_ns INTEGER, size INTEGER, state INTEGER);
+            CREATE TABLE IF NOT EXISTS postings (gram BLOB, segment INTEGER, ids BLOB,
+                                                 PRIMARY KEY (gram, segment)) WITHOUT ROWID;
+        """)
+        stored = self._db.execute("SELECT value FROM meta WHERE key = 'root'").fetchone()
+        if stored is None:
+            with self._db:
+                self._db.execute("INSERT INTO meta VALUES ('root', ?)", (self.root,))
+        elif stored[0] != self.root:
+            raise ValueError(f"索引 {db_path} 属于另一个目录: {stored[0]}")
+    
+    def grams(self, data: bytes) -> set:
+        """小写化后的UTF-8字节三元组（与ContentSearcher的匹配方式一致）"""
+        data = data.decode("utf-8", errors="ignore").lower().encode("utf-8")
+        return {data[i:i + 3] for i in range(len(data) - 2)}
+    
+    def update(self) -> Dict:
+        """扫描目录，只重新索引新增或mtime/大小变化的文件"""
+        started = time.perf_counter()
+        with self._lock:
+            known = {path: (file_id, mtime_ns, size)
+                     for file_id, path, mtime_ns, size in self._db.execute("SELECT id, path, mtime_ns, size FROM files")}
+            changed = []
+            seen = set()
+            dirs = {}
+            try:
+                dirs[self.root] = os.stat(self.root).st_mtime_ns
+            except OSError:
+                pass
+            walker = self.searcher.walker
+            # 目录在列出其内容之前stat，之后的变化都会体现在mtime上
+            for entry in walker.walk(self.root, include_dirs=True):
+                try:
+                    st = entry.stat()
+                    if entry.is_dir(follow_symlinks=walker.follow_symlinks):
+                        dirs[entry.path] = st.st_mtime_ns
+                        continue
+                except OSError:
+                    continue
+                path = entry.path
+                seen.add(path)
+                row = known.get(path)
+                if row is None or row[1] != st.st_mtime_ns or row[2] != st.st_size:
+                    changed.append((path, st))
+            removed = [(known[path][0],) for path in known if path not in seen]
+            stale = removed + [(known[path][0],) for path, _ in changed if path in known]
+            with self._db:
+                self._db.executemany("DELETE FROM files WHERE id = ?", stale)
+                self._record_dead(len(stale))
+            
+            for start in range(0, len(changed), self.segment_files):
+                self._write_segment(changed[start:start + self.segment_files])
+            if self._segment_count() > self.max_segments:
+                self.compact()
+            self._dirs = dirs
+            self.last_update = time.time()
+        return {"files": len(seen), "indexed": len(changed), "removed": len(removed),
+                "seconds": round(time.perf_counter() - started, 3)}
+    
+    def _record_dead(self, count: int):
+        if count:
+            self._db.execute("INSERT INTO meta VALUES ('dead', ?) ON CONFLICT(key) DO UPDATE "
+                             "SET value = CAST(value AS INTEGER) + ?", (count, count))
+    
+    def _segment_count(self) -> int:
+        return self._db.execute("SELECT COUNT(DISTINCT segment) FROM postings").fetchone()[0]
+    
+    def _write_segment(self, files: List[Tuple[str, os.stat_result]]):
+        segment = (self._db.execute("SELECT MAX(segment) FROM postings").fetchone()[0] or 0) + 1
+        postings: Dict[bytes, array] = {}
+        with self._db:
+            for path, st in files:
+                grams, state = None, self.UNINDEXED
+                if st.st_size <= self.max_file_bytes:
+                    try:
+                        with open(path, "rb") as f:
+                            data = f.read(self.max_file_bytes + 1)
+                    except OSError:
+                        continue
+                    if self.searcher.is_binary(data[:self.searcher.sniff_bytes]):
+                        state = self.BINARY
+                    elif len(data) <= self.max_file_bytes:
+                        grams, state = self.grams(data), self.INDEXED
+                file_id = self._db.execute(
+                    "INSERT INTO files (path, mtime_ns, size, state) VALUES (?, ?, ?, ?)",
+                    (path, st.st_mtime_ns, st.st_size, state)).lastrowid
+                for gram in grams or ():
+                    ids = postings.get(gram)
+                    if ids is None:
+                        ids = postings[gram] = array("I")
+                    ids.append(file_id)
+            self._db.executemany("INSERT INTO postings VALUES (?, ?, ?)",
+                                 ((gram, segment, ids.tobytes()) for gram, ids in postings.items()))
+    
+    def compact(self):
+        """把所有段合并为一个，并去掉已删除文件的id"""
+        with self._lock, self._db:
+            dead = int((self._db.execute("SELECT value FROM meta WHERE key = 'dead'").fetchone() or (0,))[0])
+            live = {row[0] for row in self._db.execute("SELECT id FROM files")} if dead else None
+            merged = []
+            current, ids = None, array("I")
+            for gram, blob in self._db.execute("SELECT gram, ids FROM postings ORDER BY gram, segment"):
+                if gram != current:
+                    if current is not None:
+                        merged.append((current, ids))
+                    current, ids = gram, array("I")
+                ids.frombytes(blob)
+            if current is not None:
+                merged.append((current, ids))
+            self._db.execute("DELETE FROM postings")
+            for gram, ids in merged:
+                if live is not None:
+                    ids = array("I", (file_id for file_id in ids if file_id in live))
+                if ids:
+                    self._db.execute("INSERT INTO postings VALUES (?, 1, ?)", (gram, ids.tobytes()))
+            self._db.execute("DELETE FROM meta WHERE key = 'dead'")
+        with self._lock:
+            self._db.execute("VACUUM")
+            self._db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    
+    def _lookup(self, gram: bytes) -> set:
+        ids = array("I")
+        for (blob,) in self._db.execute("SELECT ids FROM postings WHERE gram = ?", (gram,)):
+            ids.frombytes(blob)
+        return set(ids)
+    
+    def candidates(self, term: str, within: Optional[str] = None,
+                   extensions: Optional[List[str]] = None) -> Optional[List[str]]:
+        """可能包含term的文件路径；搜索词不足三个字节、候选过多或索引不覆盖within时返回None"""
+        grams = self.grams(term.encode("utf-8"))
+        if not grams:
+            return None
+        within = os.path.abspath(within or self.root)
+        prefix = within.rstrip(os.sep) + os.sep
+        if os.path.isdir(within) and within not in self._dirs:
+            return None  # 尚未建立，或位于被排除的目录中
+        with self._lock:
+            found = None
+            # 先取最短的倒排表，交集很快变小
+            for gram in sorted(grams, key=lambda g: self._db.execute(
+                    "SELECT COALESCE(SUM(LENGTH(ids)), 0) FROM postings WHERE gram = ?", (g,)).fetchone()[0]):
+                ids = self._lookup(gram)
+                found = ids if found is None else found & ids
+                if not found:
+                    break
+            found = list(found or ())
+            total = self._db.execute("SELECT COUNT(*) FROM files WHERE state = ?", (self.INDEXED,)).fetchone()[0]
+            if found and len(found) > self.max_candidate_ratio * total:
+                return None
+            paths = [row[0] for row in self._db.execute("SELECT path FROM files WHERE state = ?", (self.UNINDEXED,))]
+            for start in range(0, len(found), 500):
+                chunk = found[start:start + 500]
+                paths.extend(row[0] for row in self._db.execute(
+                    f"SELECT path FROM files WHERE state = {self.INDEXED} AND id IN ({','.join('?' * len(chunk))})",
+                    chunk))
+        paths.extend(self.changed(within, extensions))
+        return sorted({path for path in paths
+                       if (path == within or path.startswith(prefix))
+                       and (not extensions or path.endswith(tuple(extensions)))})
+    
+    def changed(self, within: Optional[str] = None, extensions: Optional[List[str]] = None) -> List[str]:
+        """within下上次更新后新增或被替换的文件：只重新列出mtime变化了的目录"""
+        within = os.path.abspath(within or self.root)
+        prefix = within.rstrip(os.sep) + os.sep
+        walker = self.searcher.walker
+        dirs = self._dirs
+        listed = []
+        if os.path.isfile(within):
+            listed.append(within)
+        for directory, mtime_ns in dirs.items():
+            if directory != within and not directory.startswith(prefix):
+                continue
+            try:
+                if os.stat(directory).st_mtime_ns == mtime_ns:
+                    continue
+            except OSError:
+                continue  # 目录已删除，其中的候选文件扫描时会被跳过
+            for entry in walker.walk(directory, include_dirs=True, max_depth=0):
+                try:
+                    is_dir = entry.is_dir(follow_symlinks=walker.follow_symlinks)
+                except OSError:
+                    continue
+                if not is_dir:
+                    listed.append(entry.path)
+                elif entry.path not in dirs:
+                    # 新建的子目录，其中的文件都不在索引中
+                    listed.extend(sub.path for sub in walker.walk(entry.path))
+        if extensions:
+            listed = [path for path in listed if path.endswith(tuple(extensions))]
+        
+        known = {}
+        with self._lock:
+            for start in range(0, len(listed), 500):
+                chunk = listed[start:start + 500]
+                known.update((path, (mtime_ns, size)) for path, mtime_ns, size in self._db.execute(
+                    f"SELECT path, mtime_ns, size FROM files WHERE path IN ({','.join('?' * len(chunk))})", chunk))
+        changed = []
+        for path in listed:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if known.get(path) != (st.st_mtime_ns, st.st_size):
+                changed.append(path)
+        return changed
+    
+    def may_contain(self, path: str, term: str) -> Optional[bool]:
+        """根据索引判断文件是否可能包含term；文件不在索引中或已变化时返回None"""
+        grams = self.grams(term.encode("utf-8"))
+        with self._lock:
+            row = self._db.execute("SELECT id, mtime_ns, size, state FROM files WHERE path = ?",
+                                   (os.path.abspath(path),)).fetchone()
+            if not grams or row is None or row[3] != self.INDEXED:
+                return None
+            try:
+                st = os.stat(path)
+            except OSError:
+                return None
+            if (st.st_mtime_ns, st.st_size) != (row[1], row[2]):
+                return None
+            return all(row[0] in self._lookup(gram) for gram in grams)
+    
+    def stats(self) -> Dict:
+        with self._lock:
+            files = self._db.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+            grams = self._db.execute("SELECT COUNT(DISTINCT gram) FROM postings").fetchone()[0]
+            segments = self._segment_count()
+        size = sum(os.path.getsize(self.db_path + suffix) for suffix in ("", "-wal")
+                   if os.path.exists(self.db_path + suffix))
+        return {"root": self.root, "files": files, "grams": grams, "segments": segments, "bytes": size}
+    
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class SearchIndexStore:
+    """管理若干目录的三元组索引：搜索路径位于某个已索引目录之下时使用该索引
+    
+    索引在首次使用时建立；之后每refresh_interval秒或有工具修改了索引内的文件后，下次搜索前增量更新。
+    某个索引正在被其他线程建立或更新时（如启动时的后台建立），搜索不等待，直接不用索引。
+    """
+    
+    def __init__(self, directory: str, roots: List[str], refresh_interval: float = 30.0):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.refresh_interval = refresh_interval
+        self.searcher = ContentSearcher()
+        self._indexes: Dict[str, TrigramIndex] = {}
+        self._dirty = set()
+        self._updating = set()
+        self._lock = threading.Lock()
+        for root in roots:
+            root = os.path.abspath(os.path.expanduser(root))
+            name = hashlib.sha256(root.encode("utf-8")).hexdigest()[:16] + ".sqlite"
+            self._indexes[root] = TrigramIndex(os.path.join(directory, name), root, self.searcher)
+            self._dirty.add(root)
+    
+    def for_path(self, path: str) -> Optional[TrigramIndex]:
+        """返回覆盖path的最新索引（必要时先增量更新）；没有覆盖它的索引或索引正在更新时返回None"""
+        path = os.path.abspath(path)
+        roots = [root for root in self._indexes if path == root or path.startswith(root.rstrip(os.sep) + os.sep)]
+        if not roots:
+            return None
+        root = max(roots, key=len)
+        index = self._indexes[root]
+        with self._lock:
+            if root in self._updating:
+                return None
+            refresh = root in self._dirty or time.time() - index.last_update > self.refresh_interval
+            if refresh:
+                self._dirty.discard(root)
+                self._updating.add(root)
+        if refresh:
+            try:
+                with tracer.span("index_update", root=root) as span:
+                    span.set(**index.update())
+            finally:
+                with self._lock:
+                    self._updating.discard(root)
+        return index
+    
+    def invalidate(self, paths: Optional[List[str]]):
+        """工具修改了paths（None表示范围未知）后，让相关索引在下次搜索前更新"""
+        with self._lock:
+            for root in self._indexes:
+                prefix = root.rstrip(os.sep) + os.sep
+                if paths is None or any(p == root or p.startswith(prefix) or root.startswith(p.rstrip(os.sep) + os.sep)
+                                        for p in paths):
+                    self._dirty.add(root)
+    
+    def update_all(self):
+        for root in list(self._indexes):
+            self.for_path(root)
+    
+    def stats(self) -> List[Dict]:
+        return [index.stats() for index in self._indexes.values()]
+    
+    def close(self):
+        for index in self._indexes.values():
+            index.close()
+
+
+class StatCache:
+    """文件元数据缓存：list_directory的scandir结果和各查询工具的stat共用
+    
+    单个路径的stat在ttl秒内直接复用；目录列表在mtime不变且未超过listing_ttl时复用
+    （目录mtime不反映其中文件大小的变化，所以列表也有有效期）。修改文件的工具执行后按路径失效。
+    """
+    
+    def __init__(self, ttl: float = 2.0, listing_ttl: float = 10.0, max_entries: int = 20000):
+        self.ttl = ttl
+        self.listing_ttl = listing_ttl
+        self.max_entries = max_entries
+        self._stats: "OrderedDict[str, Tuple[Optional[os.stat_result], float]]" = OrderedDict()
+        self._listings: Dict[str, Tuple[int, float, List[Tuple[str, bool, Optional[os.stat_result]]]]] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    def _store(self, path: str, st: Optional[os.stat_result], now: float):
+        self._stats[path] = (st, now)
+        self._stats.move_to_end(path)
+        while len(self._stats) > self.max_entries:
+            self._stats.popitem(last=False)
+    
+    def stat(self, path: str) -> Optional[os.stat_result]:
+        """跟随符号链接的stat；路径不存在时返回None"""
+        now = time.monotonic()
+        with self._lock:
+            cached = self._stats.get(path)
+            if cached is not None and now - cached[1] < self.ttl:
+                self.hits += 1
+                return cached[0]
+            self.misses += 1
+        try:
+            st = os.stat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            st = None
+        with self._lock:
+            self._store(path, st, now)
+        return st
+    
+    def scandir(self, directory: str) -> List[Tuple[str, bool, Optional[os.stat_result]]]:
+        """目录内容 [(名称, 是否目录, stat)]，stat取自DirEntry（Windows上不需要额外的系统调用）"""
+        dir_stat = os.stat(directory)
+        now = time.monotonic()
+        with self._lock:
+            cached = self._listings.get(directory)
+            if cached is not None and cached[0] == dir_stat.st_mtime_ns and now - cached[1] < self.listing_ttl:
+                self.hits += 1
+                return cached[2]
+            self.misses += 1
+        
+        entries = []
+        with os.scandir(directory) as it:
+            for entry in it:
+                try:
+                    st = entry.stat()
+                    is_dir = stat.S_ISDIR(st.st_mode)
+                except OSError:
+                    # 失效的符号链接等
+                    st, is_dir = None, False
+                entries.append((entry.name, is_dir, st))
+        with self._lock:
+            self._listings[directory] = (dir_stat.st_mtime_ns, now, entries)
+            self._store(directory, dir_stat, now)
+            for name, _, st in entries:
+                if st is not None:
+                    self._store(os.path.join(directory, name), st, now)
+        return entries
+    
+    def invalidate(self, paths: Optional[List[str]]):
+        """路径本身、其下所有条目和所在目录的列表失效；None表示全部失效"""
+        with self._lock:
+            if paths is None:
+                self._stats.clear()
+                self._listings.clear()
+                return
+            for path in paths:
+                path = path.rstrip(os.sep) or path
+                prefix = path + os.sep
+                for cache in (self._stats, self._listings):
+                    for key in [k for k in cache if k == path or k.startswith(prefix)]:
+                        del cache[key]
+                self._listings.pop(os.path.dirname(path), None)
+                self._stats.pop(os.path.dirname(path), None)
+    
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"entries": len(self._stats), "listings": len(self._listings), "hits": self.hits,
+                    "misses": self.misses}
+
+
+class LineIndex:
+    """文件的稀疏行索引：记录每个固定大小的块之前有多少个换行符
+    
+    建立时每块只做一次bytes.count；定位第N行时二分找到所在块，只在该块内切分。
+    文件只在末尾追加时（日志）复用已有的块，只统计新增部分。
+    """
+    
+    def __init__(self, block_size: int = 1024 * 1024):
+        self.block_size = block_size
+        self.counts = array("Q", [0])
+        self.size = 0
+        self.mtime_ns = 0
+        self.ends_with_newline = True
+        self._tail_crc = 0
+        self.lock = threading.Lock()
+    
+    def _crc_at(self, mm, end: int) -> int:
+        return zlib.crc32(mm[max(0, end - 64):end])
+    
+    def update(self, mm, st: os.stat_result) -> "LineIndex":
+        """按文件当前内容更新；只追加过内容时从最后一个完整块继续统计"""
+        if (st.st_size, st.st_mtime_ns) == (self.size, self.mtime_ns):
+            return self
+        full_blocks = self.size // self.block_size
+        if st.st_size >= self.size and full_blocks and self._crc_at(mm, full_blocks * self.block_size) == self._tail_crc:
+            del self.counts[full_blocks + 1:]
+        else:
+            full_blocks = 0
+            self.counts = array("Q", [0])
+        total = self.counts[-1]
+        for start in range(full_blocks * self.block_size, st.st_size, self.block_size):
+            total += mm[start:min(start + self.block_size, st.st_size)].count(b"\n")
+            self.counts.append(total)
+        self.size, self.mtime_ns = st.st_size, st.st_mtime_ns
+        self.ends_with_newline = st.st_size == 0 or mm[st.st_size - 1:st.st_size] == b"\n"
+        self._tail_crc = self._crc_at(mm, (st.st_size // self.block_size) * self.block_size)
+        return self
+    
+    @property
+    def total_lines(self) -> int:
+        return self.counts[-1] + (0 if self.ends_with_newline else 1)
+    
+    def locate(self, mm, line: int) -> Optional[int]:
+        """第line行（从1开始）的起始字节偏移；超出文件时返回None"""
+        if line < 1 or line > self.total_lines:
+            return None
+        before = line - 1
+        if before == 0:
+            return 0
+        # 第before个换行符所在的块：counts[block] < before <= counts[block + 1]
+        block = bisect.bisect_left(self.counts, before) - 1
+        position = block * self.block_size
+        need = before - self.counts[block]
+        while need:
+            newline = mm.find(b"\n", position)
+            if newline < 0:
+                return None
+            position = newline + 1
+            need -= 1
+        return position
+
+
+class FileReader:
+    """read_file的实现：按字节/行范围读取、head/tail、大文件用mmap和行索引，自动识别编码，二进制文件只返回摘要"""
+    
+    # 常见二进制格式的文件头
+    MAGIC = (
+        (b"\x89PNG", "PNG图片"), (b"\xff\xd8\xff", "JPEG图片"), (b"GIF8", "GIF图片"), (b"%PDF", "PDF文档"),
+        (b"PK\x03\x04", "ZIP压缩包（也可能是docx/xlsx/jar）"), (b"\x1f\x8b", "gzip压缩包"), (b"7z\xbc\xaf", "7z压缩包"),
+        (b"Rar!", "RAR压缩包"), (b"\x7fELF", "ELF可执行文件"), (b"MZ", "Windows可执行文件"),
+        (b"SQLite format 3", "SQLite数据库"), (b"ID3", "MP3音频"), (b"RIFF", "RIFF媒体文件（WAV/AVI/WebP）"),
+    )
+    BOMS = ((codecs.BOM_UTF8, "utf-8-sig"), (codecs.BOM_UTF16_LE, "utf-16"), (codecs.BOM_UTF16_BE, "utf-16"))
+    
+    def __init__(self, searcher: Optional[ContentSearcher] = None, max_full_bytes: int = 1024 * 1024,
+                 max_window_bytes: int = 256 * 1024, default_lines: int = 100, max_indexes: int = 16):
+        self.searcher = searcher or ContentSearcher()
+        self.max_full_bytes = max_full_bytes
+        self.max_window_bytes = max_window_bytes
+        self.default_lines = default_lines
+        self.max_indexes = max_indexes
+        self._indexes: "OrderedDict[str, LineIndex]" = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def detect_encoding(self, sample: bytes) -> Optional[str]:
+        """BOM优先，其次UTF-8、GB18030；判断为二进制时返回None"""
+        for bom, encoding in self.BOMS:
+            if sample.startswith(bom):
+                return encoding
+        if self.searcher.is_binary(sample):
+            return None
+        try:
+            # 样本末尾可能截断了多字节字符
+            codecs.getincrementaldecoder("utf-8")().decode(sample, final=False)
+            return "utf-8"
+        except UnicodeDecodeError:
+            pass
+        try:
+            sample.decode("gb18030")
+            return "gb18030"
+        except UnicodeDecodeError:
+            # 样本末尾截断的GB18030字符
+            try:
+                sample[:-3].decode("gb18030")
+                return "gb18030"
+            except UnicodeDecodeError:
+                return "latin-1"
+    
+    def binary_summary(self, path: str, size: int, head: bytes) -> str:
+        kind = next((name for magic, name in self.MAGIC if head.startswith(magic)), "未知格式")
+        return (f"二进制文件 {path}: {size} 字节，类型: {kind}，开头: {head[:16].hex(' ')}\n"
+                f"（不显示二进制内容）")
+    
+    def _line_index(self, path: str, mm, st: os.stat_result) -> LineIndex:
+        with self._lock:
+            index = self._indexes.pop(path, None) or LineIndex()
+            self._indexes[path] = index
+            while len(self._indexes) > self.max_indexes:
+                self._indexes.popitem(last=False)
+        with index.lock:
+            return index.update(mm, st)
+    
+    def read(self, path: str, offset: Optional[int] = None, length: Optional[int] = None,
+             start_line: Optional[int] = None, end_line: Optional[int] = None,
+             head: Optional[int] = None, tail: Optional[int] = None) -> str:
+        st = os.stat(path)
+        if stat.S_ISDIR(st.st_mode):
+            return f"错误：路径是目录 {path}"
+        windowed = any(value is not None for value in (offset, length, start_line, end_line, head, tail))
+        if st.st_size == 0:
+            # /proc等伪文件的大小为0但有内容，不能mmap，最多读取max_window_bytes
+            with open(path, "rb") as f:
+                data = f.read(self.max_window_bytes + 1)
+            if not data:
+                return "文件为空"
+            encoding = self.detect_encoding(data[:64 * 1024])
+            if encoding is None:
+                return self.binary_summary(path, len(data), data)
+            note = f"（内容超过{self.max_window_bytes}字节已截断）\n" if len(data) > self.max_window_bytes else ""
+            text = data[:self.max_window_bytes].decode(encoding, errors="replace")
+            if not windowed:
+                return note + text
+            return note + self._window_text(path, text, start_line, end_line, head, tail)
+        with open(path, "rb") as f:
+            sample = f.read(64 * 1024)
+            encoding = self.detect_encoding(sample)
+            if encoding is None:
+                return self.binary_summary(path, st.st_size, sample)
+            if encoding == "utf-16":
+                # UTF-16的换行不是单字节，只支持整体读取
+                if st.st_size > self.max_full_bytes:
+                    return f"错误：UTF-16文件过大（{st.st_size} 字节），不支持分段读取"
+                f.seek(0)
+                text = f.read().decode(encoding, errors="replace")
+                if not windowed:
+                    return text
+                return self._window_text(path, text, start_line, end_line, head, tail)
+            if not windowed and st.st_size <= self.max_window_bytes:
+                f.seek(0)
+                return f.read().decode(encoding, errors="replace")
+            
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if offset is not None or length is not None:
+                    return self._read_bytes(path, mm, encoding, int(offset or 0), length)
+                if tail is not None:
+                    return self._read_tail(path, mm, encoding, max(1, int(tail)))
+                index = self._line_index(path, mm, st)
+                if head is not None:
+                    start_line, end_line = 1, int(head)
+                elif start_line is None and end_line is None:
+                    # 超过大小上限且未指定范围时只给开头部分
+                    text = self._read_lines(path, mm, encoding, index, 1, self.default_lines)
+                    return (f"文件较大（{st.st_size} 字节，{index.total_lines} 行），只显示前 {self.default_lines} 行；"
+                            f"可用start_line/end_line、offset/length、head或tail读取其他部分\n" + text)
+                start_line = int(start_line or 1)
+                end_line = int(end_line if end_line is not None else start_line + self.default_lines - 1)
+                return self._read_lines(path, mm, encoding, index, start_line, end_line)
+    
+    def _window_text(self, path: str, text: str, start_line: Optional[int], end_line: Optional[int],
+                     head: Optional[int], tail: Optional[int]) -> str:
+        """已整体解码的文本按行取窗口（UTF-16和伪文件）"""
+        lines = text.splitlines(keepends=True)
+        first = int(start_line or 1) if tail is None else max(1, len(lines) - int(tail) + 1)
+        last = int(end_line or (first + int(head or self.default_lines) - 1)) if tail is None else len(lines)
+        return self._format_lines(path, first, last, len(lines), "".join(lines[first - 1:last]))
+    
+    def _format_lines(self, path: str, first: int, last: int, total: int, text: str, note: str = "") -> str:
+        last = min(last, total)
+        return f"文件 {path} 第{first}-{last}行（共{total}行）{note}:\n{text}"
+    
+    def _read_lines(self, path: str, mm, encoding: str, index: LineIndex, first: int, last: int) -> str:
+        first = max(1, first)
+        if last < first:
+            return f"错误：行范围无效 {first}-{last}"
+        start = index.locate(mm, first)
+        if start is None:
+            return f"错误：起始行超出文件范围（共{index.total_lines}行）"
+        end = index.locate(mm, last + 1)
+        end = len(mm) if end is None else end
+        note = ""
+        if end - start > self.max_window_bytes:
+            # 窗口过大时在上限内的最后一个换行处截断
+            cut = mm.rfind(b"\n", start, start + self.max_window_bytes)
+            end = cut + 1 if cut >= 0 else start + self.max_window_bytes
+            last = first + mm[start:end].count(b"\n") - 1
+            note = f"，超过{self.max_window_bytes}字节已截断，下一段从第{last + 1}行开始"
+        return self._format_lines(path, first, last, index.total_lines,
+                                  mm[start:end].decode(encoding, errors="replace"), note)
+    
+    def _read_tail(self, path: str, mm, encoding: str, count: int) -> str:
+        """从文件末尾向前找换行，不扫描整个文件"""
+        size = len(mm)
+        end = size - 1 if mm[size - 1:size] == b"\n" else size
+        position = end
+        found = 0
+        # 第count个换行可能正好在字节0处，所以单独记录是否已退到文件开头
+        hit_start = False
+        while found < count and size - position <= self.max_window_bytes:
+            newline = mm.rfind(b"\n", 0, position)
+            if newline < 0:
+                hit_start = True
+                break
+            position = newline
+            found += 1
+        start = 0 if hit_start else position + 1
+        note = ""
+        if size - start > self.max_window_bytes:
+            start = size - self.max_window_bytes
+            start = mm.find(b"\n", start) + 1 or start
+            note = f"，超过{self.max_window_bytes}字节已截断"
+        text = mm[start:size].decode(encoding, errors="replace")
+        lines = text.count("\n") + (0 if text.endswith("\n") else 1)
+        return f"文件 {path} 最后{lines}行（文件共{size}字节{note}）:\n{text}"
+    
+    def _read_bytes(self, path: str, mm, encoding: str, offset: int, length: Optional[int]) -> str:
+        size = len(mm)
+        if offset < 0:
+            offset = max(0, size + offset)
+        if offset >= size:
+            return f"错误：偏移超出文件大小（{size} 字节）"
+        length = self.max_window_bytes if length is None else min(int(length), self.max_window_bytes)
+        data = mm[offset:offset + length]
+        if encoding.startswith("utf-8"):
+            # 跳过被截断的多字节字符开头，结尾的不完整字符由增量解码器丢弃
+            skip = 0
+            while skip < min(3, len(data)) and 0x80 <= data[skip] <= 0xBF:
+                skip += 1
+            text = codecs.getincrementaldecoder("utf-8")(errors="replace").decode(data[skip:], final=False)
+        else:
+            text = data.decode(encoding, errors="replace")
+        end = offset + len(data)
+        more = f"，下一段offset={end}" if end < size else ""
+        return f"文件 {path} 字节 {offset}-{end}（共{size}字节{more}）:\n{text}"
+
 
 class ToolExecutor:
-    def __init__(self):
+    # 只读、无副作用的工具，可以在响应流式到达时提前执行
+    READ_ONLY_TOOLS = frozenset({
+        "get_current_directory", "get_system_info", "get_disk_usage", "get_memory_info",
+        "get_cpu_info", "get_network_info", "get_process_list", "read_file", "list_directory",
+        "file_exists", "directory_exists", "get_file_info", "search_files", "get_file_size",
+        "search_local_files", "search_in_file", "check_internet_connection", "get_ip_address",
+        "ping_host", "list_running_applications", "get_current_time", "calculate",
+        "read_tool_result",
+    })
+    
+    # 工具出错时的返回格式："错误：…"、"获取XX失败: …"、"工具执行错误: …"
+    ERROR_RESULT = re.compile(r"^(错误|❌|工具执行错误|[^\n:：]{0,20}失败: )")
+    
+    # 有副作用但不涉及文件系统的工具，执行后不需要让缓存失效
+    # （缓存键都是绝对路径，切换工作目录也不影响；代码解释器没有open等内置函数）
+    NO_FS_EFFECT_TOOLS = frozenset({
+        "web_search", "open_url", "open_url_in_browser", "get_weather", "translate_text",
+        "set_alarm", "create_reminder", "python_code_interpreter", "change_directory",
+    })
+    
+    # 修改文件系统的工具及其写入的路径参数
+    PATH_MUTATING_TOOLS = {
+        "create_file": ("file_path",),
+        "delete_file": ("file_path",),
+        "copy_file": ("destination_path",),
+        "move_file": ("source_path", "destination_path"),
+        "rename_file": ("old_path", "new_path"),
+        "compress_files": ("output_path",),
+        "extract_files": ("output_dir",),
+        "create_directory": ("directory_path",),
+        "delete_directory": ("directory_path",),
+        "download_file": ("save_path",),
+    }
+    
+    # 幂等工具的缓存规则：ttl为最长有效秒数，mtime表示命中时还要校验路径的修改时间
+    CACHE_POLICIES = {
+        "get_system_info": {"ttl": 300},
+        "get_disk_usage": {"ttl": 10},
+        "get_memory_info": {"ttl": 2},
+        "get_cpu_info": {"ttl": 2},
+        "get_process_list": {"ttl": 2},
+        "list_running_applications": {"ttl": 2},
+        "file_exists": {"ttl": 60, "mtime": True},
+        "directory_exists": {"ttl": 60, "mtime": True},
+        "get_file_info": {"ttl": 60, "mtime": True},
+        "get_file_size": {"ttl": 60, "mtime": True},
+        # 目录的mtime不反映其中文件大小的变化，所以有效期较短
+        "list_directory": {"ttl": 5, "mtime": True},
+        "search_files": {"ttl": 10},
+    }
+    
+    def __init__(self, cwd: Optional[str] = None, shared: Optional["ToolExecutor"] = None,
+                 search_index: Optional[SearchIndexStore] = None):
+        # 虚拟工作目录：相对路径和子进程都以它为准，不调用os.chdir，多个会话互不影响
+        self.cwd = os.path.abspath(cwd or os.getcwd())
+        # 由fork()创建的执行器与原执行器共用缓存；溢出存储属于会话，各自独立，句柄不会被其他会话读到
+        self.spill_store = ToolResultSpillStore()
+        self.result_cache = shared.result_cache if shared else ToolResultCache(self.CACHE_POLICIES)
+        self.walker = shared.walker if shared else FileWalker()
+        self.stat_cache = shared.stat_cache if shared else StatCache()
+        self.content_searcher = shared.content_searcher if shared else ContentSearcher(walker=self.walker)
+        self.file_reader = shared.file_reader if shared else FileReader(self.content_searcher)
+        # 可选的内容搜索索引（--index-root），与fork出的执行器共用
+        self.search_index = shared.search_index if shared else search_index
         self.available_functions = {
             # 系统工具
             "execute_shell_command": self.execute_shell_command,
@@ -105,14 +2415,19 @@ class ToolExecutor:
             "calculate": self.calculate,
             "get_weather": self.get_weather,
             "translate_text": self.translate_text,
+            "read_tool_result": self.read_tool_result,
         }
     
+    def fork(self, cwd: Optional[str] = None) -> "ToolExecutor":
+        """为一个会话创建执行器：有自己的工作目录和溢出存储，共用缓存"""
+        return ToolExecutor(cwd or self.cwd, shared=self)
+    
     def _normalize_path(self, path: str) -> str:
-        """标准化路径处理"""
+        """标准化路径处理：相对路径以本执行器的工作目录为基准"""
         if path.startswith('~'):
             path = os.path.expanduser(path)
         elif not os.path.isabs(path):
-            path = os.path.abspath(path)
+            path = os.path.normpath(os.path.join(self.cwd, path))
         return path
     
     def _is_dangerous_command(self, command: str) -> bool:
@@ -124,6 +2439,36 @@ class ToolExecutor:
         ]
         return any(pattern in command for pattern in dangerous_patterns)
     
+    def _run_process(self, command, timeout: float, shell: bool = False) -> subprocess.CompletedProcess:
+        """在工作目录中运行子进程并收集输出；对话被取消时结束整个进程组并抛出TurnCancelledError"""
+        cancel_token = current_cancel_token()
+        cancel_token.raise_if_cancelled()
+        if sys.platform == "win32":
+            process = subprocess.Popen(command, shell=shell, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+                                       cwd=self.cwd, creationflags=subprocess.CREATE_NEW_PROCESS_GROUP)
+        else:
+            process = subprocess.Popen(command, shell=shell, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+                                       cwd=self.cwd, start_new_session=True)
+        
+        def kill():
+            try:
+                if sys.platform == "win32":
+                    subprocess.run(["taskkill", "/F", "/T", "/PID", str(process.pid)], capture_output=True)
+                else:
+                    os.killpg(process.pid, 9)
+            except OSError:
+                process.kill()
+        
+        with cancel_token.on_cancel(kill):
+            try:
+                stdout, stderr = process.communicate(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                kill()
+                process.communicate()
+                raise
+        cancel_token.raise_if_cancelled()
+        return subprocess.CompletedProcess(command, process.returncode, stdout, stderr)
+    
     # === 系统工具 ===
     def execute_shell_command(self, command: str) -> str:
         """执行Shell命令"""
@@ -131,7 +2476,7 @@ class ToolExecutor:
             if self._is_dangerous_command(command):
                 return "错误：出于安全考虑，该命令被阻止执行"
             
-            result = subprocess.run(command, shell=True, capture_output=True, text=True, timeout=30)
+            result = self._run_process(command, timeout=30, shell=True)
             if result.returncode == 0:
                 return result.stdout.strip() or "命令执行成功（无输出）"
             else:
@@ -147,10 +2492,11 @@ class ToolExecutor:
             if self._is_dangerous_command(command):
                 return "错误：出于安全考虑，该命令被阻止执行"
             
+            # 新窗口同样在会话的工作目录中打开
             if sys.platform == "win32":
-                os.system(f'start cmd /k "{command}"')
+                subprocess.Popen(f'start cmd /k "{command}"', shell=True, cwd=self.cwd)
             else:
-                os.system(f'xterm -e "{command}" &')
+                subprocess.Popen(f'xterm -e "{command}" &', shell=True, cwd=self.cwd)
             
             return f"已启动新窗口执行命令: {command}"
         except Exception as e:
@@ -158,7 +2504,7 @@ class ToolExecutor:
     
     def get_current_directory(self) -> str:
         """获取当前工作目录"""
-        return f"当前工作目录: {os.getcwd()}"
+        return f"当前工作目录: {self.cwd}"
     
     def python_code_interpreter(self, code: str) -> str:
         """执行Python代码"""
@@ -290,37 +2636,53 @@ class ToolExecutor:
         except Exception as e:
             return f"创建文件失败: {str(e)}"
     
-    def read_file(self, file_path: str) -> str:
-        """读取文件内容"""
+    def read_file(self, file_path: str, offset: Optional[int] = None, length: Optional[int] = None,
+                  start_line: Optional[int] = None, end_line: Optional[int] = None,
+                  head: Optional[int] = None, tail: Optional[int] = None) -> str:
+        """读取文件内容（可按字节或行范围读取，大文件默认只显示开头）"""
         try:
             file_path = self._normalize_path(file_path)
             if not os.path.exists(file_path):
                 return f"错误：文件不存在 {file_path}"
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-                return content if content else "文件为空"
+            return self.file_reader.read(file_path, offset=offset, length=length, start_line=start_line,
+                                         end_line=end_line, head=head, tail=tail)
         except Exception as e:
             return f"读取文件失败: {str(e)}"
     
-    def list_directory(self, directory_path: str = ".") -> str:
-        """列出目录内容"""
+    LIST_SORT_KEYS = {
+        "name": lambda item: item[0].lower(),
+        "type": lambda item: (not item[1], item[0].lower()),
+        "size": lambda item: item[2].st_size if item[2] and not item[1] else -1,
+        "mtime": lambda item: item[2].st_mtime if item[2] else 0,
+    }
+    
+    def list_directory(self, directory_path: str = ".", sort_by: str = "type", reverse: bool = False,
+                       offset: int = 0, limit: int = 200) -> str:
+        """列出目录内容（可排序、分页）"""
         try:
             directory_path = self._normalize_path(directory_path)
-            if not os.path.exists(directory_path):
+            if self.stat_cache.stat(directory_path) is None:
                 return f"错误：目录不存在 {directory_path}"
+            if sort_by not in self.LIST_SORT_KEYS:
+                return f"错误：不支持的排序方式 {sort_by}，可选: {', '.join(self.LIST_SORT_KEYS)}"
             
-            items = os.listdir(directory_path)
+            items = self.stat_cache.scandir(directory_path)
             if not items:
                 return "目录为空"
             
+            offset, limit = max(0, int(offset)), max(1, int(limit))
+            items = sorted(items, key=self.LIST_SORT_KEYS[sort_by], reverse=bool(reverse))
+            page = items[offset:offset + limit]
             result = []
-            for item in items:
-                full_path = os.path.join(directory_path, item)
-                if os.path.isdir(full_path):
-                    result.append(f"[目录] {item}/")
+            for name, is_dir, st in page:
+                if is_dir:
+                    result.append(f"[目录] {name}/")
                 else:
-                    size = os.path.getsize(full_path)
-                    result.append(f"[文件] {item} ({size} 字节)")
+                    result.append(f"[文件] {name} ({st.st_size if st else 0} 字节)")
+            if len(page) < len(items):
+                end = offset + len(page)
+                more = f"，下一页 offset={end}" if end < len(items) else ""
+                result.insert(0, f"共 {len(items)} 项，显示第 {offset + 1}-{end} 项{more}")
             return "\n".join(result)
         except Exception as e:
             return f"列出目录失败: {str(e)}"
@@ -393,7 +2755,8 @@ class ToolExecutor:
         """检查文件是否存在"""
         try:
             file_path = self._normalize_path(file_path)
-            exists = os.path.exists(file_path) and os.path.isfile(file_path)
+            st = self.stat_cache.stat(file_path)
+            exists = st is not None and stat.S_ISREG(st.st_mode)
             return f"文件{'存在' if exists else '不存在'}: {file_path}"
         except Exception as e:
             return f"检查文件存在失败: {str(e)}"
@@ -402,7 +2765,8 @@ class ToolExecutor:
         """检查目录是否存在"""
         try:
             directory_path = self._normalize_path(directory_path)
-            exists = os.path.exists(directory_path) and os.path.isdir(directory_path)
+            st = self.stat_cache.stat(directory_path)
+            exists = st is not None and stat.S_ISDIR(st.st_mode)
             return f"目录{'存在' if exists else '不存在'}: {directory_path}"
         except Exception as e:
             return f"检查目录存在失败: {str(e)}"
@@ -412,17 +2776,17 @@ class ToolExecutor:
         try:
             file_path = self._normalize_path(file_path)
             
-            if not os.path.exists(file_path):
+            stat_info = self.stat_cache.stat(file_path)
+            if stat_info is None:
                 return f"错误：文件不存在 {file_path}"
             
-            stat_info = os.stat(file_path)
             file_info = {
                 "size": f"{stat_info.st_size} 字节",
                 "创建时间": time.ctime(stat_info.st_ctime),
                 "修改时间": time.ctime(stat_info.st_mtime),
                 "访问时间": time.ctime(stat_info.st_atime),
-                "是否为文件": os.path.isfile(file_path),
-                "是否为目录": os.path.isdir(file_path)
+                "是否为文件": stat.S_ISREG(stat_info.st_mode),
+                "是否为目录": stat.S_ISDIR(stat_info.st_mode)
             }
             
             info_str = "\n".join([f"{k}: {v}" for k, v in file_info.items()])
@@ -430,24 +2794,30 @@ class ToolExecutor:
         except Exception as e:
             return f"获取文件信息失败: {str(e)}"
     
-    def search_files(self, search_pattern: str, search_path: str = ".") -> str:
-        """搜索文件"""
+    def search_files(self, search_pattern: str, search_path: str = ".", max_depth: Optional[int] = None,
+                     include_excluded: bool = False) -> str:
+        """搜索文件（模式支持**递归，找到20个即停止）；默认跳过.git、node_modules、虚拟环境等目录"""
         try:
             search_path = self._normalize_path(search_path)
             if not os.path.exists(search_path):
                 return f"错误：搜索路径不存在 {search_path}"
             
-            import fnmatch
-            results = []
-            for root, dirs, files in os.walk(search_path):
-                for file in files:
-                    if fnmatch.fnmatch(file, search_pattern):
-                        results.append(os.path.join(root, file))
-            
+            # 多取一个，用来判断是否还有更多结果
+            walker = self._full_walker if include_excluded else self.walker
+            skipped = []
+            results = [entry.path for entry in walker.walk(search_path, search_pattern, limit=21,
+                                                           max_depth=max_depth, skipped=skipped)]
+            note = ""
+            if skipped:
+                names = sorted({os.path.basename(path) for path in skipped})
+                note = (f"\n（跳过了 {len(skipped)} 个排除的目录: {', '.join(names[:5])}"
+                        f"{' 等' if len(names) > 5 else ''}，需要搜索其中的文件时传入 include_excluded=true）")
             if not results:
-                return f"未找到匹配的文件: {search_pattern}"
+                return f"未找到匹配的文件: {search_pattern}" + note
             
-            return f"找到 {len(results)} 个匹配文件:\n" + "\n".join(results[:20])
+            if len(results) > 20:
+                return f"找到超过 20 个匹配文件，只列出前 20 个:\n" + "\n".join(results[:20]) + note
+            return f"找到 {len(results)} 个匹配文件:\n" + "\n".join(results) + note
         except Exception as e:
             return f"搜索文件失败: {str(e)}"
     
@@ -455,19 +2825,23 @@ class ToolExecutor:
         """获取文件大小"""
         try:
             file_path = self._normalize_path(file_path)
-            if not os.path.exists(file_path):
+            stat_info = self.stat_cache.stat(file_path)
+            if stat_info is None:
                 return f"错误：文件不存在 {file_path}"
             
-            size = os.path.getsize(file_path)
+            size = stat_info.st_size
             return f"文件大小: {size} 字节 ({size/1024:.2f} KB, {size/(1024*1024):.2f} MB)"
         except Exception as e:
             return f"获取文件大小失败: {str(e)}"
     
+    # 不排除任何目录的遍历器：压缩和include_excluded的文件搜索使用
+    _full_walker = FileWalker(excludes=())
+    
     def compress_files(self, files: List[str], output_path: str) -> str:
         """压缩文件"""
         try:
             import zipfile
-            output_path = self._normalize_path(output_path)
+            output_path = os.path.abspath(self._normalize_path(output_path))
             
             with zipfile.ZipFile(output_path, 'w') as zipf:
                 for file in files:
@@ -476,11 +2850,11 @@ class ToolExecutor:
                         if os.path.isfile(file):
                             zipf.write(file, os.path.basename(file))
                         else:
-                            for root, dirs, files_in_dir in os.walk(file):
-                                for f in files_in_dir:
-                                    zipf.write(os.path.join(root, f), 
-                                              os.path.relpath(os.path.join(root, f), 
-                                                             os.path.dirname(file)))
+                            # 压缩时不排除任何目录，只借用遍历（不跟随符号链接目录）
+                            for entry in self._full_walker.walk(file):
+                                if os.path.abspath(entry.path) == output_path:
+                                    continue
+                                zipf.write(entry.path, os.path.relpath(entry.path, os.path.dirname(file)))
             
             return f"文件压缩成功: {output_path}"
         except Exception as e:
@@ -550,8 +2924,8 @@ class ToolExecutor:
             if not os.path.isdir(directory_path):
                 return f"错误：路径不是目录 {directory_path}"
             
-            os.chdir(directory_path)
-            return f"当前工作目录已更改为: {os.getcwd()}"
+            self.cwd = directory_path
+            return f"当前工作目录已更改为: {self.cwd}"
         except Exception as e:
             return f"更改目录失败: {str(e)}"
     
@@ -615,31 +2989,32 @@ class ToolExecutor:
             return f"在浏览器中打开URL失败: {str(e)}"
     
     def search_local_files(self, search_term: str, search_path: str = ".", file_extensions: List[str] = None) -> str:
-        """在本地文件中搜索内容"""
+        """在本地文件中搜索内容（并行流式扫描，找到10个文件即停止）"""
         try:
             search_path = self._normalize_path(search_path)
             if not os.path.exists(search_path):
                 return f"错误：搜索路径不存在 {search_path}"
+            if not search_term:
+                return "错误：搜索词不能为空"
             
-            results = []
-            for root, dirs, files in os.walk(search_path):
-                for file in files:
-                    if file_extensions and not any(file.endswith(ext) for ext in file_extensions):
-                        continue
-                    
-                    file_path = os.path.join(root, file)
-                    try:
-                        with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                            content = f.read()
-                            if search_term.lower() in content.lower():
-                                results.append(file_path)
-                    except:
-                        continue
-            
+            index = self.search_index.for_path(search_path) if self.search_index else None
+            candidates = index.candidates(search_term, search_path, file_extensions) if index else None
+            summary = self.content_searcher.search(search_path, search_term, file_extensions, limit=10,
+                                                   cancel_token=current_cancel_token(), paths=candidates)
+            results = summary["results"]
             if not results:
-                return f"未找到包含 '{search_term}' 的文件"
+                return f"未找到包含 '{search_term}' 的文件（扫描了 {summary['files']} 个文件）"
             
-            return f"找到 {len(results)} 个包含 '{search_term}' 的文件:\n" + "\n".join(results[:10])
+            lines = []
+            for found in results:
+                lines.append(f"{found['path']} ({found['matches']}处匹配)")
+                lines.extend(f"  第{line_no}行: {text}" for line_no, text in found["lines"])
+            note = "，已达到上限，搜索提前结束" if summary["truncated"] else ""
+            if candidates is not None:
+                note = "，使用索引" + note
+            skipped = f"，跳过 {summary['binary']} 个二进制文件" if summary["binary"] else ""
+            return (f"找到 {len(results)} 个包含 '{search_term}' 的文件（扫描了 {summary['files']} 个文件"
+                    f"{skipped}{note}）:\n" + "\n".join(lines))
         except Exception as e:
             return f"本地文件搜索失败: {str(e)}"
     
@@ -649,20 +3024,19 @@ class ToolExecutor:
             file_path = self._normalize_path(file_path)
             if not os.path.exists(file_path):
                 return f"错误：文件不存在 {file_path}"
+            if not search_term:
+                return "错误：搜索词不能为空"
             
-            with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                content = f.read()
-                lines = content.split('\n')
-                
-                matches = []
-                for i, line in enumerate(lines, 1):
-                    if search_term.lower() in line.lower():
-                        matches.append(f"第{i}行: {line.strip()}")
-                
-                if not matches:
-                    return f"在文件中未找到 '{search_term}'"
-                
-                return f"在文件中找到 {len(matches)} 个匹配项:\n" + "\n".join(matches[:10])
+            index = self.search_index.for_path(file_path) if self.search_index else None
+            if index is not None and index.may_contain(file_path, search_term) is False:
+                return f"在文件中未找到 '{search_term}'"
+            
+            found = self.content_searcher.scan_file(file_path, search_term.lower(), max_lines=10, sniff=False)
+            if not found["matches"]:
+                return f"在文件中未找到 '{search_term}'"
+            
+            matches = [f"第{line_no}行: {text}" for line_no, text in found["lines"]]
+            return f"在文件中找到 {found['matches']} 个匹配项:\n" + "\n".join(matches)
         except Exception as e:
             return f"文件内容搜索失败: {str(e)}"
     
@@ -691,7 +3065,7 @@ class ToolExecutor:
         try:
             param = "-n" if sys.platform.lower() == "win32" else "-c"
             command = ["ping", param, str(count), host]
-            result = subprocess.run(command, capture_output=True, text=True, timeout=10)
+            result = self._run_process(command, timeout=10)
             
             if result.returncode == 0:
                 return f"Ping {host} 成功:\n{result.stdout}"
@@ -713,8 +3087,10 @@ class ToolExecutor:
             response = requests.get(url, stream=True, timeout=30)
             response.raise_for_status()
             
-            with open(save_path, 'wb') as f:
+            cancel_token = current_cancel_token()
+            with cancel_token.on_cancel(response.close), open(save_path, 'wb') as f:
                 for chunk in response.iter_content(chunk_size=8192):
+                    cancel_token.raise_if_cancelled()
                     f.write(chunk)
             
             return f"文件下载成功: {save_path} ({os.path.getsize(save_path)} 字节)"
@@ -817,78 +3193,856 @@ class ToolExecutor:
         except Exception as e:
             return f"计算失败: {str(e)}"
     
-    def get_weather(self, city: str = "") -> str:
-        """获取天气信息（通过打开天气网站）"""
-        try:
-            if city:
-                url = f"https://www.google.com/search?q=天气+{urllib.parse.quote(city)}"
+    def get_weather(self, city: str = "") -> str:
+        """获取天气信息（通过打开天气网站）"""
+        try:
+            if city:
+                url = f"https://www.google.com/search?q=天气+{urllib.parse.quote(city)}"
+            else:
+                url = "https://www.google.com/search?q=天气"
+            
+            webbrowser.open(url)
+            return f"已在浏览器中打开天气信息{f' for {city}' if city else ''}"
+        except Exception as e:
+            return f"获取天气信息失败: {str(e)}"
+    
+    def translate_text(self, text: str, target_lang: str = "en") -> str:
+        """翻译文本（通过打开翻译网站）"""
+        try:
+            url = f"https://translate.google.com/?sl=auto&tl={target_lang}&text={urllib.parse.quote(text)}"
+            webbrowser.open(url)
+            return f"已在浏览器中打开翻译: {text} -> {target_lang}"
+        except Exception as e:
+            return f"翻译失败: {str(e)}"
+    
+    # 所有会话共享的工具线程池，阻塞型工具在这里执行
+    _pool = None
+    _pool_lock = threading.Lock()
+    
+    @classmethod
+    def _get_pool(cls) -> ThreadPoolExecutor:
+        with cls._pool_lock:
+            if cls._pool is None:
+                cls._pool = ThreadPoolExecutor(max_workers=32, thread_name_prefix="xiaoli-tool")
+            return cls._pool
+    
+    async def aexecute_tool(self, function_name: str, function_args: Dict) -> str:
+        """异步执行工具函数：阻塞型工具交给线程池，不占用事件循环；超长结果溢出到磁盘"""
+        loop = asyncio.get_running_loop()
+        # 复制上下文，工具线程可以通过current_cancel_token()感知取消
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(self._get_pool(), context.run, self._execute_bounded,
+                                          function_name, function_args)
+    
+    def _execute_bounded(self, function_name: str, function_args: Dict) -> str:
+        return self.spill_store.spill(function_name, self.execute_tool(function_name, function_args))
+    
+    def close(self):
+        """释放会话资源：删除溢出文件"""
+        self.spill_store.close()
+    
+    @classmethod
+    def is_error_result(cls, result) -> bool:
+        """工具返回的是错误信息（工具不抛异常，出错时返回错误字符串）"""
+        return isinstance(result, str) and bool(cls.ERROR_RESULT.match(result))
+    
+    def _path_args(self, function_args: Dict) -> List[str]:
+        """提取参数中的路径（已标准化）"""
+        paths = []
+        for key, value in function_args.items():
+            if not ('path' in key or 'dir' in key or 'file' in key):
+                continue
+            for item in (value if isinstance(value, list) else [value]):
+                if isinstance(item, str) and item:
+                    paths.append(self._normalize_path(item))
+        return paths
+    
+    def read_tool_result(self, handle: str, offset: int = 0, length: int = 4000) -> str:
+        """分页读取被截断的工具结果"""
+        try:
+            return self.spill_store.read(handle, offset, length)
+        except Exception as e:
+            return f"读取工具结果失败: {str(e)}"
+    
+    def execute_tool(self, function_name: str, function_args: Dict) -> str:
+        """执行工具函数"""
+        if function_name in self.available_functions:
+            try:
+                # 对路径参数进行标准化
+                for key, value in function_args.items():
+                    if isinstance(value, str) and ('path' in key or 'dir' in key or 'file' in key):
+                        function_args[key] = self._normalize_path(value)
+                
+                function = self.available_functions[function_name]
+                cached = self.result_cache.get(function_name, function, function_args, self._normalize_path)
+                if cached is not None:
+                    return cached
+                
+                result = function(**function_args)
+                if function_name in self.CACHE_POLICIES:
+                    self.result_cache.put(function_name, function, function_args, result, self._normalize_path)
+                elif function_name in self.PATH_MUTATING_TOOLS:
+                    self.result_cache.invalidate(self._path_args(function_args))
+                    self.stat_cache.invalidate(self._path_args(function_args))
+                    if self.search_index:
+                        self.search_index.invalidate(self._path_args(function_args))
+                elif function_name not in self.READ_ONLY_TOOLS and function_name not in self.NO_FS_EFFECT_TOOLS:
+                    # 命令执行、打开/关闭应用等影响范围未知的工具，清除所有与路径相关的缓存
+                    self.result_cache.invalidate(None)
+                    self.stat_cache.invalidate(None)
+                    if self.search_index:
+                        self.search_index.invalidate(None)
+                return result
+            except Exception as e:
+                return f"工具执行错误: {str(e)}"
+        return f"错误：未知的工具 {function_name}"
+
+class LoadingAnimation:
+    """加载动画类"""
+    
+    def __init__(self):
+        self.loading = False
+        self.frames = ['/', '-', '\\', '|']
+        self.current_frame = 0
+        self._stopped = threading.Event()
+    
+    def start(self, message="小狸思考中"):
+        """开始显示加载动画"""
+        with tracer.span("loading_animation", phase="start"):
+            self.loading = True
+            self._stopped.clear()
+            self.thread = threading.Thread(target=self._animate, args=(message,))
+            self.thread.daemon = True
+            self.thread.start()
+    
+    def _animate(self, message):
+        """动画线程"""
+        while self.loading:
+            frame = self.frames[self.current_frame % len(self.frames)]
+            print(f"\r{message} {frame}", end="", flush=True)
+            self.current_frame += 1
+            # 用事件等待代替sleep，stop()时可以立即唤醒
+            self._stopped.wait(0.1)
+    
+    def stop(self):
+        """停止加载动画"""
+        if not self.loading:
+            return
+        with tracer.span("loading_animation", phase="stop"):
+            self.loading = False
+            self._stopped.set()
+            self.thread.join(timeout=0.2)
+            print("\r" + " " * 50 + "\r", end="", flush=True)
+
+class ToolScheduler:
+    """工具调用调度器：只读工具在有界并发下并行执行，修改类工具按路径冲突串行化，结果保持原顺序"""
+    
+    def __init__(self, tool_executor: ToolExecutor, max_parallel: int = 8):
+        self.tool_executor = tool_executor
+        self.max_parallel = max_parallel
+        self._path_params = {}
+    
+    async def run(self, calls: List[Tuple], on_start: Callable = None, on_done: Callable = None) -> List[str]:
+        """执行一组工具调用
+        
+        calls: [(name, arguments, prefetched_task_or_None), ...]
+        返回与calls顺序一致的结果列表
+        """
+        results = [None] * len(calls)
+        semaphore = asyncio.Semaphore(self.max_parallel)
+        
+        async def execute(index):
+            name, arguments, prefetched = calls[index]
+            if on_start:
+                on_start(name, arguments)
+            with tracer.span("tool", tool=name, prefetched=prefetched is not None):
+                if prefetched is not None:
+                    result = await prefetched
+                else:
+                    async with semaphore:
+                        result = await self.tool_executor.aexecute_tool(name, arguments)
+            results[index] = result
+            if on_done:
+                on_done(name, result)
+        
+        # 屏障类工具（如change_directory）会改变后续调用的路径解析，因此按屏障分段规划
+        segment = []
+        for index, (name, arguments, _) in enumerate(calls):
+            if self._classify(name, arguments)[0] == "barrier":
+                await self._run_segment(segment, calls, execute)
+                segment = []
+                await execute(index)
+            else:
+                segment.append(index)
+        await self._run_segment(segment, calls, execute)
+        return results
+    
+    async def _run_segment(self, segment: List[int], calls: List[Tuple], execute: Callable):
+        """按冲突关系执行：每个调用只等待与它冲突的前序调用，其余并行"""
+        if not segment:
+            return
+        
+        planned = []  # (task, kind, paths)
+        
+        async def execute_after(index, dependencies):
+            if dependencies:
+                await asyncio.gather(*dependencies)
+            await execute(index)
+        
+        for index in segment:
+            name, arguments, _ = calls[index]
+            kind, paths = self._classify(name, arguments)
+            dependencies = [task for task, other_kind, other_paths in planned
+                            if self._conflicts(kind, paths, other_kind, other_paths)]
+            task = asyncio.ensure_future(execute_after(index, dependencies))
+            planned.append((task, kind, paths))
+        
+        await asyncio.gather(*(task for task, _, _ in planned))
+    
+    def _classify(self, name: str, arguments) -> Tuple[str, List[str]]:
+        """返回 (类型, 涉及的路径)，类型为 read / write / barrier"""
+        if not isinstance(arguments, dict):
+            return "read", []
+        if name in ToolExecutor.READ_ONLY_TOOLS:
+            return "read", self._paths(name, arguments)
+        if name in ToolExecutor.PATH_MUTATING_TOOLS:
+            # 写操作的源路径也参与冲突检查（例如copy_file读源文件）
+            return "write", self._paths(name, arguments)
+        return "barrier", []
+    
+    def _paths(self, name: str, arguments: Dict) -> List[str]:
+        """提取并标准化调用涉及的路径，包含未显式传入的默认路径参数"""
+        params = self._path_params.get(name)
+        if params is None:
+            params = {}
+            function = self.tool_executor.available_functions.get(name)
+            if function is not None:
+                for param in inspect.signature(function).parameters.values():
+                    if 'path' in param.name or 'dir' in param.name or 'file' in param.name:
+                        default = param.default if param.default is not inspect.Parameter.empty else None
+                        params[param.name] = default
+            self._path_params[name] = params
+        
+        paths = []
+        for key, default in params.items():
+            value = arguments.get(key, default)
+            values = value if isinstance(value, list) else [value]
+            for item in values:
+                if isinstance(item, str) and item:
+                    try:
+                        paths.append(os.path.normcase(self.tool_executor._normalize_path(item)).rstrip(os.sep))
+                    except Exception:
+                        continue
+        return paths
+    
+    @staticmethod
+    def _conflicts(kind: str, paths: List[str], other_kind: str, other_paths: List[str]) -> bool:
+        """两个调用是否冲突：至少一个是写操作且路径存在包含关系"""
+        if kind == "read" and other_kind == "read":
+            return False
+        for a in paths:
+            for b in other_paths:
+                if a == b or a.startswith(b + os.sep) or b.startswith(a + os.sep):
+                    return True
+        return False
+
+
+class ContextWindowManager:
+    """上下文窗口管理：按估算的token预算保留系统提示和最近几轮对话，更早的轮次折叠为摘要
+    
+    摘要附加在系统消息末尾（SUMMARY_PREFIX之后），不单独插入一条用户消息，避免出现连续的用户消息。
+    """
+    
+    SUMMARY_PREFIX = "【早前对话摘要】"
+    
+    def __init__(self, max_tokens: int = 16000, keep_recent_turns: int = 3,
+                 max_summary_lines: int = 20, summary_chars: int = 60):
+        self.max_tokens = max_tokens
+        self.keep_recent_turns = keep_recent_turns
+        self.max_summary_lines = max_summary_lines
+        self.summary_chars = summary_chars
+        self._token_cache = {}
+        self.stats = {
+            "requests": 0,
+            "last_bytes": 0,
+            "total_bytes": 0,
+            "max_bytes": 0,
+            "last_tokens": 0,
+            "evicted_turns": 0,
+            "truncated_messages": 0,
+        }
+    
+    @staticmethod
+    def estimate_tokens(text: str) -> int:
+        """估算token数：中文约1字1个token，其余约4个字符1个token"""
+        chars = len(text)
+        wide = (len(text.encode('utf-8')) - chars) // 2
+        return wide + (chars - wide) // 4 + 1
+    
+    def message_tokens(self, message: Dict) -> int:
+        """单条消息的估算token数（带缓存）"""
+        cached = self._token_cache.get(id(message))
+        if cached is not None and cached[0] is message:
+            return cached[1]
+        tokens = self.estimate_tokens(message.get("content") or "") + 4
+        self._token_cache[id(message)] = (message, tokens)
+        return tokens
+    
+    def split_summary(self, system: Dict) -> Tuple[str, List[str]]:
+        """把系统消息拆成 (原始提示词, 摘要行)"""
+        content = system.get("content") or ""
+        base, marker, summary = content.partition("\n\n" + self.SUMMARY_PREFIX)
+        return base, (summary.strip().split("\n") if marker and summary.strip() else [])
+    
+    def with_summary(self, system: Dict, summary_lines: List[str]) -> Dict:
+        """返回附加了摘要的系统消息（摘要为空时去掉旧摘要）；内容不变时返回原对象"""
+        base, _ = self.split_summary(system)
+        content = base + ("\n\n" + self.SUMMARY_PREFIX + "\n" + "\n".join(summary_lines) if summary_lines else "")
+        return system if content == system.get("content") else dict(system, content=content)
+    
+    def compact(self, messages: List[Dict]) -> List[Dict]:
+        """返回符合预算的消息列表，并记录本次请求的统计"""
+        system = messages[:1] if messages and messages[0].get("role") == "system" else []
+        rest = messages[len(system):]
+        
+        summary_lines = self.split_summary(system[0])[1] if system else []
+        # 旧版本把摘要作为第一条用户消息保存，恢复旧会话时并入系统消息
+        if rest and rest[0].get("role") == "user" and rest[0].get("content", "").startswith(self.SUMMARY_PREFIX):
+            summary_lines = rest[0]["content"][len(self.SUMMARY_PREFIX):].strip().split("\n")
+            rest = rest[1:]
+        
+        # 以助手的最终回复作为一轮对话的结尾
+        turns, current = [], []
+        for message in rest:
+            current.append(message)
+            if message.get("role") == "assistant":
+                turns.append(current)
+                current = []
+        if current:
+            turns.append(current)
+        
+        # 系统消息按去掉旧摘要后的内容计算，摘要单独计入
+        base = [self.with_summary(system[0], [])] if system else []
+        
+        def total(summary, kept):
+            tokens = sum(self.message_tokens(m) for m in base)
+            if summary:
+                tokens += self.estimate_tokens("\n".join(summary)) + 4
+            return tokens + sum(self.message_tokens(m) for turn in kept for m in turn)
+        
+        keep_from = max(0, len(turns) - self.keep_recent_turns - (1 if current else 0))
+        for turn in turns[:keep_from]:
+            summary_lines.append(self._summarize_turn(turn))
+        self.stats["evicted_turns"] += keep_from
+        turns = turns[keep_from:]
+        
+        # 超出预算时继续折叠最旧的轮次，至少保留当前轮
+        while len(turns) > 1 and total(summary_lines[-self.max_summary_lines:], turns) > self.max_tokens:
+            summary_lines.append(self._summarize_turn(turns.pop(0)))
+            self.stats["evicted_turns"] += 1
+        summary_lines = summary_lines[-self.max_summary_lines:]
+        
+        kept = [m for turn in turns for m in turn]
+        # 仍然超出预算时从最大的消息开始截断（如超长的工具结果）
+        overflow = total(summary_lines, [kept]) - self.max_tokens
+        if overflow > 0:
+            for index in sorted(range(len(kept)), key=lambda i: -self.message_tokens(kept[i])):
+                if overflow <= 0:
+                    break
+                before = self.message_tokens(kept[index])
+                truncated = self._truncate(kept[index], max(200, before - overflow - 20))
+                if truncated is not kept[index]:
+                    kept[index] = truncated
+                    overflow -= before - self.message_tokens(truncated)
+                    self.stats["truncated_messages"] += 1
+        
+        result = [self.with_summary(system[0], summary_lines)] if system else []
+        result.extend(kept)
+        
+        live = {id(m) for m in result}
+        self._token_cache = {k: v for k, v in self._token_cache.items() if k in live}
+        self._record(result)
+        return result
+    
+    def _summarize_turn(self, turn: List[Dict]) -> str:
+        """把一轮对话压缩成一行摘要"""
+        user_text = turn[0].get("content", "") if turn else ""
+        reply = ""
+        if turn and turn[-1].get("role") == "assistant":
+            reply = turn[-1].get("content", "")
+            try:
+                reply = json.loads(reply).get("response", reply)
+            except (json.JSONDecodeError, AttributeError):
+                pass
+        line = f"用户: {user_text[:self.summary_chars]}"
+        if reply:
+            line += f" / 小狸: {str(reply)[:self.summary_chars]}"
+        return line.replace("\n", " ")
+    
+    def _truncate(self, message: Dict, max_tokens: int) -> Dict:
+        """保留消息内容的开头和结尾"""
+        content = message.get("content") or ""
+        keep = max(100, int(len(content) * max_tokens / max(1, self.message_tokens(message))))
+        if keep >= len(content):
+            return message
+        half = keep // 2
+        omitted = len(content) - 2 * half
+        return dict(message, content=f"{content[:half]}\n...（已省略{omitted}个字符）...\n{content[-half:]}")
+    
+    def _record(self, messages: List[Dict]):
+        """记录本次请求的大小统计"""
+        size = len(SparkX1Client.encode_payload(messages))
+        self.stats["requests"] += 1
+        self.stats["last_bytes"] = size
+        self.stats["total_bytes"] += size
+        self.stats["max_bytes"] = max(self.stats["max_bytes"], size)
+        self.stats["last_tokens"] = sum(self.message_tokens(m) for m in messages)
+        self.stats["avg_bytes"] = self.stats["total_bytes"] // self.stats["requests"]
+
+
+class SessionJournal:
+    """会话消息的只追加压缩日志
+    
+    <id>.journal 中每条记录为 4字节长度 + zlib压缩的JSON：{"op": "append", "message": ...} 追加一条消息，
+    {"op": "reset", "messages": [...]} 用新列表替换历史（清空、回退时写入），
+    {"op": "splice", "drop": n, "head": [...]} 把最前面的n条消息换成head（上下文压缩时写入，只记录变化的部分）。
+    系统提示词不写入日志；reset和splice带有当时的压缩摘要行（"summary"），load后保存在summary属性中。<id>.idx 为定长索引，每轮结束和每次reset各记一条 (类型, 轮次, 偏移)，
+    恢复会话或跳到第N轮时只需从最近的reset读到目标位置，不必解析整个日志；
+    距上次reset超过snapshot_every条记录时，下一次压缩写完整快照，限制恢复时需要重放的长度。
+    日志和索引文件在首次写入时打开并一直保持，不再每条记录重新打开。
+    打开时若最后一条记录写入不完整（进程崩溃），把日志截断到最后一条完整记录，并删除指向其后的索引，
+    之后的追加才能被读到。
+    """
+    
+    _RECORD_HEADER = struct.Struct("<I")
+    _INDEX_ENTRY = struct.Struct("<BIQ")
+    TURN_END, RESET = 0, 1
+    
+    def __init__(self, directory: str, session_id: str, snapshot_every: int = 32):
+        os.makedirs(directory, exist_ok=True)
+        stem = self._stem(directory, session_id)
+        self.journal_path = stem + ".journal"
+        self.index_path = stem + ".idx"
+        self.snapshot_every = snapshot_every
+        self.summary: List[str] = []
+        self._size = os.path.getsize(self.journal_path) if os.path.exists(self.journal_path) else 0
+        self._journal_file = None
+        self._index_file = None
+        entries = self._repair()
+        # 清空或回退后轮次会变小，以最后一条索引为准
+        self.turns = entries[-1][1] if entries else 0
+        last_reset = max((offset for kind, _, offset in entries if kind == self.RESET), default=0)
+        self._since_reset = sum(1 for _ in self._read_records(last_reset, self._size))
+    
+    @staticmethod
+    def _stem(directory: str, session_id: str) -> str:
+        """日志文件名：安全的会话ID直接使用，其余取哈希"""
+        name = session_id if re.fullmatch(r"[A-Za-z0-9_-]{1,64}", session_id) else \
+            hashlib.sha256(session_id.encode("utf-8")).hexdigest()[:32]
+        return os.path.join(directory, name)
+    
+    @classmethod
+    def exists(cls, directory: str, session_id: str) -> bool:
+        return os.path.exists(cls._stem(directory, session_id) + ".journal")
+    
+    def append(self, message: Dict):
+        """追加一条消息；助手消息表示一轮结束"""
+        self._write({"op": "append", "message": message})
+        if message.get("role") == "assistant":
+            self.turns += 1
+            self._write_index(self.TURN_END, self.turns, self._size)
+    
+    def reset(self, messages: List[Dict], turns: Optional[int] = None, summary: Optional[List[str]] = None):
+        """记录历史被整体替换；turns为替换后的轮次（清空或回退时），之后的轮次从它继续编号"""
+        if turns is not None:
+            self.turns = turns
+        self._write_index(self.RESET, self.turns, self._size)
+        self._write({"op": "reset", "messages": messages, "summary": summary or []})
+        self._since_reset = 1
+    
+    def splice(self, drop: int, head: List[Dict], messages: List[Dict], summary: Optional[List[str]] = None):
+        """记录最前面的drop条消息被替换为head，messages为替换后的完整列表（需要写快照时使用）"""
+        if self._since_reset >= self.snapshot_every:
+            self.reset(messages, summary=summary)
+        else:
+            self._write({"op": "splice", "drop": drop, "head": head, "summary": summary or []})
+    
+    def close(self):
+        for f in (self._journal_file, self._index_file):
+            if f is not None:
+                f.close()
+        self._journal_file = self._index_file = None
+    
+    def load(self, turn: Optional[int] = None) -> List[Dict]:
+        """读取最新的消息列表；指定turn时返回第turn轮结束时的消息列表"""
+        entries = self._read_index()
+        end = self._size
+        if turn is not None:
+            ends = [offset for kind, number, offset in entries if kind == self.TURN_END and number == turn]
+            if turn == 0:
+                end = 0
+            elif not ends:
+                raise ValueError(f"会话日志中没有第 {turn} 轮")
             else:
-                url = "https://www.google.com/search?q=天气"
-            
-            webbrowser.open(url)
-            return f"已在浏览器中打开天气信息{f' for {city}' if city else ''}"
-        except Exception as e:
-            return f"获取天气信息失败: {str(e)}"
+                end = ends[-1]
+        start = max((offset for kind, _, offset in entries if kind == self.RESET and offset < end), default=0)
+        
+        messages = []
+        self.summary = []
+        for record in self._read_records(start, end):
+            if record.get("op") == "reset":
+                messages = list(record.get("messages") or [])
+                self.summary = list(record.get("summary") or [])
+            elif record.get("op") == "append":
+                messages.append(record["message"])
+            elif record.get("op") == "splice":
+                messages[:record.get("drop", 0)] = record.get("head") or []
+                self.summary = list(record.get("summary") or [])
+        return messages
     
-    def translate_text(self, text: str, target_lang: str = "en") -> str:
-        """翻译文本（通过打开翻译网站）"""
+    def _write(self, record: Dict):
+        data = zlib.compress(json.dumps(record, ensure_ascii=False, separators=(',', ':')).encode("utf-8"))
+        if self._journal_file is None:
+            self._journal_file = open(self.journal_path, "ab")
+        self._journal_file.write(self._RECORD_HEADER.pack(len(data)) + data)
+        self._journal_file.flush()
+        self._size += self._RECORD_HEADER.size + len(data)
+        self._since_reset += 1
+    
+    def _write_index(self, kind: int, turn: int, offset: int):
+        if self._index_file is None:
+            self._index_file = open(self.index_path, "ab")
+        self._index_file.write(self._INDEX_ENTRY.pack(kind, turn, offset))
+        self._index_file.flush()
+    
+    def _repair(self) -> List[Tuple[int, int, int]]:
+        """截掉日志末尾不完整的记录和多余的索引，返回有效的索引项"""
+        entries = self._read_index()
+        # 索引项的偏移都在完整记录的边界上，从最后一个开始校验即可；该处已无法解析时从头校验
+        start = max((offset for _, _, offset in entries), default=0)
+        valid = start
+        for valid, _ in self._iter_records(start, self._size):
+            pass
+        if valid == start and start < self._size and start:
+            valid = 0
+            for valid, _ in self._iter_records(0, self._size):
+                pass
+        if valid < self._size:
+            with open(self.journal_path, "r+b") as f:
+                f.truncate(valid)
+            self._size = valid
+        
+        size = self._INDEX_ENTRY.size
+        # reset的索引项指向reset记录的开头，记录没写完时一并删除；轮次结束项指向记录末尾
+        kept = [entry for entry in entries if entry[2] < valid or (entry[0] == self.TURN_END and entry[2] == valid)]
+        index_size = os.path.getsize(self.index_path) if os.path.exists(self.index_path) else 0
+        if index_size != len(kept) * size:
+            with open(self.index_path, "wb") as f:
+                f.write(b"".join(self._INDEX_ENTRY.pack(*entry) for entry in kept))
+        return kept
+    
+    def _read_index(self) -> List[Tuple[int, int, int]]:
         try:
-            url = f"https://translate.google.com/?sl=auto&tl={target_lang}&text={urllib.parse.quote(text)}"
-            webbrowser.open(url)
-            return f"已在浏览器中打开翻译: {text} -> {target_lang}"
-        except Exception as e:
-            return f"翻译失败: {str(e)}"
+            with open(self.index_path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return []
+        size = self._INDEX_ENTRY.size
+        entries = [self._INDEX_ENTRY.unpack_from(data, i) for i in range(0, len(data) - size + 1, size)]
+        # 写入中断时索引可能指向日志末尾之后
+        return [entry for entry in entries if entry[2] <= self._size]
     
-    def execute_tool(self, function_name: str, function_args: Dict) -> str:
-        """执行工具函数"""
-        if function_name in self.available_functions:
+    def _read_records(self, start: int, end: int) -> Iterator[Dict]:
+        for _, record in self._iter_records(start, end):
+            yield record
+    
+    def _iter_records(self, start: int, end: int) -> Iterator[Tuple[int, Dict]]:
+        """产出 (记录结束偏移, 记录)，遇到不完整或损坏的记录时停止"""
+        if end <= start:
+            return
+        with open(self.journal_path, "rb") as f:
+            f.seek(start)
+            position = start
+            header = self._RECORD_HEADER.size
+            while position < end:
+                raw = f.read(header)
+                if len(raw) < header:
+                    return
+                length, = self._RECORD_HEADER.unpack(raw)
+                data = f.read(length)
+                if len(data) < length:
+                    return  # 最后一条记录写入不完整
+                position += header + length
+                try:
+                    record = json.loads(zlib.decompress(data))
+                except (zlib.error, ValueError):
+                    return
+                yield position, record
+
+
+class Live2DChannel:
+    """到Live2D桌面宠物（127.0.0.1:12345）的消息通道
+    
+    消息放入队列后由后台线程发送，调用方不会被阻塞。宠物每个连接只读一次，
+    所以每条消息仍然单独连接、发送、关闭（与原来的格式相同）。发送失败后按指数退避重试；
+    连续失败failure_threshold次后熔断open_seconds秒，期间的消息直接丢弃。
+    stop会取代队列中尚未发送的朗读消息，连续的stop只保留一条。
+    """
+    
+    def __init__(self, host: str = "127.0.0.1", port: int = 12345, connect_timeout: float = 2,
+                 max_queue: int = 32, backoff_base: float = 0.5, backoff_max: float = 10,
+                 failure_threshold: int = 3, open_seconds: float = 15):
+        self.host = host
+        self.port = port
+        self.connect_timeout = connect_timeout
+        self.max_queue = max_queue
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self._queue = deque()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._closed = False
+        self._closing = threading.Event()
+        self._failures = 0
+        self._open_until = 0.0
+        self._stats = {"sent": 0, "dropped": 0, "superseded": 0, "connects": 0, "failures": 0}
+    
+    def speak(self, text: str, actions: List[str] = None) -> bool:
+        """朗读文本并执行动作"""
+        return self._enqueue({"type": "speak_and_action", "text": text, "actions": actions or []})
+    
+    def stop(self) -> bool:
+        """打断朗读：丢弃队列中还没发出的朗读消息"""
+        with self._condition:
+            superseded = len(self._queue)
+            self._stats["superseded"] += superseded
+            self._queue.clear()
+        return self._enqueue({"type": "stop"})
+    
+    def _enqueue(self, message: Dict) -> bool:
+        with self._condition:
+            if self._closed or self._breaker_open():
+                self._stats["dropped"] += 1
+                return False
+            if len(self._queue) >= self.max_queue:
+                self._queue.popleft()
+                self._stats["dropped"] += 1
+            self._queue.append(message)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="xiaoli-live2d", daemon=True)
+                self._thread.start()
+            self._condition.notify()
+        return True
+    
+    def _breaker_open(self) -> bool:
+        return time.monotonic() < self._open_until
+    
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._queue and not self._closed:
+                    self._condition.wait()
+                if not self._queue:
+                    return
+                message = self._queue[0]
+            
+            data = json.dumps(message).encode('utf-8')
+            live2d_span = tracer.span("live2d", kind=message["type"])
             try:
-                # 对路径参数进行标准化
-                for key, value in function_args.items():
-                    if isinstance(value, str) and ('path' in key or 'dir' in key or 'file' in key):
-                        function_args[key] = self._normalize_path(value)
-                
-                return self.available_functions[function_name](**function_args)
-            except Exception as e:
-                return f"工具执行错误: {str(e)}"
-        return f"错误：未知的工具 {function_name}"
+                self._send(data)
+            except OSError as e:
+                live2d_span.finish(error=type(e).__name__)
+                self._on_failure()
+                continue
+            live2d_span.finish()
+            
+            self._failures = 0
+            with self._condition:
+                self._stats["sent"] += 1
+                if self._queue and self._queue[0] is message:
+                    self._queue.popleft()
+    
+    def _send(self, data: bytes):
+        with socket.create_connection((self.host, self.port), timeout=self.connect_timeout) as sock:
+            with self._condition:
+                self._stats["connects"] += 1
+            sock.sendall(data)
+    
+    def _on_failure(self):
+        """连接或发送失败：退避后重试，失败次数过多则熔断并丢弃队列"""
+        self._failures += 1
+        with self._condition:
+            self._stats["failures"] += 1
+            if self._failures >= self.failure_threshold:
+                self._open_until = time.monotonic() + self.open_seconds
+                self._stats["dropped"] += len(self._queue)
+                self._queue.clear()
+                return
+        delay = min(self.backoff_max, self.backoff_base * (2 ** (self._failures - 1)))
+        self._closing.wait(delay * random.uniform(0.5, 1.0))
+    
+    def stats(self) -> Dict:
+        with self._condition:
+            stats = dict(self._stats)
+            stats["queued"] = len(self._queue)
+        stats["breaker_open"] = self._breaker_open()
+        return stats
+    
+    def close(self, timeout: float = 0.5):
+        """等待队列发送完（最多timeout秒）后停止后台线程"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._closing.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
 
-class LoadingAnimation:
-    """加载动画类"""
+
+live2d_channel = Live2DChannel()
+atexit.register(live2d_channel.close)
+
+
+class IntentRouter:
+    """本地意图路由：简单请求（几点了、内存多少、CPU使用率等）直接调用工具并用模板回复，不请求大模型
     
-    def __init__(self):
-        self.loading = False
-        self.frames = ['/', '-', '\\', '|']
-        self.current_frame = 0
+    输入先去掉礼貌用语、语气词和空白，再用预编译的正则匹配；置信度为匹配部分占输入的比例，
+    不高于threshold、包含"顺便""然后"等复合请求的连接词、带有删除/移动/打开等操作动词或地点限定
+    （"纽约几点了"）时交给大模型处理。
+    """
     
-    def start(self, message="小狸思考中"):
-        """开始显示加载动画"""
-        self.loading = True
-        self.thread = threading.Thread(target=self._animate, args=(message,))
-        self.thread.daemon = True
-        self.thread.start()
+    # 每条规则：意图名、工具、正则、参数（字符串值可引用命名分组）、回复模板；
+    # 可选的require/reject在原始输入上检查，分别为必须出现/不能出现的内容
+    RULES = [
+        {"intent": "time", "tool": "get_current_time", "args": {},
+         "patterns": [r"(现在|当前)?(是)?(几点了?|几点钟|时间|的时间|什么时间|几号|日期|星期几)(是)?",
+                      r"(?<![a-z])(whattimeisit|what'?sthetime|currenttime|timenow)(?![a-z])"],
+         "template": "小狸看了一眼时钟~ {result}"},
+        {"intent": "memory", "tool": "get_memory_info", "args": {},
+         "patterns": [r"(电脑|系统|当前)?(的)?内存(使用|占用|用量|使用率|占用率|情况|信息|剩余|还剩|够不够用?)*",
+                      r"(?<![a-z])(howmuch)?(free)?(memory|ram)(usage|left|info)?(?![a-z])"],
+         "template": "小狸帮你看了内存情况喵~\n{result}"},
+        {"intent": "cpu", "tool": "get_cpu_info", "args": {},
+         "patterns": [r"(电脑|系统|当前)?(的)?(cpu|处理器)(使用率|占用率?|使用|情况|信息|负载|核心数?)*",
+                      r"(?<![a-z])(cpu|processor)(usage|load|info)?(?![a-z])"],
+         "template": "小狸帮你看了CPU情况喵~\n{result}"},
+        {"intent": "disk", "tool": "get_disk_usage", "args": {},
+         "patterns": [r"(电脑|系统|当前)?(的)?(磁盘|硬盘)(空间)?(使用|占用|用量|使用率|情况|剩余|还剩|信息)*(空间)?",
+                      r"(?<![a-z])disk(usage|space|free)?(?![a-z])"],
+         "template": "小狸帮你看了磁盘空间喵~\n{result}"},
+        {"intent": "system", "tool": "get_system_info", "args": {},
+         "patterns": [r"(电脑|系统|本机|机器)(的)?(信息|配置|版本)", r"(?<![a-z])systeminfo(rmation)?(?![a-z])"],
+         "template": "这是你电脑的系统信息喵~\n{result}"},
+        {"intent": "desktop", "tool": "list_directory", "args": {"directory_path": "~/Desktop"},
+         "patterns": [r"(列出|显示|看)?桌面(上)?(的)?(有什么|有哪些|有啥|文件|内容|东西)*",
+                      r"(?<![a-z])(list|show)(the|my)?desktop(files)?(?![a-z])"],
+         "template": "桌面上有这些东西喵~\n{result}"},
+        {"intent": "list_directory", "tool": "list_directory", "args": {"directory_path": "."},
+         "patterns": [r"(列出|显示|看)?(当前|这个)?(目录|文件夹)(下|里|中)?(的)?(有什么|有哪些|有啥|文件|内容)+",
+                      r"(?<![a-z])(ls|dir|list(the)?(current)?(directory|files))(?![a-z])"],
+         "template": "当前目录里有这些喵~\n{result}"},
+        {"intent": "cwd", "tool": "get_current_directory", "args": {},
+         "patterns": [r"(当前|现在)?(所在)?(的)?(工作)?目录(是|在)?(哪|哪里|哪儿|什么)?",
+                      r"(?<![a-z])(pwd|currentdirectory|whereami)(?![a-z])"],
+         "template": "{result}喵~"},
+        {"intent": "ip", "tool": "get_ip_address", "args": {},
+         "patterns": [r"(我的|本机|电脑)?(的)?ip(地址)?(是什么|是)?", r"(?<![a-z])(my)?ip(address)?(?![a-z])"],
+         "template": "小狸查到啦~\n{result}"},
+        {"intent": "internet", "tool": "check_internet_connection", "args": {},
+         "patterns": [r"(检查|测试)?(网络|网|互联网)(连接)?(正常|通|好|连上|能用|断)?(了)?(没有|不|没|是否正常)?",
+                      r"(?<![a-z])(amionline|internetconnection|check(the)?internet)(?![a-z])"],
+         "template": "{result}喵~"},
+        {"intent": "calculate", "tool": "calculate", "args": {"expression": "{expr}"},
+         "patterns": [r"(计算|算|算算)?(?P<expr>[\d\s.+\-*/()]*\d[\s.]*[+\-*/][\s\d.+\-*/()]*\d[\s)]*)(等于|是|=)?(多少|几)?",
+                      r"(calculate|compute|whatis)?(?P<expr>[\d\s.+\-*/()]*\d[\s.]*[+\-*/][\s\d.+\-*/()]*\d[\s)]*)"],
+         # 必须有计算动词或等号，日期（2024-10-18）和电话号码（138-1234-5678）不是算式
+         "require": r"(计算|算|等于|=|多少|calculate|compute|what\s*is|what's)",
+         "reject": r"\d{4}[-/]\d{1,2}[-/]\d{1,2}|\d{3}-\d{3,4}-\d{4}",
+         "template": "小狸算好啦~ {result}"},
+    ]
     
-    def _animate(self, message):
-        """动画线程"""
-        while self.loading:
-            frame = self.frames[self.current_frame % len(self.frames)]
-            print(f"\r{message} {frame}", end="", flush=True)
-            self.current_frame += 1
-            time.sleep(0.1)
+    # 去掉的礼貌用语、语气词和标点
+    _FILLER = re.compile(r"(请问|请|麻烦|帮我|帮忙|给我|告诉我|我想知道|想知道|查一下|查查|看一下|看看|一下|小狸|"
+                         r"please|can you|could you|tell me|show me|\bme\b|"
+                         r"怎么样|如何|有多少|是多少|多少|吗|呢|呀|啊|吧|喵|哦|嘛|呗|[?？!！。，,.~～\s])+", re.IGNORECASE)
+    # 复合请求的连接词，出现时交给大模型
+    _COMPOUND = re.compile(r"(顺便|然后|并且|同时|之后|再帮|还有|以及|\band\b|\bthen\b)", re.IGNORECASE)
+    # 操作动词和地点限定：路由的工具只能查看本机当前状态，这类请求交给大模型
+    _VETO = re.compile(r"(删|移动|复制|拷贝|重命名|改名|创建|新建|打开|关闭|修改|编辑|写入|"
+                       r"北京|上海|纽约|伦敦|东京|巴黎|时区|当地|"
+                       r"\b(delete|remove|move|copy|rename|create|open|close|edit|write|in|at)\b)", re.IGNORECASE)
+    _OPERATORS = str.maketrans({"×": "*", "÷": "/", "（": "(", "）": ")", "＋": "+", "－": "-"})
+    _TIMES = re.compile(r"(?<=\d)\s*[xX]\s*(?=\d)")
     
-    def stop(self):
-        """停止加载动画"""
-        self.loading = False
-        time.sleep(0.2)
-        print("\r" + " " * 50 + "\r", end="", flush=True)
+    def __init__(self, threshold: float = 0.75, max_chars: int = 40):
+        self.threshold = threshold
+        self.max_chars = max_chars
+        self._rules = [(rule, [re.compile(p, re.IGNORECASE) for p in rule["patterns"]],
+                        re.compile(rule["require"], re.IGNORECASE) if "require" in rule else None,
+                        re.compile(rule["reject"]) if "reject" in rule else None) for rule in self.RULES]
+        self.stats = {"checked": 0, "routed": 0}
+    
+    def normalize(self, text: str) -> str:
+        text = self._TIMES.sub("*", text.translate(self._OPERATORS))
+        return self._FILLER.sub("", text).lower()
+    
+    def match(self, text: str) -> Optional[Dict]:
+        """返回 {"intent", "tool", "args", "template", "confidence"}；不够确定时返回None"""
+        self.stats["checked"] += 1
+        if not text or len(text) > self.max_chars or self._COMPOUND.search(text) or self._VETO.search(text):
+            return None
+        normalized = self.normalize(text)
+        if not normalized:
+            return None
+        
+        best = None
+        for rule, patterns, require, reject in self._rules:
+            if (require and not require.search(text)) or (reject and reject.search(text)):
+                continue
+            for pattern in patterns:
+                for found in pattern.finditer(normalized):
+                    confidence = (found.end() - found.start()) / len(normalized)
+                    if best is None or confidence > best[0]:
+                        best = (confidence, rule, found)
+        if best is None or best[0] <= self.threshold:
+            return None
+        
+        confidence, rule, found = best
+        groups = {key: (value or "").strip() for key, value in found.groupdict().items()}
+        args = {key: value.format(**groups) if isinstance(value, str) else value for key, value in rule["args"].items()}
+        self.stats["routed"] += 1
+        return {"intent": rule["intent"], "tool": rule["tool"], "args": args, "template": rule["template"],
+                "confidence": round(confidence, 3)}
+
 
 class XiaoLiAgent:
     """小狸AI助手主类"""
     
-    def __init__(self, api_password: str):
-        self.client = SparkX1Client(api_password)
-        self.tool_executor = ToolExecutor()
+    def __init__(self, api_password: str, stream: bool = True, client: Optional[SparkX1Client] = None,
+                 tool_executor: Optional[ToolExecutor] = None, upstream: Optional[UpstreamScheduler] = None,
+                 session_key: str = "default", journal: Optional[SessionJournal] = None,
+                 router: Optional[IntentRouter] = None, use_router: bool = True):
+        self.client = client or SparkX1Client(api_password)
+        # 多会话共享的上游调度器（可选），session_key用于公平调度
+        self.upstream = upstream
+        self.session_key = session_key
+        # 会话日志（可选）：消息变化都会写入，重启后可恢复
+        self.journal = journal
+        self.tool_executor = tool_executor or ToolExecutor()
+        self.tool_scheduler = ToolScheduler(self.tool_executor)
+        self.context_manager = ContextWindowManager()
+        # 本地意图路由：简单请求不经过大模型
+        self.router = (router or IntentRouter()) if use_router else None
         self.loading_animation = LoadingAnimation()
+        self.stream = stream
+        # 流式模式下response字段的增量回调，参数为新到达的文本
+        self.on_response_delta: Optional[Callable[[str], None]] = None
+        # 进度回调：思考内容、工具开始/结束等事件，参数为事件字典
+        self.on_progress: Optional[Callable[[Dict], None]] = None
+        self._spoken = False
+        # 同步入口使用的私有事件循环
+        self._loop = None
         self.messages = [
             {
                 "role": "system", 
@@ -996,8 +4150,8 @@ class XiaoLiAgent:
 
 ### 文件操作工具
 - create_file: 创建文件 {"file_path": "路径", "content": "内容"}
-- read_file: 读取文件 {"file_path": "路径"}
-- list_directory: 列出目录 {"directory_path": "路径"}
+- read_file: 读取文件 {"file_path": "路径"}，可选 "start_line"/"end_line" 行范围、"head"/"tail" 开头或末尾行数、"offset"/"length" 字节范围
+- list_directory: 列出目录 {"directory_path": "路径", "sort_by": "type/name/size/mtime（可选）", "reverse": 可选是否倒序, "offset": 可选起始位置, "limit": 可选条数（默认200）}
 - delete_file: 删除文件 {"file_path": "路径"}
 - copy_file: 复制文件 {"source_path": "源路径", "destination_path": "目标路径"}
 - move_file: 移动文件 {"source_path": "源路径", "destination_path": "目标路径"}
@@ -1005,7 +4159,7 @@ class XiaoLiAgent:
 - file_exists: 检查文件存在 {"file_path": "路径"}
 - directory_exists: 检查目录存在 {"directory_path": "路径"}
 - get_file_info: 获取文件信息 {"file_path": "路径"}
-- search_files: 搜索文件 {"search_pattern": "模式", "search_path": "路径"}
+- search_files: 搜索文件 {"search_pattern": "模式（如*.py、src/**/*.md）", "search_path": "路径", "max_depth": 可选的最大目录深度, "include_excluded": 可选，为true时也搜索.git、node_modules、虚拟环境等默认跳过的目录}
 - get_file_size: 获取文件大小 {"file_path": "路径"}
 - compress_files: 压缩文件 {"files": ["文件列表"], "output_path": "输出路径"}
 - extract_files: 解压文件 {"archive_path": "压缩文件路径", "output_dir": "输出目录"}
@@ -1042,6 +4196,7 @@ class XiaoLiAgent:
 - calculate: 计算 {"expression": "表达式"}
 - get_weather: 获取天气 {"city": "城市"}
 - translate_text: 翻译文本 {"text": "文本", "target_lang": "目标语言"}
+- read_tool_result: 分页读取被截断的工具结果 {"handle": "结果句柄", "offset": 字节偏移, "length": 读取字节数}
 
 ## 📍 路径说明
 - 桌面路径: 使用 "Desktop" 或完整路径
@@ -1051,10 +4206,118 @@ class XiaoLiAgent:
 现在开始帮助用户，请尽量高效地完成任务！"""
             }
         ]
+        if self.journal is not None:
+            self.messages.extend(self.journal.load())
+            self.messages[0] = self.context_manager.with_summary(self.messages[0], self.journal.summary)
+    
+    def _append_message(self, message: Dict):
+        """追加一条消息，同时写入会话日志"""
+        self.messages.append(message)
+        if self.journal is not None:
+            self.journal.append(message)
+    
+    def _replace_messages(self, messages: List[Dict], turns: Optional[int] = None):
+        """整体替换历史（系统提示词保持在第一条）"""
+        self.messages[:] = messages
+        if self.journal is not None:
+            self.journal.reset(self.messages[1:], turns, self.context_manager.split_summary(self.messages[0])[1])
+    
+    def _compact_messages(self, messages: List[Dict]):
+        """替换为压缩后的历史；保留下来的消息仍是原对象，日志只记录被替换的开头部分"""
+        old, new = self.messages[1:], messages[1:]
+        common = 0
+        while common < min(len(old), len(new)) and old[-1 - common] is new[-1 - common]:
+            common += 1
+        self.messages[:] = messages
+        if self.journal is not None:
+            self.journal.splice(len(old) - common, new[:len(new) - common], new,
+                                self.context_manager.split_summary(messages[0])[1])
+    
+    def clear_history(self):
+        """清空对话历史（连同系统消息中的摘要）"""
+        self._replace_messages([self.context_manager.with_summary(self.messages[0], [])], turns=0)
+    
+    def rewind(self, turn: int):
+        """把对话回退到会话日志中第turn轮结束时的状态"""
+        if self.journal is None:
+            raise ValueError("未启用会话日志")
+        messages = self.journal.load(turn)
+        system = self.context_manager.with_summary(self.messages[0], self.journal.summary)
+        self._replace_messages([system] + messages, turns=turn)
+    
+    def process_user_input(self, user_input: str, cancel_token: Optional[CancelToken] = None) -> str:
+        """处理用户输入（同步入口，内部驱动异步实现）"""
+        if self._loop is None or self._loop.is_closed():
+            self._loop = asyncio.new_event_loop()
+        return self._loop.run_until_complete(self.aprocess_user_input(user_input, cancel_token))
+    
+    def close(self):
+        """释放同步入口的事件循环和连接"""
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.run_until_complete(self.client.aclose())
+            self._loop.close()
+        self.client.close()
+        self.tool_executor.close()
+    
+    async def aprocess_user_input(self, user_input: str, cancel_token: Optional[CancelToken] = None) -> str:
+        """处理用户输入；cancel_token被取消时立即中止本轮（HTTP请求、工具子进程、Live2D朗读）"""
+        cancel_token = cancel_token or CancelToken()
+        turn_span = tracer.span("turn").__enter__()
+        iterations = 0
+        
+        # 本轮在子任务中运行，取消时只取消它，不影响调用方的任务
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()
+        context.run(CancelToken._current.set, cancel_token)
+        turn = context.run(loop.create_task, self._run_turn(user_input))
+        cancelled_by_token = []
+        
+        def cancel_turn():
+            cancelled_by_token.append(True)
+            turn.cancel()
+        
+        handle = cancel_token.register(lambda: loop.call_soon_threadsafe(cancel_turn))
+        try:
+            final_response, iterations = await turn
+        except asyncio.CancelledError:
+            # 调用方自身被取消（例如服务器关闭）时照常向上传播
+            if not cancelled_by_token or not turn.cancelled():
+                raise
+            final_response = self._cancel_turn(cancel_token.reason)
+            turn_span.set(cancelled=True)
+        finally:
+            cancel_token.unregister(handle)
+            turn_span.finish(iterations=iterations)
+        return final_response
+    
+    def _cancel_turn(self, reason: str) -> str:
+        """对话被取消后的清理：停止动画和朗读，补上本轮的结尾让历史保持完整"""
+        self.loading_animation.stop()
+        self._stop_live2d_speech()
+        print(f"\n[系统] 本轮对话已取消: {reason}")
+        if self.messages and self.messages[-1].get("role") != "assistant":
+            self._append_message({
+                "role": "assistant",
+                "content": json.dumps({
+                    "thinking": "用户取消了本轮对话",
+                    "action": "final_response",
+                    "response": "（已取消）"
+                })
+            })
+        return json.dumps({
+            "thinking": "用户取消",
+            "action": "final_response",
+            "response": "本轮对话已取消",
+            "cancelled": True
+        })
     
-    def process_user_input(self, user_input: str) -> str:
-        """处理用户输入"""
-        self.messages.append({"role": "user", "content": user_input})
+    async def _run_turn(self, user_input: str) -> Tuple[str, int]:
+        """执行一轮对话的思考-工具循环，返回 (最终响应, 迭代次数)"""
+        self._append_message({"role": "user", "content": user_input})
+        
+        routed = await self._route_locally(user_input)
+        if routed is not None:
+            return routed, 0
         
         iteration = 0
         final_response = None
@@ -1068,12 +4331,25 @@ class XiaoLiAgent:
                 print(f"\033[1;33m{warning_msg}\033[0m")
             
             self.loading_animation.start(f"小狸思考中 (第{iteration}次)")
+            iteration_span = tracer.span("iteration", iteration=iteration).__enter__()
             
             try:
-                response = self.client.send_request(self.messages, stream=False)
+                prefetched = {}
+                self._spoken = False
+                # 发送前按token预算压缩历史
+                with tracer.span("context_compact"):
+                    compacted = self.context_manager.compact(self.messages)
+                    if compacted != self.messages:
+                        self._compact_messages(compacted)
+                async with self._upstream_slot():
+                    if self.stream:
+                        response = await self._stream_completion(prefetched)
+                    else:
+                        with tracer.span("http", stream=False, bytes=self.context_manager.stats["last_bytes"]):
+                            response = await self.client.asend_request(self.messages, stream=False)
                 
                 if "error" in response:
-                    return self._create_error_response(f"API错误: {response['error']}")
+                    return self._create_error_response(f"API错误: {response['error']}"), iteration
                 
                 if "choices" in response and response["choices"]:
                     assistant_message = response["choices"][0].get("message", {})
@@ -1081,22 +4357,23 @@ class XiaoLiAgent:
                     
                     # 检查是否为JSON格式
                     if not content.strip().startswith('{'):
-                        self.messages.append({
+                        self._append_message({
                             "role": "user", 
                             "content": "请严格按照JSON格式返回响应，不要包含其他文本。格式: {\"thinking\": \"...\", \"action\": \"...\", ...}"
                         })
                         continue
                     
                     try:
-                        response_data = json.loads(content)
-                        result = self._process_response(response_data, iteration)
+                        with tracer.span("json_parse", chars=len(content)):
+                            response_data = json.loads(content)
+                        result = await self._process_response(response_data, iteration, prefetched)
                         
                         if not result["continue"]:
                             final_response = json.dumps(result)
                             break
                             
                     except json.JSONDecodeError as e:
-                        self.messages.append({
+                        self._append_message({
                             "role": "user", 
                             "content": f"JSON解析错误，请返回有效的JSON格式。错误: {str(e)}"
                         })
@@ -1105,33 +4382,152 @@ class XiaoLiAgent:
                     final_response = self._create_error_response("API返回格式异常")
                     break
                     
+            except UpstreamBusyError as e:
+                final_response = self._create_error_response(str(e))
+                break
             except Exception as e:
                 final_response = self._create_error_response(f"处理请求时发生错误: {str(e)}")
                 break
             finally:
                 self.loading_animation.stop()
+                iteration_span.finish()
+                for key, value in prefetched.items():
+                    if key != "blocked":
+                        value[2].cancel()
         
-        return final_response
+        return final_response, iteration
+    
+    async def _route_locally(self, user_input: str) -> Optional[str]:
+        """命中本地意图时直接执行工具并按模板回复；未命中或工具出错时返回None交给大模型"""
+        if self.router is None:
+            return None
+        with tracer.span("router") as span:
+            route = self.router.match(user_input)
+            if route is None:
+                span.set(hit=False)
+                return None
+            span.set(hit=True, intent=route["intent"], confidence=route["confidence"])
+        
+        name, arguments = route["tool"], route["args"]
+        print(f"[系统] 本地路由: {route['intent']} -> {name}({arguments})")
+        self._emit_progress({"stage": "tool_start", "iteration": 0, "tool": name,
+                             "arguments": self._preview_arguments(arguments)})
+        try:
+            result = await self.tool_executor.aexecute_tool(name, dict(arguments))
+        except Exception as e:
+            result = f"工具执行错误: {e}"
+        self._emit_progress({"stage": "tool_done", "iteration": 0, "tool": name, "result": self._preview(result)})
+        if self.tool_executor.is_error_result(result):
+            print(f"[系统] 本地路由失败，交给小狸思考: {self._preview(result)}")
+            return None
+        
+        response = route["template"].format(result=result)
+        if self.on_response_delta:
+            self.on_response_delta(response)
+        self._spoken = False
+        result = self._handle_final_response(
+            {"response": response, "actions": self._generate_actions_from_text(response)},
+            f"本地路由: {route['intent']}", 0)
+        return json.dumps(result)
+    
+    def _upstream_slot(self):
+        """上游请求名额：未配置调度器时不做限制"""
+        if self.upstream is None:
+            return contextlib.nullcontext()
+        return self.upstream.slot(self.session_key)
+    
+    async def _stream_completion(self, prefetched: Dict) -> Dict:
+        """流式获取一次回复：边接收边提前执行只读工具、输出response文本"""
+        reader = IncrementalJSONReader()
+        content = []
+        started = time.perf_counter()
+        first_byte = None
+        
+        with tracer.span("http", stream=True, bytes=self.context_manager.stats["last_bytes"]) as http_span:
+            async with contextlib.aclosing(self.client.astream_request(self.messages)) as stream:
+                async for delta in stream:
+                    if first_byte is None:
+                        first_byte = time.perf_counter() - started
+                        tracer.observe("http_ttfb", first_byte)
+                    if "error" in delta:
+                        http_span.set(error=delta["error"])
+                        return {"error": delta["error"]}
+                    text = delta.get("content")
+                    if not text:
+                        continue
+                    content.append(text)
+                    
+                    for event, value in reader.feed(text):
+                        if event == "tool_call":
+                            self._prefetch_tool_call(value[0], value[1], prefetched)
+                        elif event == "response_delta":
+                            if reader.fields.get("action") == "final_response" and self.on_response_delta:
+                                self.loading_animation.stop()
+                                self.on_response_delta(value)
+                        elif event == "field" and value[0] in ("response", "actions"):
+                            self._speak_early(reader.fields)
+                        elif event == "end":
+                            self._speak_early(reader.fields, finished=True)
+            
+            http_span.set(ttfb_ms=round((first_byte or 0) * 1000, 3), chunks=len(content))
+        return {"choices": [{"message": {"role": "assistant", "content": "".join(content)}}]}
+    
+    def _prefetch_tool_call(self, index: int, tool_call: Dict, prefetched: Dict):
+        """在响应完整到达前提前执行只读工具"""
+        function = tool_call.get("function") if isinstance(tool_call, dict) else None
+        if not isinstance(function, dict):
+            return
+        name = self._correct_tool_name(function.get("name", ""))
+        arguments = function.get("arguments", {})
+        # 前面出现过非只读工具时不再提前执行，保证读操作不会越过写操作
+        if prefetched.get("blocked"):
+            return
+        if name not in ToolExecutor.READ_ONLY_TOOLS or not isinstance(arguments, dict):
+            prefetched["blocked"] = True
+            return
+        
+        task = asyncio.ensure_future(self.tool_executor.aexecute_tool(name, dict(arguments)))
+        prefetched[index] = (name, json.dumps(arguments, sort_keys=True), task)
     
-    def _process_response(self, response_data: Dict, iteration: int) -> Dict:
+    def _speak_early(self, fields: Dict, finished: bool = False):
+        """response和actions都已到达时立即交给Live2D朗读，无需等待整个响应结束"""
+        if self._spoken or fields.get("action") != "final_response":
+            return
+        response = fields.get("response")
+        if not isinstance(response, str):
+            return
+        if "actions" not in fields and not finished:
+            return
+        actions = fields.get("actions")
+        self._dispatch_live2d(response, actions if isinstance(actions, list) else [])
+        self._spoken = True
+    
+    def _dispatch_live2d(self, text: str, actions: List[str] = None):
+        """发送Live2D消息（只入队，不阻塞事件循环）"""
+        self._send_to_live2d(text, actions)
+    
+    async def _process_response(self, response_data: Dict, iteration: int, prefetched: Dict = None) -> Dict:
         """处理AI的响应"""
         thinking = response_data.get("thinking", "无思考内容")
         action = response_data.get("action", "")
         
         print(f"[第{iteration}次思考] {thinking}")
+        self._emit_progress({"stage": "thinking", "iteration": iteration, "thinking": thinking, "action": action})
         
         if action == "tool_call" and "tool_calls" in response_data:
-            return self._handle_tool_calls(response_data["tool_calls"], thinking, iteration)
+            return await self._handle_tool_calls(response_data["tool_calls"], thinking, iteration, prefetched)
         elif action == "final_response" and "response" in response_data:
             return self._handle_final_response(response_data, thinking, iteration)
         else:
             return self._create_error_response("响应格式不正确，缺少action或必要字段", thinking)
     
-    def _handle_tool_calls(self, tool_calls: List[Dict], thinking: str, iteration: int) -> Dict:
+    async def _handle_tool_calls(self, tool_calls: List[Dict], thinking: str, iteration: int,
+                                 prefetched: Dict = None) -> Dict:
         """处理工具调用"""
-        tool_results = []
+        prefetched = prefetched or {}
+        calls = []
         
-        for tool_call in tool_calls:
+        for index, tool_call in enumerate(tool_calls):
             if "function" in tool_call:
                 function = tool_call["function"]
                 name = function.get("name", "")
@@ -1140,11 +4536,24 @@ class XiaoLiAgent:
                 # 工具名称修正
                 name = self._correct_tool_name(name)
                 
-                print(f"[系统] 调用工具: {name}({arguments})")
-                result = self.tool_executor.execute_tool(name, arguments)
-                print(f"[系统] 结果: {result}")
-                
-                tool_results.append({"tool": name, "result": result})
+                early = prefetched.get(index)
+                if early and early[0] == name and early[1] == json.dumps(arguments, sort_keys=True):
+                    calls.append((name, arguments, early[2]))
+                else:
+                    calls.append((name, arguments, None))
+        
+        def on_start(name, arguments):
+            print(f"[系统] 调用工具: {name}({arguments})")
+            self._emit_progress({"stage": "tool_start", "iteration": iteration, "tool": name,
+                                 "arguments": self._preview_arguments(arguments)})
+        
+        def on_done(name, result):
+            print(f"[系统] 结果: {result}")
+            self._emit_progress({"stage": "tool_done", "iteration": iteration, "tool": name,
+                                 "result": self._preview(result)})
+        
+        results = await self.tool_scheduler.run(calls, on_start=on_start, on_done=on_done)
+        tool_results = [{"tool": call[0], "result": result} for call, result in zip(calls, results)]
         
         if tool_results:
             # 将工具结果发送回AI继续处理
@@ -1155,7 +4564,7 @@ class XiaoLiAgent:
             if iteration >= 2:
                 efficiency_note = " 💡提示：请尽量在下次思考中完成所有操作，减少思考次数。"
             
-            self.messages.append({
+            self._append_message({
                 "role": "user", 
                 "content": f"工具执行结果: {result_summary}.{efficiency_note} 请根据结果生成最终回复。"
             })
@@ -1166,6 +4575,31 @@ class XiaoLiAgent:
             # 没有工具调用结果，直接返回最终响应
             return {"continue": False, "thinking": thinking, "response": "没有执行任何工具操作"}
     
+    def _emit_progress(self, event: Dict):
+        if self.on_progress:
+            self.on_progress(event)
+    
+    @classmethod
+    def _preview_arguments(cls, arguments, limit: int = 200):
+        """进度事件中的工具参数：过长的值只带开头部分"""
+        if not isinstance(arguments, dict):
+            return cls._preview(arguments, limit)
+        preview = {}
+        for key, value in arguments.items():
+            if isinstance(value, str):
+                preview[key] = cls._preview(value, limit)
+            elif isinstance(value, (list, dict)) and len(json.dumps(value, ensure_ascii=False)) > limit:
+                preview[key] = cls._preview(json.dumps(value, ensure_ascii=False), limit)
+            else:
+                preview[key] = value
+        return preview
+    
+    @staticmethod
+    def _preview(result, limit: int = 200) -> str:
+        """进度事件中的工具结果只带开头部分"""
+        text = result if isinstance(result, str) else str(result)
+        return text if len(text) <= limit else text[:limit] + "..."
+    
     def _handle_final_response(self, response_data: Dict, thinking: str, iteration: int) -> Dict:
         """处理最终回复"""
         response = response_data.get("response", "")
@@ -1176,10 +4610,11 @@ class XiaoLiAgent:
         if iteration > 1:
             efficiency_note = f" (经过{iteration}次思考)"
         
-        # 发送到Live2D进行语音朗读和动作执行
-        self._send_to_live2d(response, actions)
+        # 发送到Live2D进行语音朗读和动作执行（流式模式下可能已提前发送）
+        if not self._spoken:
+            self._dispatch_live2d(response, actions)
         
-        self.messages.append({
+        self._append_message({
             "role": "assistant", 
             "content": json.dumps({
                 "thinking": thinking + efficiency_note,
@@ -1238,45 +4673,16 @@ class XiaoLiAgent:
     
     def _send_to_live2d(self, text: str, actions: List[str] = None):
         """发送文本到Live2D进行语音朗读和动作执行"""
-        try:
-            import socket
-            client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            client_socket.settimeout(2)
-            client_socket.connect(('127.0.0.1', 12345))
-            
-            # 如果没有指定动作，根据文本内容智能生成
-            if actions is None:
-                actions = self._generate_actions_from_text(text)
-            
-            # 发送JSON格式的消息，包含语音和动作
-            message = json.dumps({
-                "type": "speak_and_action",
-                "text": text,
-                "actions": actions
-            })
-            client_socket.send(message.encode('utf-8'))
-            client_socket.close()
-        except Exception as e:
-            # 静默失败，不影响主程序运行
-            pass
+        # 如果没有指定动作，根据文本内容智能生成
+        if actions is None:
+            actions = self._generate_actions_from_text(text)
+        
+        # 放入发送队列，由后台线程每条消息单独连接发送；宠物未运行时静默丢弃，不影响主程序运行
+        live2d_channel.speak(text, actions)
     
     def _stop_live2d_speech(self):
         """打断Live2D的语音朗读"""
-        try:
-            import socket
-            client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            client_socket.settimeout(2)
-            client_socket.connect(('127.0.0.1', 12345))
-            
-            # 发送打断消息
-            message = json.dumps({
-                "type": "stop"
-            })
-            client_socket.send(message.encode('utf-8'))
-            client_socket.close()
-        except Exception as e:
-            # 静默失败
-            pass
+        live2d_channel.stop()
     
     def _launch_ui(self):
         """启动AI对话UI界面"""
@@ -1333,58 +4739,519 @@ class XiaoLiAgent:
         return json.dumps({
             "thinking": thinking,
             "action": "final_response",
-            "response": message
+            "response": message,
+            "error": True
         })
 
-def handle_ai_client(client):
-    """处理AI客户端连接"""
-    try:
-        xiaoli = XiaoLiAgent("CH"+"DU"+"zbzQNJNWJ"+"wMBHBre:Od"+"EuSZOERnAVAhip"+"kKFi")
+class FrameDecoder:
+    """UI协议分帧：每条消息是一行JSON（以换行结尾）
+    
+    兼容旧版UI发送的不带换行的单个JSON对象；缓冲区有上限，超出时报错。
+    """
+    
+    def __init__(self, max_frame_bytes: int = 1024 * 1024):
+        self.max_frame_bytes = max_frame_bytes
+        self._buffer = bytearray()
+        self._decoder = json.JSONDecoder()
+    
+    def feed(self, data: bytes) -> List[Union[Dict, Exception]]:
+        """喂入收到的数据，返回解析出的消息；无效的帧以异常对象表示"""
+        self._buffer.extend(data)
+        frames = []
+        while self._buffer:
+            newline = self._buffer.find(b"\n")
+            if newline >= 0:
+                line = bytes(self._buffer[:newline])
+                del self._buffer[:newline + 1]
+                if line.strip():
+                    frames.append(self._parse(line))
+                continue
+            
+            # 旧版客户端：没有换行，尝试解析完整的JSON对象
+            try:
+                text = self._buffer.decode('utf-8')
+            except UnicodeDecodeError:
+                break
+            stripped = text.lstrip()
+            try:
+                message, end = self._decoder.raw_decode(stripped)
+            except ValueError:
+                break
+            consumed = len(stripped[:end].encode('utf-8')) + len(text) - len(stripped)
+            del self._buffer[:consumed]
+            frames.append(message if isinstance(message, dict) else ValueError("消息必须是JSON对象"))
+        
+        if len(self._buffer) > self.max_frame_bytes:
+            self._buffer.clear()
+            frames.append(OverflowError(f"消息超过 {self.max_frame_bytes} 字节上限"))
+        return frames
+    
+    @staticmethod
+    def _parse(line: bytes) -> Union[Dict, Exception]:
+        try:
+            message = json.loads(line.decode('utf-8'))
+        except (UnicodeDecodeError, json.JSONDecodeError) as e:
+            return e
+        return message if isinstance(message, dict) else ValueError("消息必须是JSON对象")
+    
+    @staticmethod
+    def encode(message: Dict) -> bytes:
+        """编码一条发往UI的消息"""
+        return (json.dumps(message, ensure_ascii=False) + "\n").encode('utf-8')
+
+
+class Session:
+    """一个UI会话：对话历史保存在agent中，断线重连后可以继续"""
+    
+    # 每个会话除消息外的固定开销估计（agent、调度器、上下文管理器等）
+    BASE_BYTES = 16 * 1024
+    
+    def __init__(self, session_id: str, agent: "XiaoLiAgent"):
+        self.session_id = session_id
+        self.agent = agent
+        self.lock = asyncio.Lock()
+        self.attached = 0
+        self.created = time.time()
+        self.last_active = time.monotonic()
+    
+    @property
+    def turns(self) -> int:
+        if self.agent.journal is not None:
+            return self.agent.journal.turns
+        return sum(1 for m in self.agent.messages if m.get("role") == "assistant")
+    
+    def memory_bytes(self) -> int:
+        """估算会话占用的内存"""
+        return self.BASE_BYTES + sum(sys.getsizeof(m.get("content") or "") for m in self.agent.messages)
+    
+    def touch(self):
+        self.last_active = time.monotonic()
+
+
+class SessionManager:
+    """会话表：所有会话共享一个API客户端，工具执行器的缓存和溢出存储也共用，只有工作目录各自独立
+    
+    未连接的会话按LRU顺序淘汰：空闲超过idle_timeout秒、会话数超过max_sessions、
+    或总内存超过max_memory_bytes时，最久未使用的会话先被移除。
+    设置journal_dir后会话写入日志，被淘汰或服务器重启后在下次连接时从日志恢复。
+    """
+    
+    MAX_SESSION_ID_LENGTH = 64
+    
+    def __init__(self, client: SparkX1Client, tool_executor: Optional[ToolExecutor] = None, api_password: str = "",
+                 stream: bool = True, max_sessions: int = 200, idle_timeout: float = 1800,
+                 max_memory_bytes: int = 64 * 1024 * 1024, upstream: Optional[UpstreamScheduler] = None,
+                 journal_dir: Optional[str] = None, use_router: bool = True):
+        self.client = client
+        self.journal_dir = journal_dir
+        # 所有会话共享一个本地意图路由
+        self.router = IntentRouter() if use_router else None
+        self.tool_executor = tool_executor or ToolExecutor()
+        self.upstream = upstream or UpstreamScheduler()
+        self.api_password = api_password
+        self.stream = stream
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.max_memory_bytes = max_memory_bytes
+        self._sessions: "OrderedDict[str, Session]" = OrderedDict()
+        self._stats = {"created": 0, "resumed": 0, "restored": 0, "evicted_idle": 0, "evicted_lru": 0}
+    
+    def _create_agent(self, session_id: str, persistent: bool) -> "XiaoLiAgent":
+        journal = SessionJournal(self.journal_dir, session_id) if self.journal_dir and persistent else None
+        return XiaoLiAgent(self.api_password, stream=self.stream, client=self.client,
+                           tool_executor=self.tool_executor.fork(), upstream=self.upstream, session_key=session_id,
+                           journal=journal, router=self.router, use_router=self.router is not None)
+    
+    def attach(self, session_id: Optional[str] = None, persistent: bool = True) -> Tuple[Session, bool]:
+        """连接到会话，返回(会话, 是否为已有会话)；不在内存中的会话从日志恢复，否则新建
+        
+        persistent为False的临时会话不写日志。
+        """
+        if not isinstance(session_id, str) or not session_id or len(session_id) > self.MAX_SESSION_ID_LENGTH:
+            session_id = uuid.uuid4().hex
+        
+        session = self._sessions.get(session_id)
+        resumed = session is not None
+        if resumed:
+            self._sessions.move_to_end(session_id)
+            self._stats["resumed"] += 1
+        else:
+            resumed = bool(self.journal_dir) and persistent and SessionJournal.exists(self.journal_dir, session_id)
+            session = Session(session_id, self._create_agent(session_id, persistent))
+            self._sessions[session_id] = session
+            self._stats["restored" if resumed else "created"] += 1
+        session.attached += 1
+        session.touch()
+        self.evict()
+        return session, resumed
+    
+    def detach(self, session: Session, discard: bool = False):
+        """断开连接；discard为True时直接移除会话（不支持重连的旧版客户端）"""
+        session.attached = max(0, session.attached - 1)
+        session.touch()
+        if session.session_id in self._sessions:
+            self._sessions.move_to_end(session.session_id)
+        if discard and session.attached == 0 and not session.lock.locked():
+            self._remove(session)
+        else:
+            self.evict()
+    
+    def get(self, session_id: str) -> Optional[Session]:
+        return self._sessions.get(session_id)
+    
+    def evict(self) -> int:
+        """淘汰空闲和超出限额的会话，返回淘汰数量"""
+        evicted = 0
+        now = time.monotonic()
+        for session in list(self._sessions.values()):
+            if self._evictable(session) and now - session.last_active > self.idle_timeout:
+                self._remove(session)
+                self._stats["evicted_idle"] += 1
+                evicted += 1
         
+        memory = self.memory_bytes()
+        for session in list(self._sessions.values()):
+            if len(self._sessions) <= self.max_sessions and memory <= self.max_memory_bytes:
+                break
+            if not self._evictable(session):
+                continue
+            memory -= session.memory_bytes()
+            self._remove(session)
+            self._stats["evicted_lru"] += 1
+            evicted += 1
+        return evicted
+    
+    def _remove(self, session: Session):
+        self._sessions.pop(session.session_id, None)
+        session.agent.tool_executor.close()
+        if session.agent.journal is not None:
+            session.agent.journal.close()
+    
+    @staticmethod
+    def _evictable(session: Session) -> bool:
+        return session.attached == 0 and not session.lock.locked()
+    
+    def memory_bytes(self) -> int:
+        return sum(session.memory_bytes() for session in self._sessions.values())
+    
+    def stats(self) -> Dict:
+        stats = dict(self._stats)
+        stats["sessions"] = len(self._sessions)
+        stats["attached"] = sum(1 for session in self._sessions.values() if session.attached)
+        stats["memory_bytes"] = self.memory_bytes()
+        if self.router is not None:
+            stats["router"] = dict(self.router.stats)
+        return stats
+    
+    async def aclose(self):
+        """释放共享的客户端和工具执行器"""
+        self._sessions.clear()
+        await self.client.aclose()
+        self.client.close()
+        self.tool_executor.close()
+
+
+class AIServer:
+    """端口8888的AI服务：单个事件循环处理所有UI连接，不再为每个连接创建线程"""
+    
+    # 流式推送的发送缓冲上限（字节），超过后暂停推送增量和进度事件
+    PUSH_HIGH_WATER = 256 * 1024
+    
+    def __init__(self, sessions: SessionManager, host: str = "127.0.0.1", port: int = 8888,
+                 max_frame_bytes: int = 1024 * 1024, max_connections: int = 1000, read_chunk: int = 65536,
+                 sweep_interval: float = 60, max_pending_turns: int = 16):
+        self.sessions = sessions
+        self.max_pending_turns = max_pending_turns
+        self.sweep_interval = sweep_interval
+        self.host = host
+        self.port = port
+        self.max_frame_bytes = max_frame_bytes
+        self.max_connections = max_connections
+        self.read_chunk = read_chunk
+        self.loop = None
+        self._server = None
+        self._connections = {}  # task -> writer
+        self._busy = set()
+        self._closing = False
+        self._ready = threading.Event()
+        self._thread = None
+        self._stop = None
+        self.grace = 5.0
+        self.start_error = None
+    
+    async def serve(self):
+        """启动监听，直到shutdown()"""
+        self.loop = asyncio.get_running_loop()
+        try:
+            self._server = await asyncio.start_server(self._on_connect, self.host, self.port,
+                                                      reuse_address=True, backlog=512)
+        except OSError as e:
+            self.start_error = e
+            self._ready.set()
+            raise
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._stop = asyncio.Event()
+        print(f"AI服务已启动在端口 {self.port}")
+        self._ready.set()
+        sweeper = asyncio.create_task(self._sweep_sessions())
+        await self._stop.wait()
+        sweeper.cancel()
+        await self._drain_connections()
+        await self.sessions.aclose()
+    
+    async def _sweep_sessions(self):
+        """定期淘汰空闲会话"""
         while True:
+            await asyncio.sleep(self.sweep_interval)
+            self.sessions.evict()
+    
+    def start_in_thread(self) -> bool:
+        """在后台线程中运行事件循环，返回是否启动成功"""
+        def run():
+            try:
+                asyncio.run(self.serve())
+            except Exception as e:
+                if self.start_error is None:
+                    self.start_error = e
+                self._ready.set()
+        
+        self._thread = threading.Thread(target=run, name="xiaoli-ai-server", daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        if self.start_error is not None:
+            print(f"AI服务启动失败: {self.start_error}")
+            return False
+        return True
+    
+    def shutdown(self, grace: float = 5.0):
+        """优雅关闭：停止接受新连接，等待进行中的对话结束（最多grace秒）"""
+        if self.loop is None or self.loop.is_closed() or self._stop is None:
+            return
+        self.grace = grace
+        self.loop.call_soon_threadsafe(self._stop.set)
+        if self._thread is not None:
+            self._thread.join(timeout=grace + 2)
+    
+    async def _drain_connections(self):
+        self._closing = True
+        self._server.close()
+        # 空闲连接立即关闭，正在处理的连接处理完当前消息后关闭
+        for task, writer in list(self._connections.items()):
+            if task not in self._busy:
+                writer.close()
+        tasks = list(self._connections)
+        if tasks:
+            done, pending = await asyncio.wait(tasks, timeout=self.grace)
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.wait(pending, timeout=1)
+    
+    async def _on_connect(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        task = asyncio.current_task()
+        if self._closing or len(self._connections) >= self.max_connections:
+            writer.write(FrameDecoder.encode({"type": "error", "text": "服务器繁忙，请稍后再试"}))
+            writer.close()
+            return
+        
+        self._connections[task] = writer
+        try:
+            await self.handle_ai_client(reader, writer)
+        finally:
+            self._connections.pop(task, None)
+            self._busy.discard(task)
+            writer.close()
             try:
-                data = client.recv(4096).decode('utf-8')
+                await writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+    
+    async def handle_ai_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """处理AI客户端连接
+        
+        客户端可先发送 {"type": "hello", "session_id": ...} 连接到指定会话（省略ID则新建，带 "turn": N
+        时回退到第N轮结束时的状态），服务器回复 {"type": "session", "session_id": ..., "resumed": ..., "turns": ...}；
+        未发送hello的旧版客户端使用随连接结束而丢弃的临时会话。
+        
+        发送 {"type": "stats"} 可获取会话表和上游请求队列的指标。
+        
+        hello或user_input中带 "stream": true 时，对话过程中依次发送 ai_response_delta（回复文本增量）、
+        tool_progress（思考内容和工具调用进度），最后以 ai_response_done 代替 ai_response。
+        
+        对话在单独的任务中依次执行，期间继续读取消息：{"type": "cancel"} 或断开连接会取消当前对话
+        并丢弃排队的输入，被取消的回复带 "cancelled": true。
+        """
+        addr = writer.get_extra_info("peername")
+        print(f"客户端连接: {addr}")
+        decoder = FrameDecoder(self.max_frame_bytes)
+        turns = asyncio.Queue(maxsize=self.max_pending_turns)
+        state = {"session": None, "anonymous": False, "token": None}
+        worker = asyncio.create_task(self._turn_worker(turns, state, writer, asyncio.current_task()))
+        streaming = False
+        
+        try:
+            while True:
+                data = await reader.read(self.read_chunk)
                 if not data:
                     break
                 
-                message = json.loads(data)
-                if message.get('type') == 'user_input' and message.get('text'):
+                for message in decoder.feed(data):
+                    if isinstance(message, OverflowError):
+                        await self._send(writer, {"type": "error", "text": str(message)})
+                        return
+                    if isinstance(message, Exception):
+                        print("收到无效的JSON数据")
+                        continue
+                    
+                    if message.get('type') == 'hello':
+                        if state["session"] is not None:
+                            self.sessions.detach(state["session"], discard=state["anonymous"])
+                        state["session"], resumed = self.sessions.attach(message.get('session_id'))
+                        state["anonymous"] = False
+                        streaming = bool(message.get('stream', streaming))
+                        reply = {"type": "session", "session_id": state["session"].session_id,
+                                 "resumed": resumed}
+                        if message.get('turn') is not None:
+                            # 回到指定轮次结束时的状态
+                            error = self._rewind(state["session"], message['turn'])
+                            if error:
+                                reply["error"] = error
+                        reply["turns"] = state["session"].turns
+                        await self._send(writer, reply)
+                        continue
+                    if message.get('type') == 'stats':
+                        await self._send(writer, {"type": "stats", "sessions": self.sessions.stats(),
+                                                  "upstream": self.sessions.upstream.stats()})
+                        continue
+                    if message.get('type') == 'cancel':
+                        self._cancel_turns(turns, state, "用户取消")
+                        continue
+                    if message.get('type') != 'user_input' or not message.get('text') or self._closing:
+                        continue
+                    
                     user_input = message['text']
                     print(f"收到用户输入: {user_input}")
+                    if state["session"] is None:
+                        state["anonymous"] = 'session_id' not in message
+                        state["session"], _ = self.sessions.attach(message.get('session_id'),
+                                                                   persistent=not state["anonymous"])
                     
-                    # 处理用户输入
-                    response = xiaoli.process_user_input(user_input)
-                    
-                    # 发送回复
                     try:
-                        response_data = json.loads(response)
-                        if "response" in response_data:
-                            ai_response = response_data["response"]
-                        else:
-                            ai_response = response
-                    except:
-                        ai_response = response
-                    
-                    # 发送回复给UI
-                    reply = json.dumps({
-                        "type": "ai_response",
-                        "text": ai_response
-                    })
-                    client.send(reply.encode('utf-8'))
-                    
-            except json.JSONDecodeError:
-                print("收到无效的JSON数据")
-            except Exception as e:
-                print(f"处理客户端错误: {e}")
-                break
-                
-    except Exception as e:
-        print(f"AI客户端处理错误: {e}")
-    finally:
+                        turns.put_nowait((state["session"], user_input, bool(message.get('stream', streaming))))
+                    except asyncio.QueueFull:
+                        await self._send(writer, {"type": "error", "text": "待处理的消息过多，请等待当前回复完成"})
+        except (ConnectionError, OSError) as e:
+            print(f"处理客户端错误: {e}")
+        finally:
+            # 断开连接：取消进行中的对话，释放上游名额和工具子进程，等对话收尾后再结束
+            self._cancel_turns(turns, state, "客户端已断开")
+            turns.put_nowait(None)
+            try:
+                await asyncio.wait_for(worker, timeout=2)
+            except (asyncio.TimeoutError, asyncio.CancelledError):
+                worker.cancel()
+            except (ConnectionError, OSError):
+                pass
+            if state["session"] is not None:
+                self.sessions.detach(state["session"], discard=state["anonymous"])
+    
+    @staticmethod
+    def _rewind(session: Session, turn) -> Optional[str]:
+        """回退会话，失败时返回错误说明"""
+        if session.lock.locked():
+            return "会话正在进行对话，无法回退"
         try:
-            client.close()
-        except:
-            pass
+            session.agent.rewind(int(turn))
+        except (TypeError, ValueError) as e:
+            return str(e)
+        return None
+    
+    @staticmethod
+    def _cancel_turns(turns: asyncio.Queue, state: Dict, reason: str):
+        """取消当前对话并丢弃排队的输入"""
+        while not turns.empty():
+            turns.get_nowait()
+        if state["token"] is not None:
+            state["token"].cancel(reason)
+    
+    async def _turn_worker(self, turns: asyncio.Queue, state: Dict, writer: asyncio.StreamWriter, connection):
+        """依次执行一个连接排队的对话"""
+        while True:
+            item = await turns.get()
+            if item is None:
+                return
+            session, user_input, stream_turn = item
+            state["token"] = cancel_token = CancelToken()
+            self._busy.add(connection)
+            try:
+                async with session.lock:
+                    response = await self._run_turn(session, user_input, writer, stream_turn, cancel_token)
+            finally:
+                state["token"] = None
+                self._busy.discard(connection)
+                session.touch()
+            
+            actions = []
+            try:
+                response_data = json.loads(response)
+                ai_response = response_data.get("response", response)
+                actions = response_data.get("actions") or []
+            except (json.JSONDecodeError, AttributeError):
+                response_data, ai_response = {}, response
+            
+            # 发送回复给UI，出错或被取消的回复分别带 "error": true / "cancelled": true
+            reply = {"type": "ai_response_done" if stream_turn else "ai_response", "text": ai_response,
+                     "session_id": session.session_id}
+            if stream_turn:
+                reply["actions"] = actions
+            for flag in ("error", "cancelled"):
+                if response_data.get(flag):
+                    reply[flag] = True
+            try:
+                await self._send(writer, reply)
+            except (ConnectionError, OSError):
+                return
+            if self._closing and turns.empty():
+                writer.close()
+    
+    @staticmethod
+    async def _run_turn(session: Session, user_input: str, writer: asyncio.StreamWriter, streaming: bool,
+                        cancel_token: CancelToken) -> str:
+        """执行一轮对话；streaming为True时把回复增量和工具进度实时推送给UI"""
+        agent = session.agent
+        if not streaming:
+            return await agent.aprocess_user_input(user_input, cancel_token)
+        
+        held = []
+        
+        def push(message: Dict):
+            # 回调是同步的，不能await drain；UI读得慢、发送缓冲超过上限时
+            # 暂存回复增量（之后合并发送），丢弃进度事件，最终的ai_response_done总是带完整文本
+            if writer.is_closing():
+                return
+            if writer.transport.get_write_buffer_size() > AIServer.PUSH_HIGH_WATER:
+                if message["type"] == "ai_response_delta":
+                    held.append(message["text"])
+                return
+            if held and message["type"] == "ai_response_delta":
+                message["text"] = "".join(held) + message["text"]
+                held.clear()
+            message["session_id"] = session.session_id
+            writer.write(FrameDecoder.encode(message))
+        
+        agent.on_response_delta = lambda text: push({"type": "ai_response_delta", "text": text})
+        agent.on_progress = lambda event: push({"type": "tool_progress", **event})
+        try:
+            return await agent.aprocess_user_input(user_input, cancel_token)
+        finally:
+            agent.on_response_delta = None
+            agent.on_progress = None
+    
+    @staticmethod
+    async def _send(writer: asyncio.StreamWriter, message: Dict):
+        writer.write(FrameDecoder.encode(message))
+        await writer.drain()
+
 
 def load_encrypted_api_key():
     """从加密配置文件中读取API密钥"""
@@ -1410,35 +5277,56 @@ def load_encrypted_api_key():
 
 def main():
     """主函数"""
-    # 从加密配置文件中读取API密钥
-    api_password = load_encrypted_api_key()
+    import argparse
+    parser = argparse.ArgumentParser(description="小狸猫娘AI助手")
+    parser.add_argument("--cache-dir", help="大模型响应缓存目录（不指定则不缓存）")
+    parser.add_argument("--cache-mode", choices=ResponseCache.MODES, default="readwrite",
+                        help="缓存模式：readwrite命中即用，record只记录，replay只回放不联网")
+    parser.add_argument("--trace", help="开启分阶段计时，span写入该JSONL文件")
+    parser.add_argument("--metrics", help="退出时把聚合的计时（Prometheus文本格式）写入该文件")
+    parser.add_argument("--journal-dir", help="会话日志目录：保存对话历史，重启后可继续（不指定则不保存）")
+    parser.add_argument("--session", default="repl", help="命令行对话使用的会话ID（配合--journal-dir）")
+    parser.add_argument("--no-router", action="store_true", help="关闭本地意图路由，所有请求都交给大模型")
+    parser.add_argument("--upstream-rate", type=float, default=0.0,
+                        help="AI服务发往大模型的每秒请求数上限（按账号配额设置，0表示不限）")
+    parser.add_argument("--index-root", action="append", default=[],
+                        help="为该目录建立内容搜索索引（可重复指定）")
+    parser.add_argument("--index-dir", default=os.path.join(os.path.expanduser("~"), ".xiaoli", "index"),
+                        help="内容搜索索引的存放目录")
+    args = parser.parse_args()
     
-    # 启动AI服务Socket服务器
-    def start_ai_server():
-        try:
-            import socket
-            server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            server.bind(('127.0.0.1', 8888))
-            server.listen(5)
-            
-            print("AI服务已启动在端口 8888")
-            
-            while True:
-                try:
-                    client, addr = server.accept()
-                    print(f"客户端连接: {addr}")
-                    
-                    # 在新线程中处理客户端
-                    threading.Thread(target=handle_ai_client, args=(client,), daemon=True).start()
-                except Exception as e:
-                    print(f"AI服务错误: {e}")
-        except Exception as e:
-            print(f"AI服务启动失败: {e}")
+    if args.trace or args.metrics:
+        tracer.configure(args.trace)
+    if args.metrics:
+        def dump_metrics():
+            with open(args.metrics, 'w', encoding='utf-8') as f:
+                f.write(tracer.prometheus_text())
+        atexit.register(dump_metrics)
+    
+    response_cache = None
+    if args.cache_dir:
+        response_cache = ResponseCache(args.cache_dir, mode=args.cache_mode)
+    
+    # 从加密配置文件中读取API密钥（回放模式不访问网络，不需要密钥）
+    if response_cache is not None and response_cache.mode == "replay":
+        api_password = ""
+    else:
+        api_password = load_encrypted_api_key()
     
-    # 启动AI服务线程
-    ai_server_thread = threading.Thread(target=start_ai_server, daemon=True)
-    ai_server_thread.start()
+    # 启动AI服务（单线程事件循环处理所有UI连接）
+    ai_api_password = "CH"+"DU"+"zbzQNJNWJ"+"wMBHBre:Od"+"EuSZOERnAVAhip"+"kKFi"
+    search_index = None
+    if args.index_root:
+        search_index = SearchIndexStore(args.index_dir, args.index_root)
+        # 后台建立索引，首次搜索不必等待整个目录扫描
+        threading.Thread(target=search_index.update_all, daemon=True, name="xiaoli-index").start()
+    
+    ai_server = AIServer(SessionManager(SparkX1Client(ai_api_password, response_cache=response_cache),
+                                        tool_executor=ToolExecutor(search_index=search_index),
+                                        upstream=UpstreamScheduler(rate=args.upstream_rate),
+                                        api_password=ai_api_password, journal_dir=args.journal_dir,
+                                        use_router=not args.no_router))
+    ai_server.start_in_thread()
     
     # 启动XiaoLi-live2d桌面宠物
     try:
@@ -1467,7 +5355,22 @@ def main():
     print("=" * 60)
     print("")
     
-    xiaoli = XiaoLiAgent(api_password)
+    # 命令行会话放在单独的子目录，避免与服务器端同名的会话ID写同一个日志文件
+    journal = SessionJournal(os.path.join(args.journal_dir, "cli"), args.session) if args.journal_dir else None
+    xiaoli = XiaoLiAgent(api_password, client=SparkX1Client(api_password, response_cache=response_cache),
+                         tool_executor=ToolExecutor(search_index=search_index), journal=journal,
+                         use_router=not args.no_router)
+    if journal is not None and journal.turns:
+        print(f"🐱 小狸: 已恢复会话 {args.session}（{journal.turns} 轮对话）喵~")
+    
+    # 流式输出回复文本
+    streamed = []
+    def print_delta(text):
+        if not streamed:
+            print("小狸: ", end="", flush=True)
+        streamed.append(text)
+        print(text, end="", flush=True)
+    xiaoli.on_response_delta = print_delta
     
     while True:
         try:
@@ -1475,9 +5378,10 @@ def main():
             
             if user_input.lower() in ['exit', 'quit', '退出']:
                 print("🐱 小狸: 再见喵~ 下次再来找小狸玩哦！")
+                ai_server.shutdown()
                 break
             elif user_input.lower() in ['clear', '清除', '清空']:
-                xiaoli.messages = xiaoli.messages[:1]
+                xiaoli.clear_history()
                 print("🐱 小狸: 对话历史已清空喵~")
                 continue
             elif user_input.lower() in ['/ui', 'ui', '界面']:
@@ -1486,12 +5390,21 @@ def main():
             elif user_input == '':
                 continue
             
-            response = xiaoli.process_user_input(user_input)
+            streamed.clear()
+            # 对话进行中按Ctrl+C只取消本轮，不退出程序
+            cancel_token = CancelToken()
+            previous_handler = signal.signal(signal.SIGINT, lambda signum, frame: cancel_token.cancel("Ctrl+C"))
+            try:
+                response = xiaoli.process_user_input(user_input, cancel_token)
+            finally:
+                signal.signal(signal.SIGINT, previous_handler)
             
             # 解析并显示响应
             try:
                 response_data = json.loads(response)
-                if "response" in response_data:
+                if streamed:
+                    print("")
+                elif "response" in response_data:
                     print(f"小狸: {response_data['response']}")
                 else:
                     print(f"小狸: {response}")